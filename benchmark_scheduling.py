@@ -0,0 +1,91 @@
+from system.log_support import init_logger
+import argparse
+import threading
+import multiprocessing
+import time
+import config
+import cv2 as cv
+from system.cpu_scheduler import CpuScheduler, assignCoreSets, setThreadAffinity
+from system.motion_detection import MotionDetector
+
+
+def cameraWorker(source, seconds, cpus, results, name):
+    """
+    Reads and detects motion in frames like recorder does, source is reopened when it ends
+    """
+    if cpus is not None:
+        setThreadAffinity(cpus)
+
+    detector = MotionDetector()
+    detector.resizeBeforeDetect = False
+
+    cap = cv.VideoCapture(source)
+    framesQty = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        (ret, frame) = cap.read()
+        if (not ret) or (frame is None):
+            cap.release()
+            cap = cv.VideoCapture(source)
+            continue
+
+        detector.motionDetected(frame)
+        framesQty += 1
+
+    cap.release()
+    results[name] = framesQty / float(seconds)
+
+
+def runMode(source, camerasQty, seconds, scheduled, queue):
+    """
+    Runs cameras in separate process, so OpenCV threads settings of one mode don't affect another one
+    """
+    logger = init_logger()
+    names = ["cam{}".format(i) for i in range(camerasQty)]
+
+    plan = {}
+    if scheduled:
+        scheduler = CpuScheduler(logger, config.CPU_AFFINITY_CPUS, pinning=True)
+        for name in names:
+            scheduler.addCamera(name)
+
+        plan = assignCoreSets(scheduler.weights, scheduler.cpus)
+
+    results = {}
+    threads = [
+        threading.Thread(target=cameraWorker, args=(source, seconds, plan.get(name), results, name))
+        for name in names
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    queue.put(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares throughput of cameras with and without threads limits and CPU pinning")
+    parser.add_argument("--source", default=config.cam, help="camera connection string or video file")
+    parser.add_argument("--cameras", default=multiprocessing.cpu_count(), type=int, help="count of simulated cameras")
+    parser.add_argument("--seconds", default=30, type=int, help="duration of each run")
+    args = parser.parse_args()
+
+    for (title, scheduled) in [("default", False), ("scheduled", True)]:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=runMode, args=(args.source, args.cameras, args.seconds, scheduled, queue))
+        process.start()
+        results = queue.get()
+        process.join()
+
+        fps = sorted(results.values())
+        print("{}: total {:.1f} fps, per camera min {:.1f} / max {:.1f} fps".format(title, sum(fps), fps[0], fps[-1]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
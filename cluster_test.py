@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import tempfile
+import time
+import multiprocessing
+import config
+
+
+def runNode(nodeId, workDir, camerasConfigPath, clusterPath):
+    """
+    Runs pynvrd node with own directories and without servers, so several nodes can work on one machine
+    """
+    nodeDir = os.path.join(workDir, nodeId)
+
+    config.CLUSTER_PATH = clusterPath
+    config.CLUSTER_NODE_ID = nodeId
+    config.CAMERAS_CONFIG_PATH = camerasConfigPath
+    config.PATH_FOR_VIDEO = nodeDir
+    config.RECORDING_INDEX_PATH = os.path.join(nodeDir, "recordings.sqlite")
+    config.OCCUPANCY_PATH = os.path.join(nodeDir, "occupancy")
+    config.CONTROL_SOCKET_PATH = None
+    config.LIVE_SERVER_ADDRESS = None
+
+    import pynvrd
+    signal.signal(signal.SIGINT, pynvrd.signal_handler)
+    pynvrd.main()
+
+
+def printAssignments(clusterPath):
+    if not os.path.exists(clusterPath):
+        return
+
+    db = sqlite3.connect(clusterPath, timeout=30)
+    try:
+        rows = db.execute("SELECT camera, node_id FROM assignments ORDER BY camera").fetchall()
+    except sqlite3.Error:
+        rows = []
+    db.close()
+
+    print(", ".join("{} -> {}".format(camera, nodeId) for (camera, nodeId) in rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs several cluster nodes on this machine and kills one of them")
+    parser.add_argument("--source", default=config.cam, help="camera connection string or video file used by all cameras")
+    parser.add_argument("--nodes", default=3, type=int, help="count of nodes")
+    parser.add_argument("--cameras", default=6, type=int, help="count of cameras")
+    parser.add_argument("--fail-after", default=30, type=int, help="seconds before the first node is killed")
+    parser.add_argument("--seconds", default=60, type=int, help="test duration")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix="pynvr_cluster_")
+    clusterPath = os.path.join(workDir, "cluster.sqlite")
+    camerasConfigPath = os.path.join(workDir, "cameras.json")
+
+    cameras = [{"name": "cam{}".format(i), "connection": args.source} for i in range(args.cameras)]
+    with open(camerasConfigPath, "w") as f:
+        json.dump({"cameras": cameras}, f, indent=4)
+
+    print("working directory: {}".format(workDir))
+
+    nodes = []
+    for i in range(args.nodes):
+        process = multiprocessing.Process(target=runNode, args=("node{}".format(i), workDir, camerasConfigPath, clusterPath))
+        process.start()
+        nodes.append(process)
+
+    started = time.time()
+    failed = False
+    while time.time() - started < args.seconds:
+        time.sleep(config.CLUSTER_HEARTBEAT_INTERVAL_SECONDS)
+        printAssignments(clusterPath)
+
+        # node disappears without leaving cluster, its cameras are taken over after node timeout
+        if (not failed) and (time.time() - started >= args.fail_after):
+            print("killing node0")
+            os.kill(nodes[0].pid, signal.SIGKILL)
+            failed = True
+
+    for process in nodes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGINT)
+
+    for process in nodes:
+        process.join()
+
+    return 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
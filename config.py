@@ -11,6 +11,16 @@ APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 # cam = "rtsp://login:password@ip:port/stream_url" #connection to camera via RTSP with credentials
 cam = 0  # use local camera
 
+# camera name, stored in recordings metadata
+CAMERA_NAME = "cam0"
+
+# JSON file with settings of cameras, changes in it are applied without restart. When None, single
+# camera from cam and CAMERA_NAME is used
+CAMERAS_CONFIG_PATH = None
+
+# interval in seconds between checks for changes in cameras settings file
+CAMERAS_CONFIG_CHECK_INTERVAL_SECONDS = 5
+
 #####################
 #   logs settings   #
 #####################
@@ -38,13 +48,285 @@ LOG_TO_CONSOLE = True
 INITIAL_WAIT_INTERVAL_BEFORE_MOTION_DETECTION_SECS = 5
 MINIMAL_MOTION_DURATION = 10
 
+# seconds of video which will be recorded after motion-event ends
+POST_ROLL_SECONDS = 0
+
+# output file stays open for this count of seconds after recording ended, new motion in this interval
+# will be recorded to the same file (0 - disabled), for example 30
+MERGE_WINDOW_SECONDS = 0
+
+# max duration of single output file in seconds, longer recordings are split into several files (0 - unlimited),
+# for example 15 * 60
+MAX_CLIP_DURATION_SECONDS = 0
+
+# directory where detector state of each camera (reference frame and noise floor) is saved, after restart
+# detection starts at once when scene matches saved state instead of waiting for initial interval (None - disabled),
+# for example "./detector_state"
+DETECTOR_STATE_PATH = None
+
+# interval in seconds between saves of detector state
+DETECTOR_STATE_SAVE_INTERVAL_SECONDS = 60
+
+# count of consecutive frames which must match saved reference frame before detection is started
+WARM_START_CONFIRM_FRAMES = 3
+
+# max mean difference (0 - 255) between frame and saved reference frame above camera noise floor, when scene
+# is considered unchanged
+WARM_START_MAX_DIFFERENCE = 8
+
 ##########################
 #   recording settings   #
 ##########################
 PRE_ALARM_RECORDING_SECONDS = 5
+
+# storage for pre-alarm frames: "memory" - keep frames in RAM, "mmap" - keep frames in fixed-size ring file
+# mapped to memory (use it for long pre-alarm windows at high resolution)
+PRE_ALARM_BUFFER_BACKEND = "memory"
+
+# directory for ring files of "mmap" pre-alarm buffer, should be local SSD or tmpfs (None - system temp directory)
+PRE_ALARM_SPILL_DIRECTORY = None
+
+# max bytes of memory used by each camera for pre-alarm buffer, detector frames and writer queue (0 - unlimited).
+# Pre-alarm frames which don't fit into budget are compressed to JPEG, when compressed frames still don't fit
+# pre-alarm window is shortened. Live frames are dropped when writer queue doesn't fit into budget
+CAMERA_MEMORY_BUDGET_BYTES = 0
+
+# JPEG quality of compressed pre-alarm frames (0 - 100)
+PRE_ALARM_JPEG_QUALITY = 90
+
 PATH_FOR_VIDEO = "./video"
 subFolderNameGeneratorFunc = None
 
+# directory on fast local disk where clips are recorded, finished clips are moved to archive roots
+# in background (None - clips are recorded directly to PATH_FOR_VIDEO)
+PATH_FOR_STAGING = None
+
+# archive roots for finished clips, root with max free space is used (empty - PATH_FOR_VIDEO)
+ARCHIVE_ROOTS = []
+
+# max bytes per second for moving clips between devices (0 - unlimited)
+MOVER_BANDWIDTH_LIMIT = 0
+
+# how many times moving of clip is retried and interval between retries
+MOVER_MAX_RETRIES = 5
+MOVER_RETRY_INTERVAL_SECONDS = 10
+
+# interval of logging queue depth and throughput of mover and post-processor (0 - disabled)
+ARCHIVE_STATS_LOG_INTERVAL_SECONDS = 300
+
+# save per-frame motion scores of each clip to .timeline.npy file next to it
+WRITE_MOTION_TIMELINE = True
+
+# size of motion heatmap grid saved to .heatmap.npy file next to clip (0 - heatmap disabled)
+MOTION_HEATMAP_GRID_SIZE = 8
+
+# SQLite index of recorded clips and motion-events (None - disabled), can be rebuilt using rebuild_index.py
+RECORDING_INDEX_PATH = "./video/recordings.sqlite"
+
+# directory for per-second spatial motion occupancy files used by search_motion.py (None - disabled)
+OCCUPANCY_PATH = "./video/occupancy"
+
+# min average value (0 - 255) of motion mask in occupancy grid cell to mark the cell as occupied
+OCCUPANCY_CELL_THRESHOLD = 25
+
+# max seconds collected occupancy records are kept in memory before they are written to file
+OCCUPANCY_FLUSH_INTERVAL_SECONDS = 10
+
+# recording mode: "motion" - record only motion-events, "continuous" - record all video into fixed-length
+# segments and mark motion in segments metadata
+RECORDING_MODE = "motion"
+
+# duration of segment in continuous recording mode
+SEGMENT_DURATION_SECONDS = 60
+
+##########################
+#   retention settings   #
+##########################
+# how many days recordings with motion are kept (0 - forever)
+MOTION_CLIPS_RETENTION_DAYS = 0
+
+# how many days recordings without motion (continuous recording mode) are kept (0 - forever)
+QUIET_CLIPS_RETENTION_DAYS = 0
+
+# default max size in bytes of each camera recordings (0 - unlimited)
+RETENTION_MAX_BYTES_PER_CAMERA = 0
+
+# default max age in days of each camera recordings (0 - unlimited)
+RETENTION_MAX_DAYS_PER_CAMERA = 0
+
+# quotas for specific cameras: camera name -> (max bytes, max days), for example {"cam0": (100 * 1024 ** 3, 30)}
+RETENTION_CAMERA_QUOTAS = {}
+
+# oldest recordings are removed when free space of archive root is less than this value (0 - disabled)
+RETENTION_MIN_FREE_BYTES = 0
+
+# pause between removals, so deletes don't stall active writers
+RETENTION_DELETE_INTERVAL_SECONDS = 0.1
+
+# large files are truncated by this step before removal (0 - remove at once)
+RETENTION_TRUNCATE_STEP_BYTES = 64 * 1024 * 1024
+
+############################
+#   control API settings   #
+############################
+# path to Unix socket of control API (None - disabled)
+CONTROL_SOCKET_PATH = "./pynvr.sock"
+
+# directory where results of profile and allocations commands are saved
+PROFILES_PATH = "./profiles"
+
+#########################
+#   watchdog settings   #
+#########################
+# recorder which doesn't make progress for this count of seconds is restarted (when it's blocked, for example
+# reading from camera hangs) or its connection to camera is reopened (when frames aren't received), 0 - disabled
+WATCHDOG_STALL_SECONDS = 30
+
+# interval in seconds between checks of recorders
+WATCHDOG_CHECK_INTERVAL_SECONDS = 5
+
+# reopens of connection to camera without frames before recorder is restarted, 0 - recorder isn't restarted
+WATCHDOG_MAX_REOPENS = 3
+
+# interval between recovery actions is doubled while camera doesn't recover, up to this count of seconds
+WATCHDOG_MAX_BACKOFF_SECONDS = 600
+
+##########################
+#   live view settings   #
+##########################
+# address of HTTP server with live snapshots and MJPEG streams (None - disabled)
+LIVE_SERVER_ADDRESS = ("127.0.0.1", 8090)
+
+# latest frame is encoded to JPEG at most once per this interval
+LIVE_JPEG_INTERVAL_SECONDS = 0.2
+
+# JPEG quality of live frames (0 - 100)
+LIVE_JPEG_QUALITY = 80
+
+# clients which can't receive frame during this time are dropped
+LIVE_CLIENT_TIMEOUT_SECONDS = 2.0
+
+#########################
+#   snapshot settings   #
+#########################
+# count of JPEG snapshots of each motion-event: onset, peak and frames spread over the event (0 - disabled)
+SNAPSHOTS_QTY = 0
+
+# JPEG quality of snapshots (0 - 100)
+SNAPSHOT_JPEG_QUALITY = 90
+
+# count of threads which encode snapshots
+SNAPSHOT_ENCODER_THREADS = 2
+
+# max count of snapshots waiting for encoder, snapshots are dropped when queue is full
+SNAPSHOT_QUEUE_SIZE = 8
+
+################################
+#   post-processing settings   #
+################################
+# post-process finished clips in background: transcoding, thumbnails and contact sheet of motion peaks
+POST_PROCESSING_ENABLED = False
+
+# count of worker processes
+POST_PROCESSING_PROCESSES = 1
+
+# niceness of worker processes (0 - 19)
+POST_PROCESSING_NICENESS = 19
+
+# new clips are not processed while load average per CPU is above this value (0 - no limit)
+POST_PROCESSING_MAX_LOAD_PER_CPU = 0.7
+
+# ffmpeg executable for transcoding to denser codec (None - transcoding disabled)
+POST_PROCESSING_FFMPEG = "ffmpeg"
+
+# ffmpeg arguments of output file, container of transcoded clip is chosen by video codec (".mp4" for H.264/H.265,
+# ".webm" for VP8/VP9, other codecs keep OUTPUT_FILES_EXTENSION)
+POST_PROCESSING_FFMPEG_ARGS = ["-threads", "1", "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-bf", "0", "-an"]
+
+# max seconds of post-processing of one clip, when worker doesn't return result in time (it was killed or hung)
+# original clip is passed to next listeners
+POST_PROCESSING_TIMEOUT_SECONDS = 3600
+
+# ffmpeg arguments of exported file when exported clips have different codecs (only part of them was transcoded),
+# such export can't be made with stream copy and is re-encoded
+EXPORT_REENCODE_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-an"]
+
+# count of motion peaks in contact sheet (0 - thumbnails disabled)
+POST_PROCESSING_PEAKS_QTY = 6
+
+# width of thumbnails
+POST_PROCESSING_THUMBNAIL_WIDTH = 320
+
+# count of columns in contact sheet
+POST_PROCESSING_CONTACT_SHEET_COLUMNS = 3
+
+########################
+#   cluster settings   #
+########################
+# SQLite file shared by nodes which run cameras from the same cameras settings file, cameras are balanced
+# across nodes by measured load (None - all cameras are run by this node)
+CLUSTER_PATH = None
+
+# unique id of node (None - host name and process id)
+CLUSTER_NODE_ID = None
+
+# interval in seconds between heartbeats of node
+CLUSTER_HEARTBEAT_INTERVAL_SECONDS = 2
+
+# node without heartbeat for this count of seconds is considered failed, its cameras are taken over
+CLUSTER_NODE_TIMEOUT_SECONDS = 10
+
+# camera is moved when difference of loads of nodes (share of node CPUs) is above this value
+CLUSTER_REBALANCE_THRESHOLD = 0.25
+
+# min interval in seconds between moves of cameras
+CLUSTER_REBALANCE_INTERVAL_SECONDS = 60
+
+###########################
+#   scheduling settings   #
+###########################
+# threads of OpenCV pool (None - CPUs / cameras, 0 - OpenCV default)
+OPENCV_THREADS = None
+
+# FFmpeg decoder threads of each camera (None - CPUs / cameras, 0 - FFmpeg default)
+DECODER_THREADS = None
+
+# pin camera threads to sets of CPUs assigned from count of cameras and their frame sizes
+CPU_AFFINITY_ENABLED = False
+
+# CPUs which are assigned to cameras (None - all CPUs available for process)
+CPU_AFFINITY_CPUS = None
+
+##############################
+#   load shedding settings   #
+##############################
+# step quality down when camera loop can't keep up with frame rate or host CPU is overloaded
+LOAD_SHEDDING_ENABLED = False
+
+# quality is stepped down when processing time of frame relative to frame interval is above this value
+LOAD_SHEDDING_MAX_BUSY_RATIO = 0.8
+
+# quality is restored when processing time of frame relative to frame interval is below this value
+LOAD_SHEDDING_RESTORE_BUSY_RATIO = 0.5
+
+# quality is stepped down while load average per CPU is above this value (0 - host load isn't checked)
+LOAD_SHEDDING_MAX_LOAD_PER_CPU = 1.5
+
+# min interval in seconds between level changes
+LOAD_SHEDDING_HOLD_SECONDS = 10
+
+# max level: 1 - detection stride, 2 - detection proxy resolution, 3 - no overlays, 4 - pre-alarm decimation
+LOAD_SHEDDING_MAX_LEVEL = 4
+
+# motion is detected in every N-th frame
+LOAD_SHEDDING_DETECTION_STRIDE = 2
+
+# scale of frames passed to motion detector
+LOAD_SHEDDING_DETECTION_PROXY_SCALE = 0.5
+
+# only every N-th frame is kept in pre-alarm buffer
+LOAD_SHEDDING_PRE_ALARM_DECIMATION = 2
+
 ############################################
 #   quality and codec settings for video   #
 ############################################
@@ -57,6 +339,12 @@ FOURCC_CODEC = "DIVX"
 OUTPUT_FILES_EXTENSION = ".avi"
 OUTPUT_FRAME_RATE = 20
 
+# prepare next output file (directory and video writer) in background thread, so recording starts without delay
+PREPARE_WRITER_IN_BACKGROUND = True
+
+# max count of frames waiting for background video writer, frames are dropped when queue is full (0 - unlimited)
+WRITER_QUEUE_SIZE = 64
+
 # loading machine specific configuration
 if os.path.exists(os.path.join(APP_ROOT, "machine_specific_configuration.py")):
     from machine_specific_configuration import *  # noqa
@@ -0,0 +1,40 @@
+from system.log_support import init_logger
+import argparse
+import datetime as dts
+import config
+from system.shared import makeAbsoluteAppPath
+from system.recording_index import RecordingIndex
+from system.clip_export import ClipExporter
+
+
+def parseDts(value):
+    return dts.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports time range of camera recordings into single file")
+    parser.add_argument("--camera", default=config.CAMERA_NAME, help="camera name")
+    parser.add_argument("--start", required=True, type=parseDts, help="range start (UTC), for example 2017-04-02T14:02:10")
+    parser.add_argument("--end", required=True, type=parseDts, help="range end (UTC)")
+    parser.add_argument("--output", required=True, help="output file name")
+    parser.add_argument("--ffmpeg", default="ffmpeg", help="ffmpeg executable")
+    parser.add_argument("--ffprobe", default="ffprobe", help="ffprobe executable, used to check codecs of clips")
+    args = parser.parse_args()
+
+    logger = init_logger()
+
+    if config.RECORDING_INDEX_PATH is None:
+        logger.error("recording index is disabled")
+        return -1
+
+    index = RecordingIndex(makeAbsoluteAppPath(config.RECORDING_INDEX_PATH))
+    exporter = ClipExporter(logger, index, args.ffmpeg, args.ffprobe)
+    ok = exporter.export(args.camera, args.start, args.end, args.output)
+    index.close()
+
+    return 0 if ok else -1
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
@@ -0,0 +1,111 @@
+from system.log_support import init_logger
+import argparse
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import config
+from nvr_classes.motion_driven_recorder import MotionDrivenRecorder
+
+
+def cameraUrl(args, index):
+    return "fake://synthetic?width={}&height={}&fps={}&motion={}&seed={}".format(
+        args.width, args.height, args.fps, args.motion, index
+    )
+
+
+def droppedFrames(recorder):
+    """
+    Frames dropped by camera (recorder didn't read them in time) and by video writer
+    """
+    cameraDropped = recorder.cap.droppedFrames if recorder.cap is not None else 0
+    return cameraDropped + recorder.getStats()["writerDroppedFrames"]
+
+
+def runStep(logger, args, camerasQty, outputDirectory):
+    """
+    Runs cameras for one step of ramp
+
+    :return: tuple of (expected frames, dropped frames) for measured interval
+    """
+    recorders = []
+    threads = []
+    for i in range(camerasQty):
+        recorder = MotionDrivenRecorder(cameraUrl(args, i), logger)
+        recorder.cameraName = "cam{}".format(i)
+        recorder.outputDirectory = outputDirectory
+        recorder.preAlarmRecordingSecondsQty = config.PRE_ALARM_RECORDING_SECONDS
+        recorders.append(recorder)
+
+        thread = threading.Thread(target=recorder.start)
+        thread.start()
+        threads.append(thread)
+
+    # drops during connection and detector warm-up aren't counted
+    time.sleep(args.warmup)
+    droppedBefore = sum(droppedFrames(recorder) for recorder in recorders)
+
+    time.sleep(args.seconds)
+    dropped = sum(droppedFrames(recorder) for recorder in recorders) - droppedBefore
+
+    for recorder in recorders:
+        recorder.add_stop_request()
+
+    for thread in threads:
+        thread.join()
+
+    return (int(camerasQty * args.fps * args.seconds), dropped)
+
+
+def rampSteps(maxCameras):
+    qty = 1
+    while qty < maxCameras:
+        yield qty
+        qty *= 2
+
+    yield maxCameras
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramps up count of fake cameras and finds point where frame drops begin")
+    parser.add_argument("--max-cameras", default=64, type=int, help="max count of cameras")
+    parser.add_argument("--width", default=1280, type=int, help="frame width")
+    parser.add_argument("--height", default=720, type=int, help="frame height")
+    parser.add_argument("--fps", default=15, type=float, help="frame rate of each camera")
+    parser.add_argument("--motion", default=0.2, type=float, help="share of time with motion")
+    parser.add_argument("--seconds", default=30, type=int, help="measured duration of each step")
+    parser.add_argument("--warmup", default=config.INITIAL_WAIT_INTERVAL_BEFORE_MOTION_DETECTION_SECS + 2, type=int, help="seconds before measuring")
+    parser.add_argument("--max-drop-rate", default=0.01, type=float, help="share of dropped frames when step is failed")
+    args = parser.parse_args()
+
+    logger = init_logger()
+
+    # recorders log every frame with motion, so only warnings are logged during test
+    logger.setLevel(logging.WARNING)
+
+    outputDirectory = tempfile.mkdtemp(prefix="pynvr_load_")
+    limit = None
+    try:
+        for camerasQty in rampSteps(args.max_cameras):
+            (expected, dropped) = runStep(logger, args, camerasQty, outputDirectory)
+            rate = float(dropped) / expected if expected > 0 else 0
+            print("{} cameras: {} of {} frames dropped ({:.2%})".format(camerasQty, dropped, expected, rate))
+
+            if rate > args.max_drop_rate:
+                limit = camerasQty
+                break
+    finally:
+        shutil.rmtree(outputDirectory, ignore_errors=True)
+
+    if limit is None:
+        print("no frame drops up to {} cameras".format(args.max_cameras))
+    else:
+        print("frame drops begin at {} cameras".format(limit))
+
+    return 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
@@ -180,7 +180,7 @@ class MotionDrivenRecorder(CameraConnectionSupport):
             frameWidth = np.size(current_frame, 1)
 
             if self.camFps is None:
-                self.camFps = self.cap.get(cv.CAP_PROP_FPS)
+                self.camFps = self.cameraFps()
                 self.logger.info("FPS = {}".format(self.camFps))
 
             ############################################
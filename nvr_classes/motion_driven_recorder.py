@@ -1,25 +1,73 @@
 import os
+import tempfile
 
 import time
 import cv2 as cv
-from system.motion_detection import MotionDetector
+from system.motion_detection import MotionDetector, DetectorStateSaver, loadDetectorState
 import imutils
 import datetime as dts
 import numpy as np
 from system.camera_support import CameraConnectionSupport
 import config
+from system.video_writer import VideoWriterPreparer, AsyncVideoWriter, openVideoWriter
+from system.clip_metadata import ClipMetadata
+from system.motion_timeline import MotionTimeline
+from system.prealarm_buffer import MemoryPreAlarmBuffer, MappedPreAlarmBuffer
+from system.snapshots import SnapshotEncoder, SnapshotBurst, snapshotFileName, pendingSnapshotFileName
+from system.cpu_scheduler import setThreadAffinity
+from system.profiling import CProfileSession, SamplingSession, AllocationsSession, PROFILING_MODE_CPROFILE, profileFileName
 from system.shared import mkdir_p
-import Queue
+import collections
+import threading
 import uuid
 
 
+# records only motion-events (with pre-alarm frames)
+RECORDING_MODE_MOTION = "motion"
+
+# records all frames into fixed-length segments, motion is only marked in segments metadata
+RECORDING_MODE_CONTINUOUS = "continuous"
+
+
 class QueueCommand:
     CMD_QUIT_THREAD = "quit"
-
-    def __init__(self, cmd):
+    CMD_GET_STATS = "stats"
+    CMD_SET_DETECTOR = "set_detector"
+    CMD_SET_ZONES = "set_zones"
+    CMD_FORCE_RECORDING = "force_recording"
+    CMD_TAKE_SNAPSHOT = "snapshot"
+    CMD_ROTATE = "rotate"
+    CMD_APPLY_CONFIG = "apply_config"
+    CMD_SET_AFFINITY = "set_affinity"
+    CMD_PROFILE = "profile"
+    CMD_TRACE_ALLOCATIONS = "allocations"
+    CMD_REOPEN = "reopen"
+
+    def __init__(self, cmd, args = None):
         self.cmd = cmd
+        self.args = args if args is not None else {}
         self.uid = str(uuid.uuid4())
 
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def complete(self, result = None, error = None):
+        """
+        Sets result of command, called from recorder thread
+        """
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        """
+        Waits for command completion
+        :return: True when command completed, otherwise False
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
 
 class MotionDrivenRecorder(CameraConnectionSupport):
     def __init__(self, camConnectionString, logger):
@@ -32,13 +80,68 @@ class MotionDrivenRecorder(CameraConnectionSupport):
 
         self.inMotionDetectedState = False
 
+        # CameraConfig applied to recorder
+        self.cameraConfig = None
+
+        # LoadSheddingGovernor, None - quality is never stepped down
+        self.loadGovernor = None
+
+        # smoothed processing time of frame relative to frame interval (1.0 - camera loop is fully busy)
+        self.busyRatio = None
+
+        # count of processed frames and total seconds spent in each stage of their processing
+        self.processedFrames = 0
+        self.stageSeconds = {"read": 0.0, "detect": 0.0, "record": 0.0}
+
+        # progress of stages for watchdog: time when main loop started, last iteration of main loop (it doesn't
+        # change while reading from camera hangs), last frame read from camera and last motion detection
+        self.startedTime = None
+        self.lastLoopTime = None
+        self.lastFrameTime = None
+        self.lastDetectionTime = None
+
+        # frames processed since motion was detected last time (see detection stride) and result of detection
+        self._framesSinceDetection = 0
+        self._lastDetectionResult = False
+        self._defaultDetectorThreshold = self.detector.threshold
+
+        self.cameraName = None
+
+        self.recordingMode = RECORDING_MODE_MOTION
+        self.segmentDurationSeconds = 60
+
         self._camConnectionDts = None
         self._canDetectMotion = False
         self.camFps = None
 
+        # directory where detector state is saved and restored from after restart (None - disabled)
+        self.detectorStatePath = None
+        self._detectorStateSaveTime = None
+        self._detectorStateSaver = None
+
         self.preAlarmRecordingSecondsQty = 0
 
-        self._savedFrames = []
+        # pre-alarm frames buffer, created when first frame received
+        self._preAlarmBuffer = None
+
+        # each N-th frame is kept in pre-alarm buffer (see load shedding)
+        self._preAlarmFramesCount = 0
+
+        # "memory" or "mmap", see PRE_ALARM_BUFFER_BACKEND
+        self.preAlarmBufferBackend = "memory"
+        self.preAlarmSpillDirectory = None
+
+        # frames of camera which weren't added to mapped pre-alarm buffer while writer used it, count of
+        # such frames since the last logged warning
+        self.preAlarmDroppedFrames = 0
+        self._preAlarmDropStreak = 0
+
+        # max bytes of memory used by pre-alarm buffer, detector and writer queue (0 - unlimited), see
+        # CAMERA_MEMORY_BUDGET_BYTES
+        self.memoryBudgetBytes = 0
+        self.preAlarmJpegQuality = 90
+        self._preAlarmCompressed = False
+        self._lastMemoryWarning = None
 
         self._isRecording = False
 
@@ -46,19 +149,106 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         self.outputDirectory = None
         self._output = None
 
+        # DTS when current output file was started
+        self._clipStartDts = None
+
+        # DTS until output file stays open after recording paused (merge window)
+        self._mergeUntilDts = None
+
+        # False until the first frame after start or resume of recording adds new segment to clip metadata,
+        # count of frames in output file when recording paused
+        self._clipSegmentStarted = False
+        self._segmentEndFrames = 0
+
         self.subFolderNameGeneratorFunc = None
         self._prevSubFolder = None
         self.scaleFrameTo = None
 
+        # background preparation of next output file
+        self._writerPreparer = None
+        if config.PREPARE_WRITER_IN_BACKGROUND:
+            self._writerPreparer = VideoWriterPreparer(logger)
+
+        # OccupancyRecorder for spatial motion search (None - disabled)
+        self.occupancyRecorder = None
+
+        # LiveFrameSource which receives every processed frame for live view (None - disabled)
+        self.liveSource = None
+
+        # count of JPEG snapshots of each motion-event: onset, peak and frames spread over the event (0 - disabled)
+        self.snapshotsQty = 0
+        self._snapshotEncoder = None
+        self._snapshotBurst = None
+
+        # functions which will be called (from writer thread) for each closed output file:
+        # listener(fileName, metadata)
+        self.clipListeners = []
+
+        # functions which will be called when frame size is initialized or changed:
+        # listener(cameraName, frameWidth, frameHeight)
+        self.frameSizeListeners = []
+
+        # seconds between motion trigger and moment when first frame was handed to encoder
+        self.lastTriggerLatency = None
+        self.maxTriggerLatency = None
 
-        self._messages_queue = Queue.Queue()
+        # True - recording forced on, False - forced off, None - recording driven by motion
+        self.forcedRecording = None
+
+        # snapshot commands which wait for next frame
+        self._snapshotRequests = []
+
+        # directory for snapshots requested by command while no clip is recorded (None - output directory)
+        self.snapshotsDirectory = None
+
+        # directory for profiling results (None - output directory)
+        self.profilesDirectory = None
+
+        # active profiling session and time when it's finished, None - not profiling
+        self._profilingSession = None
+        self._profilingDeadline = None
+
+        # commands are appended by other threads, deque operations are atomic
+        self._messages_queue = collections.deque()
 
         self._quit = False
 
     def add_stop_request(self):
         cmd = QueueCommand(QueueCommand.CMD_QUIT_THREAD)
         self.logger.info("adding quit command with uid = {}".format(cmd.uid))
-        self._messages_queue.put(cmd)
+        self._messages_queue.append(cmd)
+
+    def addCommand(self, cmd):
+        """
+        Adds command for recorder thread, result is available with cmd.wait()
+
+        :param cmd: QueueCommand
+        :return: None
+        """
+        self._messages_queue.append(cmd)
+
+    def _createPreAlarmBuffer(self, maxFramesQty, frameShape):
+        if self.preAlarmBufferBackend != "mmap":
+            return MemoryPreAlarmBuffer(maxFramesQty, jpegQuality=self.preAlarmJpegQuality)
+
+        spillDirectory = self.preAlarmSpillDirectory
+        if spillDirectory is None:
+            spillDirectory = tempfile.gettempdir()
+
+        # recorder which replaces abandoned one (for the same camera) must not share its ring file
+        fileName = os.path.join(
+            spillDirectory,
+            "pynvr_prealarm_{}_{}_{}.ring".format(self.cameraName, os.getpid(), uuid.uuid4().hex)
+        )
+        self.logger.info("using mapped pre-alarm buffer: {}".format(fileName))
+        return MappedPreAlarmBuffer(fileName, maxFramesQty, frameShape)
+
+    def _closePreAlarmBuffer(self):
+        if self._preAlarmBuffer is None:
+            return
+
+        self._preAlarmBuffer.close()
+        self._preAlarmBuffer = None
 
     def _addPreAlarmFrame(self, frame):
         if self.preAlarmRecordingSecondsQty == 0:
@@ -67,15 +257,95 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         if self.camFps is None:
             return
 
-        totalQty = int(self.preAlarmRecordingSecondsQty * self.camFps)
-        if len(self._savedFrames) < totalQty:
-            self._savedFrames.append(frame)
+        # with decimation only every N-th frame is buffered, each of them is written N times, so frames which
+        # are already buffered are kept when decimation changes
+        decimation = self._preAlarmDecimation()
+        self._preAlarmFramesCount += 1
+        if self._preAlarmFramesCount % decimation != 0:
             return
 
-        if len(self._savedFrames) > 0:
-            self._savedFrames.pop(0)
+        totalQty = max(1, int(self.preAlarmRecordingSecondsQty * self.camFps))
+
+        buffer = self._preAlarmBuffer
+        if buffer is not None:
+            resized = (buffer.maxFramesQty != totalQty)
+            reshaped = isinstance(buffer, MappedPreAlarmBuffer) and (buffer.frameShape != frame.shape)
+            if resized or reshaped:
+                self._closePreAlarmBuffer()
+
+        if self._preAlarmBuffer is None:
+            self._preAlarmBuffer = self._createPreAlarmBuffer(totalQty, frame.shape)
+
+        self._appendPreAlarmFrame(frame, decimation)
+
+    def _appendPreAlarmFrame(self, frame, repeat):
+        buffer = self._preAlarmBuffer
+
+        # mapped buffer is backed by file and has fixed size
+        if not isinstance(buffer, MemoryPreAlarmBuffer):
+            self._appendMappedPreAlarmFrame(buffer, frame, repeat)
+            return
+
+        buffer.maxBytes = self._preAlarmBudget()
+        buffer.append(frame, repeat)
+
+        if buffer.compressed != self._preAlarmCompressed:
+            self._preAlarmCompressed = buffer.compressed
+            if buffer.compressed:
+                self.logger.warning("pre-alarm frames don't fit into memory budget, frames are compressed")
+            else:
+                self.logger.info("pre-alarm frames fit into memory budget, frames aren't compressed")
+
+        if buffer.shrunk:
+            seconds = float(buffer.framesQty) / self.camFps
+            self._warnMemoryBudget("pre-alarm window is shortened to {:.1f} seconds to fit into memory budget".format(seconds))
+
+    def _appendMappedPreAlarmFrame(self, buffer, frame, repeat):
+        # ring isn't overwritten while writer still uses drained frames, so frame is dropped
+        droppedFrames = buffer.droppedFrames
+        buffer.append(frame, repeat)
+        if buffer.droppedFrames != droppedFrames:
+            self.preAlarmDroppedFrames += repeat
+            self._preAlarmDropStreak += repeat
+            return
 
-        self._savedFrames.append(frame)
+        if self._preAlarmDropStreak > 0:
+            self.logger.warning("{} pre-alarm frames were dropped while writer used ring buffer".format(self._preAlarmDropStreak))
+            self._preAlarmDropStreak = 0
+
+    def _preAlarmBudget(self):
+        """
+        Bytes of memory budget which are left for pre-alarm buffer (0 - unlimited)
+        """
+        if self.memoryBudgetBytes <= 0:
+            return 0
+
+        output = self._output
+        used = self.detector.memoryBytes() + (output.queuedBytes() if output is not None else 0)
+        return max(1, self.memoryBudgetBytes - used)
+
+    def _warnMemoryBudget(self, message):
+        # warnings are repeated each frame while budget is exceeded, so they are logged once a minute
+        now = time.time()
+        if (self._lastMemoryWarning is None) or (now - self._lastMemoryWarning >= 60):
+            self._lastMemoryWarning = now
+            self.logger.warning(message)
+
+    def getMemoryUsage(self):
+        """
+        Returns bytes of memory used by owners of frame buffers
+        :return: dictionary with sizes and total
+        """
+        buffer = self._preAlarmBuffer
+        output = self._output
+
+        usage = {
+            "preAlarm": buffer.bytesQty if buffer is not None else 0,
+            "detector": self.detector.memoryBytes(),
+            "writerQueue": output.queuedBytes() if output is not None else 0,
+        }
+        usage["total"] = sum(usage.values())
+        return usage
 
     def canDetectMotion(self):
         if self._canDetectMotion:
@@ -89,25 +359,227 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         if minDts > self.utcNow():
             return False
 
+        # warm start isn't needed anymore
+        self._canDetectMotion = True
+        self.detector.warmStart(None)
+        return True
+
+    def _confirmWarmStart(self, frame):
+        """
+        Starts detection before initial wait interval is over when scene matches saved detector state
+        :return: True when detection can be started
+        """
+        if (self._camConnectionDts is None) or (not self.detector.confirmScene(frame)):
+            return False
+
+        self.logger.info("scene matches saved detector state, motion detection started")
         self._canDetectMotion = True
         return True
 
+    def _detectorStateFileName(self):
+        if (self.detectorStatePath is None) or (self.cameraName is None):
+            return None
+
+        return os.path.join(self.detectorStatePath, "{}.detector.npz".format(self.cameraName))
+
+    def _loadDetectorState(self):
+        fileName = self._detectorStateFileName()
+        if (fileName is None) or (not os.path.exists(fileName)):
+            return
+
+        try:
+            state = loadDetectorState(fileName)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            self.logger.warning("can't load detector state {}: {}".format(fileName, e))
+            return
+
+        self.detector.warmStart(state, config.WARM_START_CONFIRM_FRAMES, config.WARM_START_MAX_DIFFERENCE)
+        self.logger.info("detector state loaded from {}".format(fileName))
+
+    def _saveDetectorState(self, force = False):
+        """
+        Saves detector state with configured interval, state is saved only when detection works and there is no
+        motion, so reference frame shows static scene
+        """
+        fileName = self._detectorStateFileName()
+        if (fileName is None) or (not self._canDetectMotion) or self.inMotionDetectedState:
+            return
+
+        now = time.time()
+        if (not force) and (self._detectorStateSaveTime is not None):
+            if now - self._detectorStateSaveTime < config.DETECTOR_STATE_SAVE_INTERVAL_SECONDS:
+                return
+
+        state = self.detector.getState()
+        if state is None:
+            return
+
+        self._detectorStateSaveTime = now
+
+        # file is written by saver thread
+        if self._detectorStateSaver is None:
+            self._detectorStateSaver = DetectorStateSaver(self.logger)
+            self._detectorStateSaver.start()
+
+        self._detectorStateSaver.save(fileName, state)
+
+    def _stopDetectorStateSaver(self):
+        if self._detectorStateSaver is None:
+            return
+
+        self._detectorStateSaver.stop()
+        self._detectorStateSaver.join()
+        self._detectorStateSaver = None
+
     def setError(self, errorText):
         self.logger.error(errorText)
         return CameraConnectionSupport.setError(self, errorText)
 
     def _writeOutFrame(self, frame):
         assert self._output is not None
-        self._output.write(frame)
+
+        # frames which don't fit into memory budget are dropped by writer
+        if self.memoryBudgetBytes > 0:
+            self._output.maxQueuedBytes = max(1, self.memoryBudgetBytes - self.detector.memoryBytes())
+
+        if (not self._output.write(frame)) and (self.memoryBudgetBytes > 0):
+            self._warnMemoryBudget("writer queue doesn't fit into memory budget or is full, frames are dropped")
 
     def _stopRecording(self):
         if self._output is None:
             return
 
-        self._output.release()
+        self._finishSnapshotBurst()
+
+        # file will be closed by writer thread when all queued frames are written
+        self._output.metadata.endDts = self.utcNow()
+        self._output.close()
         self._output = None
 
         self._isRecording = False
+        self._mergeUntilDts = None
+
+    def _pauseRecording(self, now):
+        """
+        Stops writing frames but keeps output file open for merge window, so next motion-event
+        will be added to the same file
+        :return: None
+        """
+        self._isRecording = False
+        self._mergeUntilDts = now + dts.timedelta(seconds=config.MERGE_WINDOW_SECONDS)
+
+        self._clipSegmentStarted = False
+        self._segmentEndFrames = self._output.framesQueued
+
+    def _resumeRecording(self):
+        self._isRecording = True
+        self._mergeUntilDts = None
+
+    def _rotateRecording(self):
+        """
+        Switches recording to new output file, previous file is closed by its writer thread
+        :return: True on success, otherwise False
+        """
+        self._finishSnapshotBurst()
+        prevOutput = self._output
+
+        self._output = None
+        self._isRecording = False
+        ret = self._startRecording()
+
+        prevOutput.metadata.endDts = self.utcNow()
+        prevOutput.close()
+        return ret
+
+    def _clipDurationExceeded(self, now):
+        if (config.MAX_CLIP_DURATION_SECONDS <= 0) or (self._clipStartDts is None):
+            return False
+
+        return (now - self._clipStartDts) >= dts.timedelta(seconds=config.MAX_CLIP_DURATION_SECONDS)
+
+    def _inPostRoll(self, now):
+        if self.detector.motionDetectionDts is None:
+            return False
+
+        seconds = config.MINIMAL_MOTION_DURATION + config.POST_ROLL_SECONDS
+        return (self.detector.motionDetectionDts + dts.timedelta(seconds=seconds)) > now
+
+    def _segmentBoundaryReached(self, now):
+        """
+        Checks that current segment must be finished. Segments are aligned to multiple of segment duration,
+        for example to minutes
+        """
+        if self._clipStartDts is None:
+            return False
+
+        epoch = dts.datetime(1970, 1, 1)
+        duration = max(1, int(self.segmentDurationSeconds))
+
+        startIndex = int((self._clipStartDts - epoch).total_seconds()) // duration
+        currentIndex = int((now - epoch).total_seconds()) // duration
+        return currentIndex != startIndex
+
+    def _updateSegmentedRecording(self, now):
+        """
+        Continuous recording: keeps recording all frames and rotates segments without dropping frames
+        :param now: current DTS
+        :return: None
+        """
+        if not self._isRecording:
+            self.logger.info("starting continuous recording...")
+            if self._startRecording():
+                self._flushPreRecordingFrames()
+            return
+
+        if self._segmentBoundaryReached(now):
+            self._rotateRecording()
+
+    def _recordMotion(self, now):
+        if self._isRecording:
+            if self._clipDurationExceeded(now):
+                self.logger.info("max clip duration reached, rotating output file...")
+                self._rotateRecording()
+            return
+
+        if self._output is not None:
+            self.logger.info("motion detected in merge window, continuing current file...")
+            self._resumeRecording()
+            self._flushPreRecordingFrames(clipStart=False)
+            return
+
+        self.logger.info("starting recording...")
+        if self._startRecording():
+            self._flushPreRecordingFrames()
+
+    def _updateRecordingState(self, motionDetected, now):
+        """
+        Starts, prolongates, pauses, rotates or stops recording according to motion state
+        :param motionDetected: True when motion detected (or prolongated by minimal motion duration)
+        :param now: current DTS
+        :return: None
+        """
+        if motionDetected:
+            self._recordMotion(now)
+            return
+
+        if self._isRecording:
+            if self._inPostRoll(now):
+                if self._clipDurationExceeded(now):
+                    self._rotateRecording()
+                return
+
+            if config.MERGE_WINDOW_SECONDS > 0:
+                self.logger.info("pausing recording...")
+                self._pauseRecording(now)
+                return
+
+            self.logger.info("stopping recording...")
+            self._stopRecording()
+            return
+
+        if (self._mergeUntilDts is not None) and (self._mergeUntilDts <= now):
+            self.logger.info("merge window expired, stopping recording...")
+            self._stopRecording()
 
     def _getSubFolderName(self, dts):
         if self.subFolderNameGeneratorFunc is None:
@@ -115,6 +587,106 @@ class MotionDrivenRecorder(CameraConnectionSupport):
 
         return self.subFolderNameGeneratorFunc(dts)
 
+    def _getOutputDirName(self, now):
+        subFolder = self._getSubFolderName(now)
+        if subFolder is None:
+            return self.outputDirectory
+
+        dirName = os.path.join(self.outputDirectory, subFolder)
+        return os.path.normpath(dirName)
+
+    def _updateFrameSize(self, frameWidth, frameHeight):
+        """
+        Sets resolution of frames, called for the first frame and when resolution of camera changes (for example,
+        after its connection was changed by config). Clip and pre-alarm frames of previous resolution are finished
+        first, recording continues in new clip.
+        """
+        if self.frameWidth is not None:
+            self.logger.warning("resolution changed from {}x{} to {}x{}".format(self.frameWidth, self.frameHeight, frameWidth, frameHeight))
+
+            if self._output is not None:
+                self._stopRecording()
+
+            self._closePreAlarmBuffer()
+            self._preAlarmFramesCount = 0
+            self.detector.reset()
+
+        self.frameWidth = frameWidth
+        self.frameHeight = frameHeight
+        self.nb_pixels = self.frameWidth * self.frameHeight
+
+        self.logger.info("self.width = {}".format(self.frameWidth))
+        self.logger.info("self.height = {}".format(self.frameHeight))
+
+        self.onFrameSizeUpdate(frameWidth, frameHeight)
+
+    def onFrameSizeUpdate(self, frameWidth, frameHeight):
+        for listener in self.frameSizeListeners:
+            listener(self.cameraName, frameWidth, frameHeight)
+
+        if (self._writerPreparer is None) or (self.outputDirectory is None):
+            return
+
+        self._writerPreparer.prepare(self._getOutputDirName(self.utcNow()), (frameWidth, frameHeight))
+
+    def _onFirstFrameWritten(self, latency):
+        self.lastTriggerLatency = latency
+        if (self.maxTriggerLatency is None) or (latency > self.maxTriggerLatency):
+            self.maxTriggerLatency = latency
+
+        self.logger.info("trigger to first frame latency: {:.3f} sec".format(latency))
+
+    def _finishClipSnapshots(self, fileName, metadata):
+        """
+        Renames snapshots of closed clip to their final names
+        :return: None
+        """
+        if (self._snapshotEncoder is None) or (metadata is None) or (len(metadata.snapshots) == 0):
+            return
+
+        self._snapshotEncoder.waitSaved(metadata.snapshots)
+
+        snapshots = []
+        for pendingName in metadata.snapshots:
+            snapshotName = snapshotFileName(fileName, len(snapshots))
+            try:
+                os.rename(pendingName, snapshotName)
+            except OSError as e:
+                self.logger.error("can't rename snapshot {}: {}".format(pendingName, e))
+                continue
+
+            snapshots.append(os.path.basename(snapshotName))
+
+        metadata.snapshots = snapshots
+        if not metadata.save(fileName):
+            self.logger.error("can't save metadata for file: {}".format(fileName))
+
+    def _onClipClosed(self, fileName, metadata):
+        self._finishClipSnapshots(fileName, metadata)
+
+        for listener in self.clipListeners:
+            try:
+                listener(fileName, metadata)
+            except Exception as e:
+                self.logger.error("clip listener failed for {}: {}".format(fileName, e))
+
+    def _openOutput(self, dirName, videoSize):
+        prepared = None
+        if self._writerPreparer is not None:
+            prepared = self._writerPreparer.take(dirName, videoSize)
+
+        if prepared is not None:
+            return prepared
+
+        if self._writerPreparer is not None:
+            self.logger.warning("prepared writer is not available, opening writer synchronously")
+
+        if (dirName != self._prevSubFolder) and (not os.path.exists(dirName)):
+            self.logger.info("adding new directory: {}".format(dirName))
+
+        self._prevSubFolder = dirName
+        return openVideoWriter(dirName, videoSize)
+
     def _startRecording(self):
         if self.outputDirectory is None:
             return self.setError("output directory is not specified")
@@ -122,53 +694,196 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         if None in [self.frameWidth, self.frameHeight]:
             return self.setError("resolution is't specified")
 
-        fourcc = cv.VideoWriter_fourcc(*config.FOURCC_CODEC)
+        triggerTime = time.time()
         videoSize = (self.frameWidth, self.frameHeight)
 
         # calculation output filename
         now = dts.datetime.utcnow()
         fileName = "video_{}{}".format(now.strftime("%Y%m%dT%H%M%S"), config.OUTPUT_FILES_EXTENSION)
 
-        subFolder = self._getSubFolderName(now)
-        if subFolder is not None:
-            needCreate = ((self._prevSubFolder is not None) or (subFolder != self._prevSubFolder))
+        dirName = self._getOutputDirName(now)
+        (pendingName, output) = self._openOutput(dirName, videoSize)
+        if output is None:
+            return self.setError("can't create sub-directory: {}".format(dirName))
 
-            dirName = os.path.join(self.outputDirectory, subFolder)
-            dirName = os.path.normpath(dirName)
+        fileName = os.path.join(dirName, fileName)
 
-            if (needCreate) and (not os.path.exists(dirName)):
-                self.logger.info("adding new directory: {}".format(dirName))
-                if not mkdir_p(dirName):
-                    return self.setError("can't create sub-directory: {}".format(dirName))
-
-            fileName = os.path.join(dirName, fileName)
-        else:
-            fileName = os.path.join(self.outputDirectory, fileName)
-
-        self._output = cv.VideoWriter(fileName, fourcc, config.OUTPUT_FRAME_RATE, videoSize)
+        self._output = AsyncVideoWriter(self.logger, output, pendingName, fileName, triggerTime, config.WRITER_QUEUE_SIZE)
+        self._output.onFirstFrameWritten = self._onFirstFrameWritten
+        self._output.metadata = ClipMetadata(self.cameraName, now)
+        self._output.onClosed = self._onClipClosed
+        if config.WRITE_MOTION_TIMELINE:
+            self._output.timeline = MotionTimeline(config.MOTION_HEATMAP_GRID_SIZE)
+        self._output.start()
 
+        self._clipStartDts = now
         self._isRecording = True
+
+        self._clipSegmentStarted = False
+        self._segmentEndFrames = 0
         return True
 
-    def _flushPreRecordingFrames(self):
+    def _flushPreRecordingFrames(self, clipStart = True):
         """
-        Writes pre-alarm frames to output file
+        Hands pre-alarm frames to writer thread, they will be written before live frames
+        :param clipStart: True when frames are written to the beginning of new clip
         :return:
         """
         assert self._output is not None
 
-        for frame in self._savedFrames:
-            self._output.write(frame)
+        if self._preAlarmBuffer is None:
+            return True
+
+        # frames may be views to mapped buffer, so buffer is released only when writer is done with them
+        frames = self._preAlarmBuffer.drain()
+
+        if not self._output.writeMany(frames, self._preAlarmBuffer.release):
+            self.logger.warning("writer queue is full, {} pre-alarm frames are dropped".format(len(frames)))
+            return False
+
+        # clip begins with pre-alarm frames, so its start is moved back
+        if clipStart and (len(frames) > 0) and self.camFps:
+            self._shiftClipStart(dts.timedelta(seconds=float(len(frames)) / self.camFps))
 
-        self._savedFrames = []
         return True
 
+    def _shiftClipStart(self, delta):
+        self._output.metadata.startDts -= delta
+
+    def getStats(self):
+        """
+        Returns recorder statistics
+        :return: dictionary with statistics
+        """
+        stats = {
+            "camera": self.cameraName,
+            "isRecording": self._isRecording,
+            "forcedRecording": self.forcedRecording,
+            "detectorThreshold": self.detector.threshold,
+            "lastTriggerLatency": self.lastTriggerLatency,
+            "maxTriggerLatency": self.maxTriggerLatency,
+            "busyRatio": self.busyRatio,
+            "processedFrames": self.processedFrames,
+            "stageSeconds": dict(self.stageSeconds),
+            "writerQueueSize": 0,
+            "writerDroppedFrames": 0,
+        }
+
+        output = self._output
+        if output is not None:
+            stats["writerQueueSize"] = output.queueSize()
+            stats["writerDroppedFrames"] = output.droppedFrames
+
+        if self.loadGovernor is not None:
+            stats["loadShedding"] = self.loadGovernor.getStats()
+
+        stats["memory"] = self.getMemoryUsage()
+        stats["memoryBudget"] = self.memoryBudgetBytes
+        stats["preAlarmCompressed"] = self._preAlarmCompressed
+        stats["preAlarmDroppedFrames"] = self.preAlarmDroppedFrames
+
+        return stats
+
+    def _updateClipSegment(self, now):
+        """
+        Adds frame which will be written now to clip segments, so wall-clock time can be mapped to position
+        in video of merged clip
+        :return: position of frame in video (seconds)
+        """
+        output = self._output
+        videoOffset = float(output.framesQueued) / config.OUTPUT_FRAME_RATE
+
+        if not self._clipSegmentStarted:
+            # frames written since previous segment are pre-alarm frames which precede this frame
+            preAlarmFrames = output.framesQueued - self._segmentEndFrames
+            preAlarmSeconds = float(preAlarmFrames) / self.camFps if self.camFps else 0.0
+
+            output.metadata.addSegment(
+                now - dts.timedelta(seconds=preAlarmSeconds),
+                float(self._segmentEndFrames) / config.OUTPUT_FRAME_RATE
+            )
+            self._clipSegmentStarted = True
+
+        output.metadata.extendSegment(now, videoOffset)
+        return videoOffset
+
+    def _updateClipMetadata(self, motionInFrame, now):
+        # frames aren't written while recording paused in merge window
+        if not self._isRecording:
+            return
+
+        metadata = self._output.metadata
+        videoOffset = self._updateClipSegment(now)
+
+        score = self.detector.lastScore
+        if score is not None:
+            metadata.addScore(score)
+
+            if self._output.timeline is not None:
+                self._output.timeline.add(videoOffset, score, self.detector.lastMotionMask)
+
+        if motionInFrame:
+            metadata.addMotion(now, score)
+
+    def _saveSnapshot(self, frame):
+        """
+        Hands frame to encoder as snapshot of current clip, frame must not be changed after it
+        :return: pending name of snapshot or None when it was dropped
+        """
+        pendingName = pendingSnapshotFileName(self._output.fileName)
+        if not self._snapshotEncoder.submit(pendingName, frame):
+            return None
+
+        self._output.metadata.snapshots.append(pendingName)
+        return pendingName
+
+    def _finishSnapshotBurst(self):
+        if self._snapshotBurst is None:
+            return
+
+        if self._output is not None:
+            for frame in self._snapshotBurst.frames():
+                self._saveSnapshot(frame)
+
+        self._snapshotBurst = None
+
+    def _updateSnapshots(self, frame, motionInFrame, motionDetected):
+        """
+        Hands snapshots of motion-event to encoder: onset frame at once, peak and spread frames when event ends
+        :return: True when frame is kept for snapshot (it must not be changed)
+        """
+        if (self._snapshotEncoder is None) or (self._output is None):
+            return False
+
+        if not motionInFrame:
+            if not motionDetected:
+                self._finishSnapshotBurst()
+            return False
+
+        if self._snapshotBurst is None:
+            self._snapshotBurst = SnapshotBurst(self.snapshotsQty - 1)
+            self._saveSnapshot(frame)
+            return True
+
+        return self._snapshotBurst.add(frame, self.detector.lastScore)
+
     def _detect_motion(self, current_frame, instant):
+        self.detector.lastScore = None
+        self.detector.lastMotionMask = None
+
         # detection motion if can do it now
-        if not self.canDetectMotion():
+        if (not self.canDetectMotion()) and (not self._confirmWarmStart(current_frame)):
             return False
 
-        if not self.detector.motionDetected(current_frame):
+        # with detection stride frames between detections get result of the last detection
+        self._framesSinceDetection += 1
+        if self._framesSinceDetection < self._detectionStride():
+            return self._lastDetectionResult
+
+        self._framesSinceDetection = 0
+        self._lastDetectionResult = self.detector.motionDetected(current_frame)
+        self.lastDetectionTime = time.time()
+        if not self._lastDetectionResult:
             return False
 
         self.trigger_time = instant  # Update the trigger_time
@@ -179,19 +894,339 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         self.inMotionDetectedState = True
         return True
 
+    def _detectionStride(self):
+        return self.loadGovernor.detectionStride() if self.loadGovernor is not None else 1
+
+    def _overlaysEnabled(self):
+        return self.loadGovernor.drawOverlays() if self.loadGovernor is not None else True
+
+    def _preAlarmDecimation(self):
+        return self.loadGovernor.preAlarmDecimation() if self.loadGovernor is not None else 1
+
+    def _addStageTimes(self, readStarted, readFinished, detectionFinished, processingFinished):
+        """
+        Accumulates time spent in stages of frame processing: reading from camera (including waiting for
+        frame), motion detection and the rest of processing (recording, snapshots, live view)
+        """
+        self.processedFrames += 1
+        self.stageSeconds["read"] += readFinished - readStarted
+        self.stageSeconds["detect"] += detectionFinished - readFinished
+        self.stageSeconds["record"] += processingFinished - detectionFinished
+
+    def abandonRecording(self):
+        """
+        Closes clip of recorder which is blocked (for example reading from camera hangs), so recorded frames are
+        saved and writer thread finishes. Called from other thread when recorder is abandoned
+        :return: None
+        """
+        output = self._output
+        if output is None:
+            return
+
+        self._output = None
+        self._isRecording = False
+
+        output.metadata.endDts = self.utcNow()
+        output.close()
+
+    def getHealth(self):
+        """
+        Returns progress of recorder stages for watchdog, times are Unix timestamps (None - not happened yet)
+        :return: dictionary
+        """
+        output = self._output
+
+        # writer progress is measured from the moment it was started when nothing is written yet
+        lastWriteTime = None
+        if output is not None:
+            lastWriteTime = output.lastWriteTime if output.lastWriteTime is not None else output.triggerTime
+
+        return {
+            "startedTime": self.startedTime,
+            "lastLoopTime": self.lastLoopTime,
+            "lastFrameTime": self.lastFrameTime,
+            "lastDetectionTime": self.lastDetectionTime,
+            "lastWriteTime": lastWriteTime,
+            "writerQueueSize": output.queueSize() if output is not None else 0,
+            "processedFrames": self.processedFrames,
+        }
+
+    def _updateLoadStats(self, busySeconds):
+        """
+        Updates smoothed busy ratio, passes processing time of frame to load governor and applies new load
+        shedding level when it's changed
+        :param busySeconds: time spent for processing of frame (without waiting for camera)
+        :return: None
+        """
+        if not self.camFps:
+            return
+
+        ratio = busySeconds * self.camFps
+        if self.busyRatio is None:
+            self.busyRatio = ratio
+        else:
+            self.busyRatio += 0.05 * (ratio - self.busyRatio)
+
+        if self.loadGovernor is None:
+            return
+
+        if self.loadGovernor.update(busySeconds, 1.0 / self.camFps, time.time()):
+            self.detector.proxyScale = self.loadGovernor.detectionProxyScale()
+
     def _process_queue_commands(self):
-        if self._messages_queue.empty():
+        # checking of empty deque doesn't take any lock
+        if not self._messages_queue:
+            return
+
+        handlers = {
+            QueueCommand.CMD_QUIT_THREAD: self._onQuitCommand,
+            QueueCommand.CMD_GET_STATS: self._onStatsCommand,
+            QueueCommand.CMD_SET_DETECTOR: self._onSetDetectorCommand,
+            QueueCommand.CMD_SET_ZONES: self._onSetZonesCommand,
+            QueueCommand.CMD_FORCE_RECORDING: self._onForceRecordingCommand,
+            QueueCommand.CMD_TAKE_SNAPSHOT: self._snapshotRequests.append,
+            QueueCommand.CMD_ROTATE: self._onRotateCommand,
+            QueueCommand.CMD_APPLY_CONFIG: self._onApplyConfigCommand,
+            QueueCommand.CMD_SET_AFFINITY: self._onSetAffinityCommand,
+            QueueCommand.CMD_PROFILE: self._onProfileCommand,
+            QueueCommand.CMD_TRACE_ALLOCATIONS: self._onTraceAllocationsCommand,
+            QueueCommand.CMD_REOPEN: self._onReopenCommand,
+        }
+
+        # all available commands are processed at once
+        while self._messages_queue:
+            cmd = self._messages_queue.popleft()
+            self.logger.info("got new command - {} [{}]".format(cmd.cmd, cmd.uid))
+
+            handler = handlers.get(cmd.cmd)
+            if handler is None:
+                self.logger.error("unknown command: {} [{}]".format(cmd.cmd, cmd.uid))
+                raise Exception("Unknown command")
+
+            handler(cmd)
+
+    def _onQuitCommand(self, cmd):
+        self._quit = True
+        cmd.complete()
+
+    def _onStatsCommand(self, cmd):
+        cmd.complete(self.getStats())
+
+    def _onSetDetectorCommand(self, cmd):
+        self.detector.threshold = cmd.args["threshold"]
+        cmd.complete({"threshold": self.detector.threshold})
+
+    def _onSetZonesCommand(self, cmd):
+        self.detector.zones = cmd.args["zones"]
+        cmd.complete({"zones": self.detector.zones})
+
+    def _onForceRecordingCommand(self, cmd):
+        self.forcedRecording = {"on": True, "off": False, "auto": None}[cmd.args["mode"]]
+        cmd.complete({"mode": cmd.args["mode"]})
+
+    def _onRotateCommand(self, cmd):
+        if not self._isRecording:
+            cmd.complete(error="not recording now")
+            return
+
+        self.logger.info("rotating output file by command...")
+        self._rotateRecording()
+        cmd.complete({"fileName": self._output.fileName if self._output is not None else None})
+
+    def _onApplyConfigCommand(self, cmd):
+        self.applyCameraConfig(cmd.args["config"])
+        cmd.complete()
+
+    def _onSetAffinityCommand(self, cmd):
+        # affinity is set for recorder thread, threads started by it later inherit it
+        cpus = cmd.args["cpus"]
+        if not setThreadAffinity(cpus):
+            self.logger.warning("can't pin recorder thread to CPUs {}".format(cpus))
+            cmd.complete(error="can't set CPU affinity")
+            return
+
+        self.logger.info("recorder thread pinned to CPUs {}".format(cpus))
+        cmd.complete()
+
+    def _onReopenCommand(self, cmd):
+        # camera is reconnected in main loop
+        if self.cap is not None:
+            self.logger.warning("reopening connection to camera by command...")
+            self.cap.release()
+            self.cap = None
+
+        cmd.complete()
+
+    def _onProfileCommand(self, cmd):
+        # profiler is started from recorder thread, so only this camera is profiled
+        if cmd.args["mode"] == PROFILING_MODE_CPROFILE:
+            sessionClass = CProfileSession
+        else:
+            sessionClass = SamplingSession
+
+        self._startProfiling(cmd, sessionClass(self._profileFileName(sessionClass.suffix)))
+
+    def _onTraceAllocationsCommand(self, cmd):
+        session = AllocationsSession(self._profileFileName(AllocationsSession.suffix), cmd.args["top"])
+        self._startProfiling(cmd, session)
+
+    def _profileFileName(self, suffix):
+        directory = self.profilesDirectory if self.profilesDirectory is not None else self.outputDirectory
+        return profileFileName(directory, self.cameraName, suffix)
+
+    def _startProfiling(self, cmd, session):
+        """
+        Starts profiling session which is finished by recorder thread after requested count of seconds,
+        command is completed with name of result file at once
+        """
+        if self._profilingSession is not None:
+            cmd.complete(error="profiling is already running")
             return
 
-        cmd = self._messages_queue.get()
-        self.logger.info("got new command - {} [{}]".format(cmd.cmd, cmd.uid))
+        try:
+            dirName = os.path.dirname(session.fileName)
+            if not os.path.exists(dirName):
+                os.makedirs(dirName)
+
+            session.start()
+        except (OSError, RuntimeError) as e:
+            self.logger.error("can't start profiling: {}".format(e))
+            cmd.complete(error="can't start profiling: {}".format(e))
+            return
+
+        self._profilingSession = session
+        self._profilingDeadline = time.time() + cmd.args["seconds"]
+        self.logger.info("profiling started for {} seconds, result will be saved to {}".format(cmd.args["seconds"], session.fileName))
+        cmd.complete({"fileName": session.fileName})
+
+    def _finishProfiling(self):
+        session = self._profilingSession
+        self._profilingSession = None
+        self._profilingDeadline = None
+
+        try:
+            session.finish()
+        except (IOError, OSError) as e:
+            self.logger.error("can't save profiling result {}: {}".format(session.fileName, e))
+            return
+
+        self.logger.info("profiling finished, result saved to {}".format(session.fileName))
+
+    def applyCameraConfig(self, cameraConfig):
+        """
+        Applies camera settings, only changed groups of settings are applied. Must be called before recorder
+        started or from recorder thread (use CMD_APPLY_CONFIG command).
+
+        :param cameraConfig: CameraConfig
+        :return: None
+        """
+        prev = self.cameraConfig
+        self.cameraConfig = cameraConfig
+        self.cameraName = cameraConfig.name
+
+        if (prev is None) or (prev.captureSettings() != cameraConfig.captureSettings()):
+            self._applyCaptureSettings(cameraConfig)
+
+        if (prev is None) or (prev.detectorSettings() != cameraConfig.detectorSettings()):
+            self._applyDetectorSettings(cameraConfig)
+
+        if (prev is None) or (prev.recordingSettings() != cameraConfig.recordingSettings()):
+            self._applyRecordingSettings(cameraConfig)
+
+    def _applyCaptureSettings(self, cameraConfig):
+        self.camConnectionString = cameraConfig.connection
+
+        # camera is reconnected in main loop
+        if self.cap is not None:
+            self.logger.info("camera connection changed, reconnecting...")
+            self.cap.release()
+            self.cap = None
+
+        # frame rate of new camera is read from its first frame
+        self.camFps = None
+
+    def _applyDetectorSettings(self, cameraConfig):
+        threshold = cameraConfig.threshold
+        self.detector.threshold = threshold if threshold is not None else self._defaultDetectorThreshold
+        self.detector.zones = cameraConfig.zones
+        self.logger.info("detector settings applied: threshold = {}, zones = {}".format(self.detector.threshold, self.detector.zones))
 
-        if cmd.cmd == QueueCommand.CMD_QUIT_THREAD:
-            self._quit = True
+    def _applyRecordingSettings(self, cameraConfig):
+        # current file is finished, so each file is recorded in single mode
+        if (cameraConfig.recordingMode != self.recordingMode) and (self._output is not None):
+            self.logger.info("recording mode changed, stopping current recording...")
+            self._stopRecording()
+
+        self.recordingMode = cameraConfig.recordingMode
+        self.segmentDurationSeconds = cameraConfig.segmentDurationSeconds
+
+        # pre-alarm buffer is resized when next frame added to it
+        self.preAlarmRecordingSecondsQty = cameraConfig.preAlarmSeconds
+        self.memoryBudgetBytes = cameraConfig.memoryBudgetBytes
+
+        self.snapshotsQty = cameraConfig.snapshotsQty
+        if self.snapshotsQty > 0:
+            self._startSnapshotEncoder()
+
+        self.logger.info("recording settings applied: {}".format(cameraConfig.recordingSettings()))
+
+    def _startSnapshotEncoder(self):
+        if self._snapshotEncoder is not None:
             return
 
-        self.logger.error("unknown command: {} [{}]".format(cmd.cmd, cmd.uid))
-        raise Exception("Unknown command")
+        self._snapshotEncoder = SnapshotEncoder(
+            self.logger,
+            config.SNAPSHOT_ENCODER_THREADS,
+            config.SNAPSHOT_QUEUE_SIZE,
+            config.SNAPSHOT_JPEG_QUALITY
+        )
+        self._snapshotEncoder.start()
+
+    def _saveRequestedSnapshot(self, frame):
+        """
+        Saves snapshot requested by command: while clip is recorded snapshot is added to it (so it's moved to archive
+        and removed by retention together with clip), otherwise it's saved to snapshots directory
+        :return: tuple of (result of command or None when snapshot wasn't saved, True when frame is kept by encoder)
+        """
+        if (self._snapshotEncoder is not None) and (self._output is not None):
+            clipFileName = self._output.fileName
+            pendingName = self._saveSnapshot(frame)
+            if pendingName is None:
+                return (None, False)
+
+            return ({"fileName": pendingName, "clip": clipFileName}, True)
+
+        directory = self.snapshotsDirectory if self.snapshotsDirectory is not None else self.outputDirectory
+        if not mkdir_p(directory):
+            return (None, False)
+
+        fileName = os.path.join(
+            directory,
+            "snapshot_{}_{}.jpg".format(self.cameraName, self.utcNow().strftime("%Y%m%dT%H%M%S_%f"))
+        )
+
+        if self._snapshotEncoder is not None:
+            saved = self._snapshotEncoder.submit(fileName, frame)
+            return ({"fileName": fileName} if saved else None, saved)
+
+        return ({"fileName": fileName} if cv.imwrite(fileName, frame) else None, False)
+
+    def _processSnapshotRequests(self, frame):
+        """
+        :return: True when frame is kept for snapshot (it must not be changed)
+        """
+        if len(self._snapshotRequests) == 0:
+            return False
+
+        (result, kept) = self._saveRequestedSnapshot(frame)
+        for cmd in self._snapshotRequests:
+            if result is not None:
+                cmd.complete(result)
+            else:
+                cmd.complete(error="can't save snapshot")
+
+        self._snapshotRequests = []
+        return kept
 
     def start(self):  # noqa
         """
@@ -200,17 +1235,30 @@ class MotionDrivenRecorder(CameraConnectionSupport):
         """
         self.logger.info("main loop started")
 
+        if self._writerPreparer is not None:
+            self._writerPreparer.start()
+
+        if self.snapshotsQty > 0:
+            self._startSnapshotEncoder()
+
         emptyFrame = None
 
         prev_logged_left_seconds = None
 
         bad_frames = 0
 
+        self._loadDetectorState()
+
+        self.startedTime = time.time()
         while not self._quit:
+            self.lastLoopTime = time.time()
             self._process_queue_commands()
             if self._quit:
                 break
 
+            if (self._profilingSession is not None) and (time.time() >= self._profilingDeadline):
+                self._finishProfiling()
+
             if bad_frames > 100:
                 if self.cap is not None:
                     self.cap.release()
@@ -227,6 +1275,7 @@ class MotionDrivenRecorder(CameraConnectionSupport):
 
                 self._camConnectionDts = self.utcNow()
 
+            readStartTime = time.time()
             ret, current_frame = self.cap.read()
 
             # if can't read current frame - going to the next loop
@@ -237,6 +1286,13 @@ class MotionDrivenRecorder(CameraConnectionSupport):
             else:
                 bad_frames = 0
 
+            # processing time of frame is measured for load governor
+            frameReadTime = time.time()
+            self.lastFrameTime = frameReadTime
+
+            # snapshots are made from frames in original resolution
+            source_frame = current_frame
+
             if self.scaleFrameTo is not None:
                 current_frame = imutils.resize(current_frame, width=self.scaleFrameTo[0], height=self.scaleFrameTo[1])
 
@@ -247,35 +1303,20 @@ class MotionDrivenRecorder(CameraConnectionSupport):
             frameWidth = np.size(current_frame, 1)
 
             if self.camFps is None:
-                self.camFps = self.cap.get(cv.CAP_PROP_FPS)
+                self.camFps = self.cameraFps()
                 self.logger.info("FPS = {}".format(self.camFps))
 
-            # adding frame to pre-recording buffer
-            if self.preAlarmRecordingSecondsQty > 0:
-                self._addPreAlarmFrame(current_frame)
+            if (self.frameWidth != frameWidth) or (self.frameHeight != frameHeight):
+                self._updateFrameSize(frameWidth, frameHeight)
+                emptyFrame = None
 
             if emptyFrame is None:
                 emptyFrame = np.zeros((frameHeight, frameWidth, 3), np.uint8)
 
-            resolutionChanged = False
-            if None in [self.frameWidth, self.frameHeight]:
-                self.frameWidth = frameWidth
-                self.frameHeight = frameHeight
-                self.nb_pixels = self.frameWidth * self.frameHeight
-
-                self.logger.info("self.width = {}".format(self.frameWidth))
-                self.logger.info("self.height = {}".format(self.frameHeight))
-
-                resolutionChanged = True
-            else:
-                resolutionChanged = ((self.frameWidth != frameWidth) or (self.frameHeight != frameHeight))
-
-            if resolutionChanged:
-                # TODO: need process when recording now, or will be exception!
-                self.onFrameSizeUpdate(frameWidth, frameHeight)
-
             # detecting motion
             motionDetected = self._detect_motion(current_frame, instant)
+            motionInFrame = motionDetected
+            detectionTime = time.time()
 
             now = self.utcNow()
             # prolongating motion for minimal motion duration
@@ -288,14 +1329,25 @@ class MotionDrivenRecorder(CameraConnectionSupport):
             if not motionDetected:
                 self.inMotionDetectedState = False
 
-                if self._isRecording:
-                    self.logger.info("stopping recording...")
-                    self._stopRecording()
+            # recording may be forced on or off by command
+            recordingRequested = motionDetected
+            if self.forcedRecording is not None:
+                recordingRequested = self.forcedRecording
 
-            elif not self._isRecording:
-                self.logger.info("starting recording...")
-                self._startRecording()
-                self._flushPreRecordingFrames()
+            if self.recordingMode == RECORDING_MODE_CONTINUOUS:
+                self._updateSegmentedRecording(now)
+            else:
+                self._updateRecordingState(recordingRequested, now)
+
+            if self._output is not None:
+                self._updateClipMetadata(motionInFrame, now)
+
+            # frames kept for snapshots aren't copied, so label is drawn on copy of such frame
+            keptForSnapshot = self._updateSnapshots(source_frame, motionInFrame, motionDetected)
+            keptForSnapshot = self._processSnapshotRequests(source_frame) or keptForSnapshot
+
+            if (self.occupancyRecorder is not None) and (self.detector.lastMotionMask is not None):
+                self.occupancyRecorder.add(now, self.detector.lastMotionMask)
 
             # calculating left seconds for motion (for further use in label)
             dx = 0
@@ -308,7 +1360,10 @@ class MotionDrivenRecorder(CameraConnectionSupport):
                     prev_logged_left_seconds = dx
 
             # adding label for frame with detected motion
-            if motionDetected:
+            if motionDetected and self._overlaysEnabled():
+                if keptForSnapshot and (current_frame is source_frame):
+                    current_frame = current_frame.copy()
+
                 text = "MOTION DETECTED [{}]".format(dx)
                 cv.putText(
                     current_frame,
@@ -320,15 +1375,49 @@ class MotionDrivenRecorder(CameraConnectionSupport):
                     2
                 )
 
+            if self.liveSource is not None:
+                self.liveSource.publish(current_frame)
+
+            # frames which are not recorded are kept in pre-recording buffer
             if self._isRecording:
                 self._writeOutFrame(current_frame)
+            elif self.preAlarmRecordingSecondsQty > 0:
+                self._addPreAlarmFrame(current_frame)
+
+            processingTime = time.time()
+            self._addStageTimes(readStartTime, frameReadTime, detectionTime, processingTime)
+            self._updateLoadStats(processingTime - frameReadTime)
+
+            self._saveDetectorState()
+
+        if self._profilingSession is not None:
+            self._finishProfiling()
+
+        self._saveDetectorState(force=True)
+        self._stopDetectorStateSaver()
 
         # stop recording if now recording
-        if self._isRecording:
+        output = self._output
+        if output is not None:
             self._stopRecording()
 
+        if output is not None:
+            output.join()
+
+        if self._snapshotEncoder is not None:
+            self._snapshotEncoder.stop()
+
+        if self._writerPreparer is not None:
+            self._writerPreparer.stop()
+            self._writerPreparer.join()
+
+        self._closePreAlarmBuffer()
+
+        if self.occupancyRecorder is not None:
+            self.occupancyRecorder.close()
+
         if self.cap is not None:
             self.cap.release()
 
         cv.destroyAllWindows()
-        self.logger.info("main loop finished")
\ No newline at end of file
+        self.logger.info("main loop finished")
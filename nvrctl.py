@@ -0,0 +1,46 @@
+import argparse
+import json
+import socket
+import config
+from system.shared import makeAbsoluteAppPath
+
+
+def parseValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends command to running pynvrd")
+    parser.add_argument("--camera", default=config.CAMERA_NAME, help="camera name")
+    parser.add_argument("--socket", default=config.CONTROL_SOCKET_PATH, help="path to control socket")
+    parser.add_argument("cmd", help="command: stats, set_detector, set_zones, force_recording, snapshot, rotate, reopen, profile, allocations")
+    parser.add_argument("args", nargs="*", help="command arguments as name=value, values are parsed as JSON")
+    args = parser.parse_args()
+
+    if args.socket is None:
+        print("control socket is disabled")
+        return -1
+
+    request = {
+        "camera": args.camera,
+        "cmd": args.cmd,
+        "args": dict((name, parseValue(value)) for (name, value) in (item.split("=", 1) for item in args.args)),
+    }
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(makeAbsoluteAppPath(args.socket))
+    client.sendall(json.dumps(request) + "\n")
+
+    response = client.makefile().readline()
+    client.close()
+
+    print(response.strip())
+    return 0 if json.loads(response).get("ok") else -1
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
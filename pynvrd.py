@@ -5,75 +5,583 @@ import time
 import os
 from system.shared import makeAbsoluteAppPath, mkdir_p
 import signal
-from nvr_classes.motion_driven_recorder import MotionDrivenRecorder
+import socket
+from nvr_classes.motion_driven_recorder import MotionDrivenRecorder, QueueCommand
+from system.retention import SegmentRetentionSweeper, QuotaRetentionManager
+from system.clip_mover import ClipMover
+from system.recording_index import RecordingIndexWriter
+from system.post_processing import ClipPostProcessor
+from system.live_server import LiveServer, LiveFrameSource
+from system.control_server import ControlServer
+from system.motion_search import OccupancyRecorder
+from system.load_shedding import LoadSheddingGovernor
+from system.cpu_scheduler import CpuScheduler
+from system.cluster import ClusterNode
+from system.watchdog import PipelineWatchdog
+from system.camera_config import ConfigError, CameraConfigWatcher, loadCamerasConfig, defaultCamerasConfig
 import threading
 
 
-nvr_thread = None
+camera_manager = None
 quit_loop = False
 
 
 def signal_handler(signal, frame):
-    global nvr_thread
+    global camera_manager
     global quit_loop
 
     quit_loop = True
-    nvr_thread.add_stop_request()
+    camera_manager.add_stop_request()
 
 
 class NVRThread(threading.Thread):
-    def __init__(self, logger, video_path):
+    def __init__(self, logger, video_path, clip_listeners, camera_config, live_source = None, control_server = None):
         threading.Thread.__init__(self)
         self._logger = logger
-        self._video_path = video_path
+        self._camera_config = camera_config
+        self._control_server = control_server
 
-        self._processor = None
+        self._processor = MotionDrivenRecorder(camera_config.connection, self._logger)
+        self._processor.preAlarmBufferBackend = config.PRE_ALARM_BUFFER_BACKEND
+        self._processor.preAlarmSpillDirectory = config.PRE_ALARM_SPILL_DIRECTORY
+        self._processor.preAlarmJpegQuality = config.PRE_ALARM_JPEG_QUALITY
+        self._processor.outputDirectory = video_path
+        self._processor.subFolderNameGeneratorFunc = config.subFolderNameGeneratorFunc
+        self._processor.scaleFrameTo = config.scaleFrameTo
+        self._processor.clipListeners.extend(clip_listeners)
+        self._processor.liveSource = live_source
+        self._processor.profilesDirectory = makeAbsoluteAppPath(config.PROFILES_PATH)
+
+        # with staging directory snapshots which don't belong to clip are saved to archive directly
+        self._processor.snapshotsDirectory = makeAbsoluteAppPath(config.PATH_FOR_VIDEO)
+        if config.DETECTOR_STATE_PATH is not None:
+            self._processor.detectorStatePath = makeAbsoluteAppPath(config.DETECTOR_STATE_PATH)
+        self._processor.applyCameraConfig(camera_config)
+
+        if config.LOAD_SHEDDING_ENABLED:
+            self._processor.loadGovernor = LoadSheddingGovernor(self._logger, camera_config.name)
+
+        if config.OCCUPANCY_PATH is not None:
+            self._processor.occupancyRecorder = OccupancyRecorder(
+                self._logger,
+                makeAbsoluteAppPath(config.OCCUPANCY_PATH),
+                camera_config.name,
+                config.OCCUPANCY_CELL_THRESHOLD,
+                config.OCCUPANCY_FLUSH_INTERVAL_SECONDS
+            )
 
     def run(self):
         print("nvr thread id = {}".format(threading.current_thread().ident))
 
-        self._processor = MotionDrivenRecorder(config.cam, self._logger)
-        self._processor.preAlarmRecordingSecondsQty = config.PRE_ALARM_RECORDING_SECONDS
-        self._processor.outputDirectory = self._video_path
-        self._processor.subFolderNameGeneratorFunc = config.subFolderNameGeneratorFunc
-        self._processor.scaleFrameTo = config.scaleFrameTo
+        if self._control_server is not None:
+            self._control_server.addRecorder(self._camera_config.name, self._processor)
 
         self._processor.start()
 
+        # camera may be restarted with new recorder while this one was blocked
+        if self._control_server is not None:
+            self._control_server.removeRecorder(self._camera_config.name, self._processor)
+
         print("nvr thread id = {}".format(threading.current_thread().ident))
         print "Done"
 
     def add_stop_request(self):
         self._processor.add_stop_request()
 
+    def busy_ratio(self):
+        return self._processor.busyRatio
 
+    def camera_config(self):
+        return self._camera_config
 
-def main():
-    logger = init_logger()
-    logger.info("app started")
-    logger.info("main thread id = {}".format(threading.current_thread().ident))
+    def health(self):
+        return self._processor.getHealth()
+
+    def reopen(self):
+        self._processor.addCommand(QueueCommand(QueueCommand.CMD_REOPEN))
+
+    def abandon(self):
+        self._processor.add_stop_request()
+        self._processor.abandonRecording()
+
+    def set_cpus(self, cpus):
+        # affinity is set by recorder thread itself
+        self._processor.addCommand(QueueCommand(QueueCommand.CMD_SET_AFFINITY, {"cpus": cpus}))
+
+    def add_frame_size_listener(self, listener):
+        self._processor.frameSizeListeners.append(listener)
+
+    def apply_config(self, camera_config):
+        # settings are applied in recorder thread
+        self._camera_config = camera_config
+        self._processor.addCommand(QueueCommand(QueueCommand.CMD_APPLY_CONFIG, {"config": camera_config}))
+
+
+class CameraManager:
+    """
+    Runs recorder thread for each camera, cameras can be added, changed and removed while app is running
+    """
+    def __init__(self, logger, videoPath, clipListeners, liveServer = None, controlServer = None, perCameraDirectories = False):
+        self._logger = logger
+        self._videoPath = videoPath
+        self._clipListeners = clipListeners
+        self._liveServer = liveServer
+        self._controlServer = controlServer
+
+        # CPUs are assigned to cameras from their count and frame sizes
+        self._scheduler = CpuScheduler(self._logger, config.CPU_AFFINITY_CPUS, config.CPU_AFFINITY_ENABLED)
+        self._scheduler.onPlanChanged = self._onPlanChanged
+
+        # each camera records into own sub-directory
+        self._perCameraDirectories = perCameraDirectories
+
+        # camera name -> NVRThread
+        self.threads = {}
+        self._lock = threading.Lock()
+
+        # cameras aren't started after stop request
+        self._stopping = False
+
+        # recorders which are blocked (for example reading from camera hangs) are replaced
+        self._watchdog = None
+        if config.WATCHDOG_STALL_SECONDS > 0:
+            self._watchdog = PipelineWatchdog(self._logger, config.WATCHDOG_STALL_SECONDS, config.WATCHDOG_CHECK_INTERVAL_SECONDS)
+            self._watchdog.maxReopens = config.WATCHDOG_MAX_REOPENS
+            self._watchdog.maxBackoffSeconds = config.WATCHDOG_MAX_BACKOFF_SECONDS
+            self._watchdog.onStalled = self.restartCamera
+            self._watchdog.start()
+
+        if self._liveServer is not None:
+            self._liveServer.healthProvider = self.health
+
+    def startCamera(self, cameraConfig):
+        if self._stopping:
+            return
+
+        self._logger.info("starting camera: {}".format(cameraConfig.name))
+
+        videoPath = self._videoPath
+        if self._perCameraDirectories:
+            videoPath = os.path.join(videoPath, cameraConfig.name)
+
+        liveSource = None
+        if self._liveServer is not None:
+            liveSource = LiveFrameSource(cameraConfig.name, config.LIVE_JPEG_INTERVAL_SECONDS, config.LIVE_JPEG_QUALITY)
+            self._liveServer.addSource(liveSource)
+
+        thread = NVRThread(self._logger, videoPath, self._clipListeners, cameraConfig, liveSource, self._controlServer)
+
+        # threads are joined explicitly, so recordings are finished on exit, but thread which is blocked in reading
+        # from camera must not keep process running
+        thread.setDaemon(True)
+        thread.add_frame_size_listener(self._onFrameSizeUpdate)
 
-    # creating directory for output files
-    videoPath = config.PATH_FOR_VIDEO
-    videoPath = makeAbsoluteAppPath(videoPath)
+        with self._lock:
+            self.threads[cameraConfig.name] = thread
+
+        if self._watchdog is not None:
+            self._watchdog.addCamera(cameraConfig.name, thread)
+
+        # threads limits are updated before camera connection is opened
+        self._scheduler.addCamera(cameraConfig.name)
+        thread.start()
+
+    def stopCamera(self, cameraConfig):
+        with self._lock:
+            thread = self.threads.pop(cameraConfig.name, None)
+
+        if thread is None:
+            return
+
+        self._logger.info("stopping camera: {}".format(cameraConfig.name))
+        if self._watchdog is not None:
+            self._watchdog.removeCamera(cameraConfig.name, thread)
+
+        thread.add_stop_request()
+        thread.join()
+
+        self._scheduler.removeCamera(cameraConfig.name)
+
+        if self._liveServer is not None:
+            self._liveServer.removeSource(cameraConfig.name)
+
+    def restartCamera(self, cameraName):
+        """
+        Replaces recorder thread of camera which is blocked (for example reading from camera hangs). Blocked
+        thread can't be interrupted, so it's only asked to quit and finishes when blocking call returns
+        """
+        with self._lock:
+            if self._stopping:
+                return
+
+            thread = self.threads.pop(cameraName, None)
+
+        if thread is None:
+            return
+
+        self._logger.warning("restarting camera: {}".format(cameraName))
+        thread.abandon()
+
+        if self._watchdog is not None:
+            self._watchdog.removeCamera(cameraName, thread)
+
+        self._scheduler.removeCamera(cameraName)
+
+        if self._liveServer is not None:
+            self._liveServer.removeSource(cameraName)
+
+        self.startCamera(thread.camera_config())
+
+    def health(self):
+        """
+        Returns status of cameras reported by watchdog, None when watchdog is disabled
+        """
+        return self._watchdog.getHealth() if self._watchdog is not None else None
+
+    def _onFrameSizeUpdate(self, cameraName, frameWidth, frameHeight):
+        self._scheduler.updateCamera(cameraName, frameWidth * frameHeight)
+
+    def _onPlanChanged(self, plan):
+        with self._lock:
+            threads = dict(self.threads)
+
+        for (name, cpus) in plan.items():
+            if name in threads:
+                threads[name].set_cpus(cpus)
+
+    def applyCameraConfig(self, oldCameraConfig, cameraConfig):
+        with self._lock:
+            thread = self.threads.get(cameraConfig.name)
+
+        if thread is None:
+            return
+
+        self._logger.info("applying settings of camera: {}".format(cameraConfig.name))
+        thread.apply_config(cameraConfig)
+
+    def cameraLoads(self):
+        """
+        Returns busy ratios of recorders: camera name -> busy ratio (None when it isn't measured yet)
+        """
+        with self._lock:
+            return dict((name, thread.busy_ratio()) for (name, thread) in self.threads.items())
+
+    def add_stop_request(self):
+        with self._lock:
+            self._stopping = True
+            threads = list(self.threads.values())
+
+        if self._watchdog is not None:
+            self._watchdog.stop()
+
+        for thread in threads:
+            thread.add_stop_request()
+
+    def join(self):
+        with self._lock:
+            threads = list(self.threads.items())
+
+        # with watchdog enabled, thread which is blocked in reading from camera is abandoned on exit
+        timeout = config.WATCHDOG_STALL_SECONDS if config.WATCHDOG_STALL_SECONDS > 0 else None
+        for (name, thread) in threads:
+            thread.join(timeout)
+            if thread.is_alive():
+                self._logger.error("camera {} didn't stop in {} seconds, it's abandoned".format(name, timeout))
+                thread.abandon()
+
+
+class ArchiveServices:
+    """
+    Background services for finished clips: post-processor, mover from staging directory, recording index
+    writer and retention manager
+    """
+    def __init__(self, logger, videoPath):
+        self._logger = logger
+
+        self.archiveRoots = [makeAbsoluteAppPath(path) for path in config.ARCHIVE_ROOTS]
+        if len(self.archiveRoots) == 0:
+            self.archiveRoots = [videoPath]
+
+        # directory where recorder writes clips
+        self.recordingPath = videoPath
+
+        # listeners for clips closed by recorder
+        self.clipListeners = []
+
+        self.postProcessor = None
+        self.mover = None
+        self.indexWriter = None
+        self.sweeper = None
+
+        self._statsLogTime = time.time()
+
+    def _startPostProcessing(self):
+        """
+        Starts post-processor, it's the first listener of recorder
+        :return: listeners for post-processed clips
+        """
+        if not config.POST_PROCESSING_ENABLED:
+            return self.clipListeners
+
+        self.postProcessor = ClipPostProcessor(self._logger)
+        self.postProcessor.start()
+        self.clipListeners.append(self.postProcessor.enqueue)
+        return self.postProcessor.clipListeners
+
+    def start(self):
+        # listeners for finished clips
+        processedListeners = self._startPostProcessing()
+
+        # listeners for clips which reached archive
+        archiveListeners = processedListeners
+
+        # when staging directory used, clips are recorded to it and then moved to archive roots
+        if config.PATH_FOR_STAGING is not None:
+            self.recordingPath = makeAbsoluteAppPath(config.PATH_FOR_STAGING)
+            if not mkdir_p(self.recordingPath):
+                self._logger.error("can't create staging directory: {}".format(self.recordingPath))
+                return False
+
+            self.mover = ClipMover(self._logger, self.recordingPath, self.archiveRoots)
+            self.mover.start()
+            processedListeners.append(self.mover.enqueue)
+            archiveListeners = self.mover.clipListeners
+
+        # clips are added to index when they reach archive
+        if config.RECORDING_INDEX_PATH is not None:
+            self.indexWriter = RecordingIndexWriter(self._logger, makeAbsoluteAppPath(config.RECORDING_INDEX_PATH))
+            self.indexWriter.start()
+            archiveListeners.append(self.indexWriter.addClip)
+
+            # clips which were indexed in staging directory (see rebuild_index.py) are re-indexed in archive
+            if self.mover is not None:
+                self.mover.moveListeners.append(lambda srcFileName, dstFileName: self.indexWriter.removeClip(srcFileName))
+
+        self._startRetention()
+        self._processLeftovers()
+        return True
+
+    def _processLeftovers(self):
+        """
+        Passes clips which were left in staging directory (for example, before restart) through the same listeners
+        as clips closed by recorder
+        """
+        if self.mover is None:
+            return
+
+        for (fileName, metadata) in self.mover.findLeftovers():
+            for listener in self.clipListeners:
+                try:
+                    listener(fileName, metadata)
+                except Exception as e:
+                    self._logger.error("clip listener failed for {}: {}".format(fileName, e))
+
+    def _startRetention(self):
+        # with recording index oldest clips are found without walking archive
+        if config.RECORDING_INDEX_PATH is not None:
+            if QuotaRetentionManager.isRequired():
+                self.sweeper = QuotaRetentionManager(
+                    self._logger,
+                    makeAbsoluteAppPath(config.RECORDING_INDEX_PATH),
+                    self.archiveRoots
+                )
+        elif (config.MOTION_CLIPS_RETENTION_DAYS > 0) or (config.QUIET_CLIPS_RETENTION_DAYS > 0):
+            self.sweeper = SegmentRetentionSweeper(self._logger, self.archiveRoots)
+
+        if self.sweeper is not None:
+            self.sweeper.start()
+
+    def getStats(self):
+        """
+        Returns queue depth and throughput of post-processor and mover (only of running services)
+        """
+        stats = {}
+        if self.postProcessor is not None:
+            stats["postProcessing"] = self.postProcessor.getStats()
+
+        if self.mover is not None:
+            stats["mover"] = self.mover.getStats()
+
+        return stats
+
+    def logStats(self):
+        """
+        Logs stats of services every ARCHIVE_STATS_LOG_INTERVAL_SECONDS, called periodically from main loop
+        """
+        if (config.ARCHIVE_STATS_LOG_INTERVAL_SECONDS <= 0) or (time.time() - self._statsLogTime < config.ARCHIVE_STATS_LOG_INTERVAL_SECONDS):
+            return
+
+        self._statsLogTime = time.time()
+        for (name, serviceStats) in sorted(self.getStats().items()):
+            self._logger.info("{} stats: {}".format(name, ", ".join("{} = {}".format(key, value) for (key, value) in sorted(serviceStats.items()))))
+
+    def stop(self):
+        # services are stopped in order of clips flow, so finished clips are passed to archive and indexed
+        for service in [self.postProcessor, self.sweeper, self.mover, self.indexWriter]:
+            if service is None:
+                continue
+
+            service.stop()
+            service.join()
+
+
+def startLiveServer(logger):
+    if config.LIVE_SERVER_ADDRESS is None:
+        return None
+
+    try:
+        liveServer = LiveServer(logger, config.LIVE_SERVER_ADDRESS, config.LIVE_CLIENT_TIMEOUT_SECONDS)
+    except socket.error as e:
+        logger.error("can't start live server: {}".format(e))
+        return None
+
+    liveServer.start()
+    return liveServer
+
+
+def startControlServer(logger, services):
+    if config.CONTROL_SOCKET_PATH is None:
+        return None
+
+    try:
+        controlServer = ControlServer(logger, makeAbsoluteAppPath(config.CONTROL_SOCKET_PATH))
+    except (socket.error, OSError) as e:
+        logger.error("can't start control server: {}".format(e))
+        return None
+
+    controlServer.statsProviders["archive"] = services.getStats
+    controlServer.start()
+    return controlServer
+
+
+def makeVideoDirectory(logger):
+    """
+    Creates directory for output files
+    :return: path to directory or None on error
+    """
+    videoPath = makeAbsoluteAppPath(config.PATH_FOR_VIDEO)
     if not os.path.exists(videoPath):
         logger.info("making directory for output files: {}".format(videoPath))
 
         if not mkdir_p(videoPath):
             logger.error("can't create directory for output files")
-            return -1
+            return None
+
+    return videoPath
+
+
+def camerasConfigFileName():
+    if config.CAMERAS_CONFIG_PATH is None:
+        return None
+
+    return makeAbsoluteAppPath(config.CAMERAS_CONFIG_PATH)
+
+
+def loadCameras(logger, camerasConfigPath):
+    """
+    Loads settings of cameras from file or from config.py when file isn't used
+    :return: list of CameraConfig or None when settings are invalid
+    """
+    if camerasConfigPath is None:
+        return defaultCamerasConfig()
+
+    try:
+        return loadCamerasConfig(camerasConfigPath)
+    except ConfigError as e:
+        logger.error("invalid cameras settings: {}".format(e))
+        return None
+
+
+def startCameras(logger, cameras, cameraManager):
+    """
+    Starts all cameras or cluster node which starts cameras assigned to it
+    :return: camera manager or cluster node
+    """
+    if config.CLUSTER_PATH is None:
+        for cameraConfig in cameras:
+            cameraManager.startCamera(cameraConfig)
+
+        return cameraManager
+
+    nodeId = config.CLUSTER_NODE_ID
+    if nodeId is None:
+        nodeId = "{}-{}".format(socket.gethostname(), os.getpid())
+
+    node = ClusterNode(logger, makeAbsoluteAppPath(config.CLUSTER_PATH), nodeId, cameras, cameraManager)
+    node.start()
+    return node
+
+
+def startCameraConfigWatcher(logger, camerasConfigPath, cameras, cameraOwner):
+    """
+    :param cameraOwner: camera manager or cluster node
+    """
+    watcher = CameraConfigWatcher(logger, camerasConfigPath, cameras, config.CAMERAS_CONFIG_CHECK_INTERVAL_SECONDS)
+    watcher.onCameraAdded = cameraOwner.startCamera
+    watcher.onCameraChanged = cameraOwner.applyCameraConfig
+    watcher.onCameraRemoved = cameraOwner.stopCamera
+    watcher.start()
+    return watcher
 
-    global nvr_thread
-    nvr_thread = NVRThread(logger, videoPath)
-    nvr_thread.setDaemon(False)
-    nvr_thread.start()
+
+def main():
+    logger = init_logger()
+    logger.info("app started")
+    logger.info("main thread id = {}".format(threading.current_thread().ident))
+
+    videoPath = makeVideoDirectory(logger)
+    if videoPath is None:
+        return -1
+
+    camerasConfigPath = camerasConfigFileName()
+    cameras = loadCameras(logger, camerasConfigPath)
+    if cameras is None:
+        return -1
+
+    services = ArchiveServices(logger, videoPath)
+    if not services.start():
+        return -1
+
+    liveServer = startLiveServer(logger)
+    controlServer = startControlServer(logger, services)
+
+    global camera_manager
+    camera_manager = CameraManager(
+        logger,
+        services.recordingPath,
+        services.clipListeners,
+        liveServer,
+        controlServer,
+        camerasConfigPath is not None
+    )
+
+    # in cluster cameras are started by node when they are assigned to it
+    cameraOwner = startCameras(logger, cameras, camera_manager)
+
+    watcher = None
+    if camerasConfigPath is not None:
+        watcher = startCameraConfigWatcher(logger, camerasConfigPath, cameras, cameraOwner)
 
     global quit_loop
     while not quit_loop:
         time.sleep(1)
+        services.logStats()
+
+    # cluster node leaves cluster before cameras are stopped, so they are taken over by other nodes
+    for service in [watcher, cameraOwner if cameraOwner is not camera_manager else None]:
+        if service is not None:
+            service.stop()
+            service.join()
 
     logger.info("joining...")
-    nvr_thread.join()
+    camera_manager.join()
+
+    services.stop()
+
+    for server in [controlServer, liveServer]:
+        if server is not None:
+            server.stop()
+
     logger.info("app finished")
 
     return 0
@@ -0,0 +1,104 @@
+from system.log_support import init_logger
+import os
+import datetime as dts
+import cv2 as cv
+import config
+from system.shared import makeAbsoluteAppPath
+from system.clip_metadata import ClipMetadata, isClipFileName
+from system.recording_index import RecordingIndex, parseClipFileName
+
+
+def clipCameraName(videoPath, fileName):
+    """
+    Returns name of camera which recorded clip. When cameras settings file is used each camera records into
+    own sub-directory (see pynvrd.py), otherwise the only camera is CAMERA_NAME
+
+    :param videoPath: archive root or staging directory
+    :param fileName: clip file name
+    :return: camera name
+    """
+    if config.CAMERAS_CONFIG_PATH is None:
+        return config.CAMERA_NAME
+
+    relPath = os.path.relpath(fileName, videoPath)
+    return relPath.split(os.sep)[0] if os.sep in relPath else config.CAMERA_NAME
+
+
+def loadClipMetadata(fileName, startDts, cameraName):
+    """
+    Loads clip metadata from sidecar file, when it's not available reads duration from video file
+
+    :param fileName: clip file name
+    :param startDts: DTS of clip start (from file name)
+    :param cameraName: camera name used when metadata doesn't have it
+    :return: ClipMetadata
+    """
+    metadata = ClipMetadata.load(fileName)
+    if metadata is not None:
+        if metadata.cameraName is None:
+            metadata.cameraName = cameraName
+        return metadata
+
+    metadata = ClipMetadata(cameraName, startDts)
+
+    cap = cv.VideoCapture(fileName)
+    framesCount = int(cap.get(cv.CAP_PROP_FRAME_COUNT) or 0)
+    fps = cap.get(cv.CAP_PROP_FPS) or config.OUTPUT_FRAME_RATE
+    cap.release()
+
+    metadata.framesCount = framesCount
+    metadata.endDts = startDts + dts.timedelta(seconds=float(framesCount) / fps)
+    return metadata
+
+
+def rebuildIndex(logger, index, videoPaths):
+    qty = 0
+    for videoPath in videoPaths:
+        for (root, dirs, files) in os.walk(videoPath):
+            for fileName in files:
+                startDts = parseClipFileName(fileName)
+                if (startDts is None) or (not isClipFileName(fileName)):
+                    continue
+
+                clipFileName = os.path.join(root, fileName)
+                metadata = loadClipMetadata(clipFileName, startDts, clipCameraName(videoPath, clipFileName))
+                index.insertClip(clipFileName, metadata)
+
+                qty += 1
+                if qty % 1000 == 0:
+                    index.commit()
+                    logger.info("clips indexed: {}".format(qty))
+
+    index.commit()
+    return qty
+
+
+def main():
+    logger = init_logger()
+    logger.info("rebuilding recording index")
+
+    if config.RECORDING_INDEX_PATH is None:
+        logger.error("recording index is disabled")
+        return -1
+
+    videoPaths = [makeAbsoluteAppPath(path) for path in config.ARCHIVE_ROOTS]
+    if len(videoPaths) == 0:
+        videoPaths = [makeAbsoluteAppPath(config.PATH_FOR_VIDEO)]
+
+    # clips which are not moved to archive yet are indexed too, they are re-indexed by daemon when moved
+    if config.PATH_FOR_STAGING is not None:
+        videoPaths.append(makeAbsoluteAppPath(config.PATH_FOR_STAGING))
+
+    index = RecordingIndex(makeAbsoluteAppPath(config.RECORDING_INDEX_PATH))
+    index.clear()
+
+    qty = rebuildIndex(logger, index, videoPaths)
+    index.close()
+
+    logger.info("recording index rebuilt, clips: {}".format(qty))
+    return 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
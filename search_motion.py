@@ -0,0 +1,53 @@
+import argparse
+import datetime as dts
+import config
+from system.shared import makeAbsoluteAppPath
+from system.motion_search import OccupancyStore, rectangleBitmap
+from system.recording_index import RecordingIndex
+
+
+def parseDts(value):
+    return dts.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Searches recorded footage for motion in area of frame")
+    parser.add_argument("--camera", default=config.CAMERA_NAME, help="camera name")
+    parser.add_argument("--start", required=True, type=parseDts, help="range start (UTC), for example 2017-04-02T13:00:00")
+    parser.add_argument("--end", required=True, type=parseDts, help="range end (UTC)")
+    parser.add_argument(
+        "--rect",
+        required=True,
+        type=float,
+        nargs=4,
+        metavar=("X0", "Y0", "X1", "Y1"),
+        help="area in relative frame coordinates (0.0 - 1.0)"
+    )
+    args = parser.parse_args()
+
+    if config.OCCUPANCY_PATH is None:
+        print("occupancy recording is disabled")
+        return -1
+
+    store = OccupancyStore(makeAbsoluteAppPath(config.OCCUPANCY_PATH))
+    seconds = store.findSeconds(args.camera, rectangleBitmap(*args.rect), args.start, args.end)
+    ranges = OccupancyStore.groupSeconds(seconds)
+
+    if config.RECORDING_INDEX_PATH is None:
+        for (first, last) in ranges:
+            print("{} - {}".format(dts.datetime.utcfromtimestamp(first), dts.datetime.utcfromtimestamp(last + 1)))
+        return 0
+
+    index = RecordingIndex(makeAbsoluteAppPath(config.RECORDING_INDEX_PATH))
+    clips = index.findClips(args.camera, args.start, args.end)
+    index.close()
+
+    for (path, offset, duration) in OccupancyStore.mapToClips(ranges, clips):
+        print("{} +{:.0f}s ({}s)".format(path, offset, duration))
+
+    return 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
@@ -0,0 +1,404 @@
+from system.log_support import init_logger
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import config
+from nvr_classes.motion_driven_recorder import MotionDrivenRecorder
+from system.clip_metadata import sidecarFileNames
+
+
+STAGES = ["read", "detect", "record"]
+
+COLUMNS = [
+    "elapsed_seconds", "rss_mb", "open_fds", "threads", "fps", "dropped_frames",
+    "read_ms", "detect_ms", "record_ms", "writer_queue", "trigger_latency", "clips", "disk_mb_per_s",
+]
+
+# metrics compared with baseline: name -> (higher is better, min absolute change reported as regression)
+METRICS = [
+    ("rss_max_mb", False, 16.0),
+    ("rss_growth_mb_per_hour", False, 8.0),
+    ("open_fds_growth_per_hour", False, 2.0),
+    ("threads_growth_per_hour", False, 1.0),
+    ("fps", True, 0.5),
+    ("drop_rate", False, 0.002),
+    ("detect_ms_mean", False, 1.0),
+    ("detect_ms_p95", False, 2.0),
+    ("record_ms_mean", False, 1.0),
+    ("record_ms_p95", False, 2.0),
+    ("trigger_latency_p95", False, 0.05),
+    ("disk_mb_per_s", True, 0.05),
+]
+
+
+def residentMegabytes():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+
+    return pages * os.sysconf("SC_PAGE_SIZE") / float(1024 ** 2)
+
+
+def openFilesQty():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class ClipSink:
+    """
+    Clip listener which counts bytes of closed clips (with sidecar files) and removes them, so disk
+    isn't filled during long test
+    """
+
+    def __init__(self, keepClips = False):
+        self.keepClips = keepClips
+        self.bytesQty = 0
+        self.clipsQty = 0
+        self._lock = threading.Lock()
+
+    def onClipClosed(self, fileName, metadata):
+        names = [fileName] + sidecarFileNames(fileName)
+        size = sum(os.path.getsize(name) for name in names if os.path.exists(name))
+
+        with self._lock:
+            self.bytesQty += size
+            self.clipsQty += 1
+
+        if self.keepClips:
+            return
+
+        for name in names:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+def counterDelta(previous, current):
+    # counters of camera and writer start from zero after reconnect and for each new clip
+    return current - previous if current >= previous else current
+
+
+class SoakSampler:
+    """
+    Samples process resources and recorders statistics, values of each sample are measured for interval
+    since previous sample
+    """
+
+    def __init__(self, recorders, sink):
+        self.recorders = recorders
+        self.sink = sink
+        self.started = time.time()
+
+        # last values of dropped frames counters of camera and writer for each recorder
+        self._dropCounters = [(0, 0) for _ in recorders]
+        self._previous = self._totals(time.time())
+
+    def _droppedFrames(self, index, recorder, stats):
+        """
+        Frames dropped by camera and writer of recorder since previous call
+        """
+        cameraDropped = getattr(recorder.cap, "droppedFrames", 0)
+        writerDropped = stats["writerDroppedFrames"]
+        (prevCameraDropped, prevWriterDropped) = self._dropCounters[index]
+        self._dropCounters[index] = (cameraDropped, writerDropped)
+
+        return counterDelta(prevCameraDropped, cameraDropped) + counterDelta(prevWriterDropped, writerDropped)
+
+    def _totals(self, now):
+        """
+        Totals of recorders counters, except of dropped frames which are counted since previous call
+        """
+        totals = {
+            "time": now,
+            "frames": 0,
+            "dropped": 0,
+            "writerQueue": 0,
+            "triggerLatency": None,
+            "bytes": self.sink.bytesQty,
+            "clips": self.sink.clipsQty,
+        }
+        totals.update((stage, 0.0) for stage in STAGES)
+
+        for (index, recorder) in enumerate(self.recorders):
+            stats = recorder.getStats()
+            totals["frames"] += stats["processedFrames"]
+            totals["dropped"] += self._droppedFrames(index, recorder, stats)
+            totals["writerQueue"] += stats["writerQueueSize"]
+            for stage in STAGES:
+                totals[stage] += stats["stageSeconds"][stage]
+
+            latency = stats["lastTriggerLatency"]
+            if (latency is not None) and ((totals["triggerLatency"] is None) or (latency > totals["triggerLatency"])):
+                totals["triggerLatency"] = latency
+
+        return totals
+
+    def sample(self):
+        current = self._totals(time.time())
+        previous = self._previous
+        self._previous = current
+
+        seconds = current["time"] - previous["time"]
+        frames = current["frames"] - previous["frames"]
+
+        row = {
+            "elapsed_seconds": round(current["time"] - self.started, 1),
+            "rss_mb": residentMegabytes(),
+            "open_fds": openFilesQty(),
+            "threads": threading.active_count(),
+            "fps": frames / seconds,
+            "dropped_frames": current["dropped"],
+            "writer_queue": current["writerQueue"],
+            "trigger_latency": current["triggerLatency"],
+            "clips": current["clips"] - previous["clips"],
+            "disk_mb_per_s": (current["bytes"] - previous["bytes"]) / seconds / float(1024 ** 2),
+        }
+
+        for stage in STAGES:
+            spent = current[stage] - previous[stage]
+            row[stage + "_ms"] = 1000.0 * spent / frames if frames > 0 else None
+
+        return row
+
+
+def writeSeries(fileName, rows):
+    with open(fileName, "w") as f:
+        writer = csv.DictWriter(f, COLUMNS, lineterminator="\n")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def readSeries(fileName):
+    rows = []
+    with open(fileName) as f:
+        for row in csv.DictReader(f):
+            rows.append(dict((name, float(value) if value != "" else None) for (name, value) in row.items()))
+
+    return rows
+
+
+def growthPerHour(rows, column):
+    """
+    Least squares slope of column in units per hour, first quarter of series (buffers filling, writers
+    warm-up) isn't used
+    """
+    points = [(row["elapsed_seconds"], row[column]) for row in rows[len(rows) // 4:] if row[column] is not None]
+    if len(points) < 2:
+        return None
+
+    meanX = sum(x for (x, _) in points) / float(len(points))
+    meanY = sum(y for (_, y) in points) / float(len(points))
+    variance = sum((x - meanX) ** 2 for (x, _) in points)
+    if variance == 0:
+        return None
+
+    return 3600.0 * sum((x - meanX) * (y - meanY) for (x, y) in points) / variance
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / float(len(values)) if len(values) > 0 else None
+
+
+def percentile(values, share):
+    values = sorted(value for value in values if value is not None)
+    if len(values) == 0:
+        return None
+
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def summarize(rows):
+    """
+    Reduces time series to metrics which are compared with baseline
+    """
+    framesQty = sum(row["fps"] * row["elapsed_seconds"] for row in rows[:1]) + sum(
+        row["fps"] * (row["elapsed_seconds"] - prev["elapsed_seconds"]) for (prev, row) in zip(rows, rows[1:])
+    )
+    droppedQty = sum(row["dropped_frames"] for row in rows)
+
+    summary = {
+        "samples": len(rows),
+        "duration_hours": rows[-1]["elapsed_seconds"] / 3600.0 if len(rows) > 0 else 0,
+        "rss_max_mb": max(row["rss_mb"] for row in rows) if len(rows) > 0 else None,
+        "rss_growth_mb_per_hour": growthPerHour(rows, "rss_mb"),
+        "open_fds_growth_per_hour": growthPerHour(rows, "open_fds"),
+        "threads_growth_per_hour": growthPerHour(rows, "threads"),
+        "fps": mean(row["fps"] for row in rows),
+        "drop_rate": droppedQty / (framesQty + droppedQty) if framesQty + droppedQty > 0 else 0,
+        "trigger_latency_p95": percentile((row["trigger_latency"] for row in rows), 0.95),
+        "disk_mb_per_s": mean(row["disk_mb_per_s"] for row in rows),
+    }
+
+    for stage in ["detect", "record"]:
+        summary[stage + "_ms_mean"] = mean(row[stage + "_ms"] for row in rows)
+        summary[stage + "_ms_p95"] = percentile((row[stage + "_ms"] for row in rows), 0.95)
+
+    return summary
+
+
+def compareWithBaseline(summary, baseline, tolerance):
+    """
+    Compares metrics with baseline, metric is regressed when it's worse than baseline by more than
+    tolerance (share of baseline value) and more than min absolute change of metric
+
+    :return: list of tuples (metric, baseline value, current value, True when regressed)
+    """
+    results = []
+    for (name, higherIsBetter, minChange) in METRICS:
+        (expected, actual) = (baseline.get(name), summary.get(name))
+        if (expected is None) or (actual is None):
+            results.append((name, expected, actual, False))
+            continue
+
+        change = (expected - actual) if higherIsBetter else (actual - expected)
+        regressed = change > max(minChange, tolerance * abs(expected))
+        results.append((name, expected, actual, regressed))
+
+    return results
+
+
+def printReport(summary, baseline, tolerance):
+    """
+    :return: True when there are regressions
+    """
+    print("duration: {:.2f} hours, {} samples".format(summary["duration_hours"], summary["samples"]))
+
+    if baseline is None:
+        for (name, _, _) in METRICS:
+            print("{:<26} {}".format(name, summary.get(name)))
+        return False
+
+    results = compareWithBaseline(summary, baseline, tolerance)
+    print("{:<26} {:>12} {:>12}".format("metric", "baseline", "current"))
+    for (name, expected, actual, regressed) in results:
+        print("{:<26} {:>12} {:>12}  {}".format(name, formatValue(expected), formatValue(actual), "REGRESSION" if regressed else "ok"))
+
+    return any(regressed for (_, _, _, regressed) in results)
+
+
+def formatValue(value):
+    return "-" if value is None else "{:.3f}".format(value)
+
+
+def cameraUrl(args, index):
+    url = "fake://synthetic?width={}&height={}&fps={}&motion={}&seed={}".format(
+        args.width, args.height, args.fps, args.motion, index
+    )
+    return url + "&" + args.faults if args.faults else url
+
+
+def runSoak(logger, args, outputDirectory):
+    """
+    Runs recorders with fake cameras and writes sample of resources and statistics to series file
+    each interval
+
+    :return: list of samples
+    """
+    sink = ClipSink(args.keep_clips)
+    recorders = []
+    threads = []
+    for i in range(args.cameras):
+        recorder = MotionDrivenRecorder(cameraUrl(args, i), logger)
+        recorder.cameraName = "cam{}".format(i)
+        recorder.outputDirectory = outputDirectory
+        recorder.preAlarmRecordingSecondsQty = config.PRE_ALARM_RECORDING_SECONDS
+        recorder.clipListeners.append(sink.onClipClosed)
+        recorders.append(recorder)
+
+        thread = threading.Thread(target=recorder.start)
+        thread.start()
+        threads.append(thread)
+
+    sampler = SoakSampler(recorders, sink)
+    rows = []
+    deadline = time.time() + args.hours * 3600
+    try:
+        while time.time() < deadline:
+            time.sleep(max(0, min(args.interval, deadline - time.time())))
+            rows.append(sampler.sample())
+
+            # series is rewritten after each sample, so it's available when test is interrupted
+            writeSeries(args.output, rows)
+            row = rows[-1]
+            print("{:>8.0f} s: rss {:.1f} MB, fds {}, threads {}, {:.1f} fps, detect {} ms, record {} ms".format(
+                row["elapsed_seconds"], row["rss_mb"] or 0, row["open_fds"], row["threads"], row["fps"],
+                formatValue(row["detect_ms"]), formatValue(row["record_ms"])
+            ))
+    finally:
+        for recorder in recorders:
+            recorder.add_stop_request()
+
+        for thread in threads:
+            thread.join()
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs recorders against fake cameras for hours and tracks memory and latency regressions")
+    parser.add_argument("--hours", default=4, type=float, help="duration of test")
+    parser.add_argument("--interval", default=60, type=int, help="seconds between samples")
+    parser.add_argument("--cameras", default=4, type=int, help="count of cameras")
+    parser.add_argument("--width", default=1280, type=int, help="frame width")
+    parser.add_argument("--height", default=720, type=int, help="frame height")
+    parser.add_argument("--fps", default=15, type=float, help="frame rate of each camera")
+    parser.add_argument("--motion", default=0.2, type=float, help="share of time with motion")
+    parser.add_argument("--faults", default="", help="fault parameters of fake cameras, for example disconnect=3600&stall=600")
+    parser.add_argument("--clip-seconds", default=60, type=int, help="max clip duration, short clips exercise writers churn")
+    parser.add_argument("--keep-clips", action="store_true", help="don't remove closed clips")
+    parser.add_argument("--output", default="soak.csv", help="time series file")
+    parser.add_argument("--report", default=None, help="only report on existing time series file")
+    parser.add_argument("--baseline", default=None, help="baseline JSON file to compare with")
+    parser.add_argument("--save-baseline", default=None, help="save summary of this run as baseline JSON file")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="allowed share of metric change before it's reported as regression")
+    args = parser.parse_args()
+
+    if args.report is not None:
+        rows = readSeries(args.report)
+    else:
+        logger = init_logger()
+
+        # recorders log every frame with motion, so only warnings are logged during test
+        logger.setLevel(logging.WARNING)
+        config.MAX_CLIP_DURATION_SECONDS = args.clip_seconds
+
+        outputDirectory = tempfile.mkdtemp(prefix="pynvr_soak_")
+        try:
+            rows = runSoak(logger, args, outputDirectory)
+        finally:
+            if not args.keep_clips:
+                shutil.rmtree(outputDirectory, ignore_errors=True)
+
+    if len(rows) == 0:
+        print("no samples")
+        return 1
+
+    summary = summarize(rows)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    return 1 if printReport(summary, baseline, args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    ret = main()
+    exit(ret)
@@ -0,0 +1,271 @@
+import os
+import json
+import threading
+import config
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def validatePositiveNumber(value, name):
+    if isinstance(value, bool) or (not isinstance(value, (int, long, float))) or (value <= 0):
+        raise ConfigError("{}: positive number expected".format(name))
+
+    return value
+
+
+def validateNonNegativeNumber(value, name):
+    if isinstance(value, bool) or (not isinstance(value, (int, long, float))) or (value < 0):
+        raise ConfigError("{}: non-negative number expected".format(name))
+
+    return value
+
+
+def validateOneOf(value, values, name):
+    if value not in values:
+        raise ConfigError("{}: one of {} expected".format(name, ", ".join(values)))
+
+    return str(value)
+
+
+def validateGroup(value, name):
+    """
+    Validates group of settings, missing group is empty
+
+    :return: dictionary
+    """
+    if value is None:
+        return {}
+
+    if not isinstance(value, dict):
+        raise ConfigError("{}: object expected".format(name))
+
+    return value
+
+
+def validateZones(value, name = "zones"):
+    """
+    Validates list of zones, each zone is list of x0, y0, x1, y1 in relative frame coordinates
+
+    :return: list of tuples or None (whole frame)
+    """
+    if value is None:
+        return None
+
+    if not isinstance(value, list):
+        raise ConfigError("{}: list expected".format(name))
+
+    zones = []
+    for zone in value:
+        if (not isinstance(zone, list)) or (len(zone) != 4):
+            raise ConfigError("{}: zone must be list of x0, y0, x1, y1".format(name))
+
+        for item in zone:
+            if isinstance(item, bool) or (not isinstance(item, (int, long, float))) or (not (0 <= item <= 1)):
+                raise ConfigError("{}: zone coordinates must be in range 0.0 - 1.0".format(name))
+
+        # empty zone would silently disable detection
+        (x0, y0, x1, y1) = zone
+        if (x0 >= x1) or (y0 >= y1):
+            raise ConfigError("{}: zone must have x0 < x1 and y0 < y1".format(name))
+
+        zones.append(tuple(zone))
+
+    return zones
+
+
+class CameraConfig:
+    """
+    Settings of single camera. Settings are grouped, so only changed group is re-applied to recorder.
+    """
+
+    RECORDING_MODES = ["motion", "continuous"]
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+
+        # detector settings, threshold None - detector default
+        self.threshold = None
+        self.zones = None
+
+        # recording settings
+        self.recordingMode = config.RECORDING_MODE
+        self.segmentDurationSeconds = config.SEGMENT_DURATION_SECONDS
+        self.preAlarmSeconds = config.PRE_ALARM_RECORDING_SECONDS
+        self.snapshotsQty = config.SNAPSHOTS_QTY
+        self.memoryBudgetBytes = config.CAMERA_MEMORY_BUDGET_BYTES
+
+    def captureSettings(self):
+        return (self.connection,)
+
+    def detectorSettings(self):
+        return (self.threshold, self.zones)
+
+    def recordingSettings(self):
+        return (self.recordingMode, self.segmentDurationSeconds, self.preAlarmSeconds, self.snapshotsQty, self.memoryBudgetBytes)
+
+    def __eq__(self, other):
+        if not isinstance(other, CameraConfig):
+            return False
+
+        settings = (self.name, self.captureSettings(), self.detectorSettings(), self.recordingSettings())
+        return settings == (other.name, other.captureSettings(), other.detectorSettings(), other.recordingSettings())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @staticmethod
+    def fromDict(data):
+        """
+        Creates camera settings from dictionary, missing settings are taken from config.py
+
+        :param data: dictionary with "name", "connection" and optional "detector" and "recording" groups
+        :return: CameraConfig
+        """
+        if not isinstance(data, dict):
+            raise ConfigError("camera settings must be object")
+
+        name = data.get("name")
+        if (not isinstance(name, basestring)) or (len(name) == 0):
+            raise ConfigError("camera name expected")
+
+        connection = data.get("connection")
+        if not isinstance(connection, (int, long, basestring)):
+            raise ConfigError("{}: camera connection string or index expected".format(name))
+
+        cameraConfig = CameraConfig(str(name), connection)
+
+        detector = validateGroup(data.get("detector"), name + ".detector")
+        if "threshold" in detector:
+            cameraConfig.threshold = validatePositiveNumber(detector["threshold"], name + ".detector.threshold")
+        cameraConfig.zones = validateZones(detector.get("zones"), name + ".detector.zones")
+
+        recording = validateGroup(data.get("recording"), name + ".recording")
+        cameraConfig.recordingMode = validateOneOf(
+            recording.get("mode", cameraConfig.recordingMode), CameraConfig.RECORDING_MODES, name + ".recording.mode"
+        )
+        cameraConfig.segmentDurationSeconds = validatePositiveNumber(
+            recording.get("segmentDurationSeconds", cameraConfig.segmentDurationSeconds), name + ".recording.segmentDurationSeconds"
+        )
+        cameraConfig.preAlarmSeconds = validateNonNegativeNumber(
+            recording.get("preAlarmSeconds", cameraConfig.preAlarmSeconds), name + ".recording.preAlarmSeconds"
+        )
+        cameraConfig.snapshotsQty = int(validateNonNegativeNumber(
+            recording.get("snapshotsQty", cameraConfig.snapshotsQty), name + ".recording.snapshotsQty"
+        ))
+        cameraConfig.memoryBudgetBytes = int(validateNonNegativeNumber(
+            recording.get("memoryBudgetBytes", cameraConfig.memoryBudgetBytes), name + ".recording.memoryBudgetBytes"
+        ))
+
+        return cameraConfig
+
+
+def defaultCamerasConfig():
+    """
+    Returns settings of single camera from config.py
+    """
+    return [CameraConfig(config.CAMERA_NAME, config.cam)]
+
+
+def loadCamerasConfig(fileName):
+    """
+    Loads and validates cameras settings file
+
+    :param fileName: JSON file with list of cameras in "cameras"
+    :return: list of CameraConfig
+    """
+    try:
+        with open(fileName, "r") as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise ConfigError("can't load {}: {}".format(fileName, e))
+
+    if (not isinstance(data, dict)) or (not isinstance(data.get("cameras"), list)):
+        raise ConfigError("list of cameras expected in \"cameras\"")
+
+    cameras = [CameraConfig.fromDict(item) for item in data["cameras"]]
+
+    names = [camera.name for camera in cameras]
+    if len(set(names)) != len(names):
+        raise ConfigError("camera names must be unique")
+
+    return cameras
+
+
+class CameraConfigWatcher(threading.Thread):
+    """
+    Polls modification time of cameras settings file and reloads it when it's changed. Invalid file is
+    ignored (current settings are kept). For each added, changed or removed camera corresponding callback
+    is called: onCameraAdded(new), onCameraChanged(old, new), onCameraRemoved(old).
+    """
+
+    def __init__(self, logger, fileName, cameras, checkIntervalSeconds = 5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self.fileName = fileName
+        self.checkIntervalSeconds = checkIntervalSeconds
+
+        # camera name -> CameraConfig
+        self.cameras = dict((camera.name, camera) for camera in cameras)
+
+        self.onCameraAdded = None
+        self.onCameraChanged = None
+        self.onCameraRemoved = None
+
+        self._fileState = self._readFileState()
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def _readFileState(self):
+        try:
+            st = os.stat(self.fileName)
+        except OSError:
+            return None
+
+        return (st.st_mtime, st.st_size)
+
+    def check(self):
+        """
+        Reloads settings file when it's changed
+        :return: True when settings were reloaded, otherwise False
+        """
+        state = self._readFileState()
+        if (state is None) or (state == self._fileState):
+            return False
+
+        self._fileState = state
+
+        try:
+            cameras = loadCamerasConfig(self.fileName)
+        except ConfigError as e:
+            self.logger.error("invalid cameras settings, changes ignored: {}".format(e))
+            return False
+
+        self.logger.info("cameras settings changed: {}".format(self.fileName))
+        self._applyChanges(dict((camera.name, camera) for camera in cameras))
+        return True
+
+    def _applyChanges(self, cameras):
+        for (name, camera) in cameras.items():
+            old = self.cameras.get(name)
+            if old is None:
+                self.onCameraAdded(camera)
+            elif old != camera:
+                self.onCameraChanged(old, camera)
+
+        for (name, camera) in self.cameras.items():
+            if name not in cameras:
+                self.onCameraRemoved(camera)
+
+        self.cameras = cameras
+
+    def run(self):
+        while not self._stopEvent.is_set():
+            self._stopEvent.wait(self.checkIntervalSeconds)
+            self.check()
@@ -2,6 +2,12 @@ import datetime as dts
 from system.shared import LastErrorHolder
 import time
 import cv2 as cv
+import config
+from system.fake_camera import FakeCamera, isFakeCameraUrl
+
+
+# frame rates above this value reported by camera are treated as invalid
+MAX_CAMERA_FPS = 240
 
 
 class CameraConnectionSupport(LastErrorHolder):
@@ -40,6 +46,22 @@ class CameraConnectionSupport(LastErrorHolder):
 
         pass
 
+    def cameraFps(self):
+        """
+        Returns frame rate reported by camera. Many RTSP cameras report 0, NaN or RTP clock rate (90000)
+        instead of frame rate, OUTPUT_FRAME_RATE is used in this case, so pre-alarm buffer stays bounded.
+
+        :return: frame rate
+        """
+        fps = self.cap.get(cv.CAP_PROP_FPS) if self.cap is not None else None
+
+        # NaN fails both comparisons
+        if (fps is not None) and (0 < fps <= MAX_CAMERA_FPS):
+            return fps
+
+        self.logger.warning("camera reported invalid FPS = {}, using {}".format(fps, config.OUTPUT_FRAME_RATE))
+        return float(config.OUTPUT_FRAME_RATE)
+
     def _initCamera(self, callSleep = True):
         """
         Initializes camera. If can't establish connection will write error message to log file and sleep for some
@@ -47,7 +69,10 @@ class CameraConnectionSupport(LastErrorHolder):
 
         :return: True when camera successfully open, otherwise False
         """
-        self.cap = cv.VideoCapture(self.camConnectionString)
+        if isFakeCameraUrl(self.camConnectionString):
+            self.cap = FakeCamera(self.camConnectionString)
+        else:
+            self.cap = cv.VideoCapture(self.camConnectionString)
 
         if self.cap is None:
             self.setError("can't connect to camera")
@@ -0,0 +1,211 @@
+import os
+import time
+import tempfile
+import subprocess
+import config
+from system.clip_metadata import ClipMetadata
+
+
+class ExportPart:
+    """
+    Part of clip included to export, offsets are in seconds of video time
+    """
+    def __init__(self, path, inpoint, outpoint):
+        self.path = path
+        self.inpoint = inpoint
+        self.outpoint = outpoint
+
+
+def _videoScale(clip):
+    """
+    Returns ratio of video duration to wall-clock duration of clip. Video is written with OUTPUT_FRAME_RATE,
+    which may differ from camera frame rate.
+    """
+    wallDuration = (clip.endDts - clip.startDts).total_seconds()
+    if (clip.frames <= 0) or (wallDuration <= 0):
+        return 1.0
+
+    return (float(clip.frames) / config.OUTPUT_FRAME_RATE) / wallDuration
+
+
+def _videoOffsetFunc(clip):
+    """
+    Returns function which maps DTS to position in clip video (seconds). Segments saved in clip metadata are
+    used when available, so pauses inside merged clips are skipped.
+    """
+    metadata = ClipMetadata.load(clip.path)
+    if (metadata is not None) and (len(metadata.segments) > 0):
+        return metadata.videoOffset
+
+    scale = _videoScale(clip)
+    return lambda value: (value - clip.startDts).total_seconds() * scale
+
+
+def exportParts(clips, startDts, endDts):
+    """
+    Maps time range to parts of clips
+
+    :param clips: list of ClipRecord ordered by start, see RecordingIndex.findClips()
+    :param startDts: range start (UTC)
+    :param endDts: range end (UTC)
+    :return: list of ExportPart, inpoint or outpoint is None when whole clip start or end is included
+    """
+    parts = []
+    for clip in clips:
+        if (clip.endDts <= startDts) or (clip.startDts >= endDts):
+            continue
+
+        videoOffset = _videoOffsetFunc(clip)
+
+        inpoint = None
+        if startDts > clip.startDts:
+            inpoint = videoOffset(startDts)
+
+        outpoint = None
+        if endDts < clip.endDts:
+            outpoint = videoOffset(endDts)
+
+        parts.append(ExportPart(clip.path, inpoint, outpoint))
+
+    return parts
+
+
+def _quote(path):
+    return "'{}'".format(path.replace("'", "'\\''"))
+
+
+def writeConcatList(parts, fileName):
+    """
+    Writes list for ffmpeg concat demuxer
+    """
+    with open(fileName, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for part in parts:
+            f.write("file {}\n".format(_quote(os.path.abspath(part.path))))
+            if part.inpoint is not None:
+                f.write("inpoint {:.3f}\n".format(part.inpoint))
+            if part.outpoint is not None:
+                f.write("outpoint {:.3f}\n".format(part.outpoint))
+
+
+def _duration(part):
+    return part.outpoint - (part.inpoint if part.inpoint is not None else 0.0)
+
+
+class ClipExporter:
+    """
+    Exports time range of camera recordings into single file. Clips are located with recording index, cut and
+    concatenated by ffmpeg with stream copy, so nothing is decoded. With stream copy cuts are at keyframes:
+    export starts from the nearest keyframe before range start. Clips with different codecs (only part of them
+    was transcoded by post-processing) can't be concatenated with stream copy, such export is re-encoded.
+    """
+
+    def __init__(self, logger, index, ffmpeg = "ffmpeg", ffprobe = "ffprobe"):
+        self.logger = logger
+        self.index = index
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+
+        self.lastExportedBytes = 0
+        self.lastThroughput = None
+
+    def export(self, camera, startDts, endDts, outputFileName):
+        """
+        Exports time range into file
+
+        :param camera: camera name
+        :param startDts: range start (UTC)
+        :param endDts: range end (UTC)
+        :param outputFileName: output file name, container is selected by extension
+        :return: True on success, otherwise False
+        """
+        parts = exportParts(self.index.findClips(camera, startDts, endDts), startDts, endDts)
+        if len(parts) == 0:
+            self.logger.error("no recordings of camera {} in range {} - {}".format(camera, startDts, endDts))
+            return False
+
+        started = time.time()
+        if self._hasMixedCodecs(parts):
+            self.logger.warning("exported clips have different codecs, export is re-encoded")
+            code = self._runFfmpegReencode(parts, outputFileName)
+        else:
+            code = self._copyParts(parts, outputFileName)
+
+        if code != 0:
+            self.logger.error("export failed, ffmpeg exit code: {}".format(code))
+            return False
+
+        self.lastExportedBytes = os.path.getsize(outputFileName)
+        elapsed = time.time() - started
+        if elapsed > 0:
+            self.lastThroughput = self.lastExportedBytes / elapsed
+
+        self.logger.info("exported {} clips to {} ({} bytes)".format(len(parts), outputFileName, self.lastExportedBytes))
+        return True
+
+    def _codecName(self, path):
+        """
+        Returns codec of video stream of clip or None when it can't be read
+        """
+        command = [
+            self.ffprobe, "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", path
+        ]
+
+        try:
+            with open(os.devnull, "wb") as devnull:
+                output = subprocess.check_output(command, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.warning("can't read codec of {}: {}".format(path, e))
+            return None
+
+        return output.strip() or None
+
+    def _hasMixedCodecs(self, parts):
+        # when codec of clip can't be read stream copy isn't safe
+        codecs = set(self._codecName(part.path) for part in parts)
+        return (None in codecs) or (len(codecs) > 1)
+
+    def _copyParts(self, parts, outputFileName):
+        (handle, listFileName) = tempfile.mkstemp(suffix=".ffconcat")
+        os.close(handle)
+
+        try:
+            writeConcatList(parts, listFileName)
+            return self._runFfmpeg(listFileName, outputFileName)
+        finally:
+            os.remove(listFileName)
+
+    def _runFfmpegReencode(self, parts, outputFileName):
+        """
+        Cuts parts on input and joins them with concat filter, so each clip is decoded with its own codec
+        """
+        command = [self.ffmpeg, "-nostdin", "-loglevel", "error", "-y"]
+        for part in parts:
+            if part.inpoint is not None:
+                command += ["-ss", "{:.3f}".format(part.inpoint)]
+            if part.outpoint is not None:
+                command += ["-t", "{:.3f}".format(_duration(part))]
+            command += ["-i", os.path.abspath(part.path)]
+
+        inputs = "".join("[{}:v:0]".format(index) for index in range(len(parts)))
+        command += ["-filter_complex", "{}concat=n={}:v=1:a=0[v]".format(inputs, len(parts)), "-map", "[v]"]
+        command += config.EXPORT_REENCODE_ARGS + [outputFileName]
+
+        return self._call(command)
+
+    def _call(self, command):
+        try:
+            return subprocess.call(command)
+        except OSError as e:
+            self.logger.error("can't run ffmpeg: {}".format(e))
+            return -1
+
+    def _runFfmpeg(self, listFileName, outputFileName):
+        command = [
+            self.ffmpeg, "-nostdin", "-loglevel", "error", "-y",
+            "-f", "concat", "-safe", "0", "-i", listFileName,
+            "-c", "copy", outputFileName
+        ]
+
+        return self._call(command)
@@ -0,0 +1,311 @@
+import os
+import json
+import datetime as dts
+import config
+
+
+DTS_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# container of clips transcoded to video codec (see POST_PROCESSING_FFMPEG_ARGS), clips transcoded to other
+# codecs keep container of recorder output (OUTPUT_FILES_EXTENSION)
+CODEC_EXTENSIONS = {
+    "libx264": ".mp4",
+    "h264": ".mp4",
+    "libx265": ".mp4",
+    "hevc": ".mp4",
+    "libvpx": ".webm",
+    "libvpx-vp9": ".webm",
+}
+
+
+def isClipFileName(fileName):
+    """
+    Checks that file is clip: output of recorder or clip transcoded by post-processing
+
+    :param fileName: file name
+    :return: True for clip file
+    """
+    return fileName.endswith(tuple(set(CODEC_EXTENSIONS.values()) | {config.OUTPUT_FILES_EXTENSION}))
+
+
+def metadataFileName(clipFileName):
+    """
+    Returns name of metadata file (sidecar) for clip
+
+    :param clipFileName: clip file name
+    :return: metadata file name
+    """
+    return os.path.splitext(clipFileName)[0] + ".json"
+
+
+def sidecarFileNames(clipFileName):
+    """
+    Returns names of existing files which belong to clip (metadata and other files with the same name
+    but different extension)
+
+    :param clipFileName: clip file name
+    :return: list of file names
+    """
+    (dirName, baseName) = os.path.split(clipFileName)
+    prefix = os.path.splitext(baseName)[0] + "."
+
+    try:
+        names = os.listdir(dirName)
+    except OSError:
+        return []
+
+    return [os.path.join(dirName, name) for name in names if name.startswith(prefix) and (name != baseName)]
+
+
+def formatDts(value):
+    if value is None:
+        return None
+
+    return value.strftime(DTS_FORMAT)
+
+
+def parseDts(value):
+    if value is None:
+        return None
+
+    return dts.datetime.strptime(value, DTS_FORMAT)
+
+
+class MotionRange:
+    """
+    Time range with motion inside clip and motion scores in it
+    """
+    def __init__(self, startDts, endDts = None):
+        self.startDts = startDts
+        self.endDts = endDts if endDts is not None else startDts
+
+        self.peakScore = 0
+        self.scoresSum = 0.0
+        self.scoresQty = 0
+
+    @property
+    def meanScore(self):
+        if self.scoresQty == 0:
+            return 0
+
+        return self.scoresSum / self.scoresQty
+
+    def addScore(self, score):
+        self.peakScore = max(self.peakScore, score)
+        self.scoresSum += score
+        self.scoresQty += 1
+
+    def toList(self):
+        return [formatDts(self.startDts), formatDts(self.endDts), self.peakScore, self.meanScore]
+
+    @staticmethod
+    def fromList(data):
+        motionRange = MotionRange(parseDts(data[0]), parseDts(data[1]))
+        if len(data) > 3:
+            motionRange.peakScore = data[2]
+            motionRange.scoresSum = data[3]
+            motionRange.scoresQty = 1
+
+        return motionRange
+
+
+class ClipSegment:
+    """
+    Continuously recorded part of clip: wall-clock range and matching range of position in video (seconds).
+    Clip with merged motion-events has a segment for each event, pauses between them aren't recorded.
+    """
+    def __init__(self, startDts, videoStart):
+        self.startDts = startDts
+        self.endDts = startDts
+        self.videoStart = videoStart
+        self.videoEnd = videoStart
+
+    def videoOffset(self, value):
+        duration = (self.endDts - self.startDts).total_seconds()
+        if duration <= 0:
+            return self.videoStart
+
+        ratio = min(1.0, max(0.0, (value - self.startDts).total_seconds() / duration))
+        return self.videoStart + ratio * (self.videoEnd - self.videoStart)
+
+    def toList(self):
+        return [formatDts(self.startDts), formatDts(self.endDts), self.videoStart, self.videoEnd]
+
+    @staticmethod
+    def fromList(data):
+        segment = ClipSegment(parseDts(data[0]), data[2])
+        segment.endDts = parseDts(data[1])
+        segment.videoEnd = data[3]
+        return segment
+
+
+class ClipMetadata:
+    """
+    Holds information about single output file (clip or segment) and motion-events inside it
+    """
+
+    # motions with gap less than this count of seconds are merged into one range
+    MOTION_RANGE_GAP_SECONDS = 1.0
+
+    def __init__(self, cameraName = None, startDts = None):
+        self.cameraName = cameraName
+        self.startDts = startDts
+        self.endDts = None
+        self.framesCount = 0
+
+        # list of MotionRange
+        self.motionRanges = []
+
+        # motion scores of all frames where detection was performed
+        self.peakScore = 0
+        self.scoresSum = 0.0
+        self.scoresQty = 0
+
+        # names of snapshot files (in the same directory as clip)
+        self.snapshots = []
+
+        # list of ClipSegment, empty for clips recorded before segments were saved
+        self.segments = []
+
+    @property
+    def hasMotion(self):
+        return len(self.motionRanges) > 0
+
+    @property
+    def meanScore(self):
+        if self.scoresQty == 0:
+            return 0
+
+        return self.scoresSum / self.scoresQty
+
+    def addScore(self, score):
+        """
+        Adds motion score of frame
+
+        :param score: motion score calculated by detector
+        :return: None
+        """
+        self.peakScore = max(self.peakScore, score)
+        self.scoresSum += score
+        self.scoresQty += 1
+
+    def addMotion(self, motionDts, score = None):
+        """
+        Marks moment of time as moment with motion
+
+        :param motionDts: DTS when motion detected
+        :param score: motion score calculated by detector
+        :return: None
+        """
+        motionRange = None
+        if len(self.motionRanges) > 0:
+            lastRange = self.motionRanges[-1]
+            gap = (motionDts - lastRange.endDts).total_seconds()
+            if gap <= self.MOTION_RANGE_GAP_SECONDS:
+                motionRange = lastRange
+                motionRange.endDts = motionDts
+
+        if motionRange is None:
+            motionRange = MotionRange(motionDts)
+            self.motionRanges.append(motionRange)
+
+        if score is not None:
+            motionRange.addScore(score)
+
+    def addSegment(self, startDts, videoStart):
+        """
+        Starts new continuously recorded part of clip
+
+        :param startDts: DTS of the first frame of part
+        :param videoStart: position of the first frame in video (seconds)
+        :return: None
+        """
+        self.segments.append(ClipSegment(startDts, videoStart))
+
+    def extendSegment(self, frameDts, videoOffset):
+        """
+        Adds frame to the last part of clip
+
+        :param frameDts: DTS of frame
+        :param videoOffset: position of frame in video (seconds)
+        :return: None
+        """
+        segment = self.segments[-1]
+        segment.endDts = frameDts
+        segment.videoEnd = videoOffset
+
+    def videoOffset(self, value):
+        """
+        Maps DTS to position in video, DTS in pause between merged motion-events is mapped to the start
+        of the next part
+
+        :param value: DTS
+        :return: position in seconds or None when clip has no segments
+        """
+        if len(self.segments) == 0:
+            return None
+
+        for segment in self.segments:
+            if value < segment.startDts:
+                return segment.videoStart
+
+            if value <= segment.endDts:
+                return segment.videoOffset(value)
+
+        return self.segments[-1].videoEnd
+
+    def toDict(self):
+        return {
+            "camera": self.cameraName,
+            "start": formatDts(self.startDts),
+            "end": formatDts(self.endDts),
+            "framesCount": self.framesCount,
+            "peakScore": self.peakScore,
+            "meanScore": self.meanScore,
+            "hasMotion": self.hasMotion,
+            "motionRanges": [motionRange.toList() for motionRange in self.motionRanges],
+            "snapshots": self.snapshots,
+            "segments": [segment.toList() for segment in self.segments],
+        }
+
+    @staticmethod
+    def fromDict(data):
+        metadata = ClipMetadata(data.get("camera"), parseDts(data.get("start")))
+        metadata.endDts = parseDts(data.get("end"))
+        metadata.framesCount = data.get("framesCount", 0)
+        metadata.peakScore = data.get("peakScore", 0)
+        metadata.scoresSum = data.get("meanScore", 0)
+        metadata.scoresQty = 1
+        metadata.motionRanges = [MotionRange.fromList(item) for item in data.get("motionRanges", [])]
+        metadata.snapshots = data.get("snapshots", [])
+        metadata.segments = [ClipSegment.fromList(item) for item in data.get("segments", [])]
+        return metadata
+
+    def save(self, clipFileName):
+        """
+        Saves metadata to sidecar file next to clip
+
+        :param clipFileName: clip file name
+        :return: True on success, otherwise False
+        """
+        try:
+            with open(metadataFileName(clipFileName), "w") as f:
+                json.dump(self.toDict(), f)
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    @staticmethod
+    def load(clipFileName):
+        """
+        Loads metadata from sidecar file
+
+        :param clipFileName: clip file name
+        :return: ClipMetadata or None when metadata is not available
+        """
+        try:
+            with open(metadataFileName(clipFileName), "r") as f:
+                return ClipMetadata.fromDict(json.load(f))
+        except (IOError, OSError, ValueError):
+            return None
@@ -0,0 +1,271 @@
+import os
+import time
+import threading
+import Queue
+import config
+from system.shared import mkdir_p, uniqueFileName
+from system.clip_metadata import ClipMetadata, sidecarFileNames, isClipFileName
+
+
+class MoveTask:
+    def __init__(self, fileName, metadata):
+        self.fileName = fileName
+        self.metadata = metadata
+        self.attempts = 0
+
+        # archive root and name are selected once, so retry moves rest of files next to already moved ones
+        self.dstFileName = None
+
+        # failed task isn't retried before this time
+        self.notBefore = 0
+
+
+class ClipMover(threading.Thread):
+    """
+    Moves finished clips (with their sidecar files) from fast local staging directory to archive roots.
+    Uses atomic rename when destination is on the same device, otherwise copies file with bandwidth limit.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, logger, stagingPath, archiveRoots):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self.stagingPath = stagingPath
+        self.archiveRoots = archiveRoots
+
+        # max bytes per second for copying between devices (0 - unlimited)
+        self.bandwidthLimit = config.MOVER_BANDWIDTH_LIMIT
+        self.maxRetries = config.MOVER_MAX_RETRIES
+        self.retryIntervalSeconds = config.MOVER_RETRY_INTERVAL_SECONDS
+
+        # functions which will be called for each moved clip: listener(fileName, metadata)
+        self.clipListeners = []
+
+        # functions which will be called with staging and archive name of each moved clip before clipListeners:
+        # listener(srcFileName, dstFileName)
+        self.moveListeners = []
+
+        self.movedFilesCount = 0
+        self.movedBytes = 0
+        self.failedFilesCount = 0
+        self.lastThroughput = None
+
+        self._queue = Queue.Queue()
+        # failed tasks waiting for retry, ordered by notBefore
+        self._retries = []
+        self._stopEvent = threading.Event()
+
+    def enqueue(self, fileName, metadata):
+        """
+        Adds finished clip to moving queue, can be used as recorder clip listener
+
+        :param fileName: clip file name in staging directory
+        :param metadata: ClipMetadata or None
+        :return: None
+        """
+        self._queue.put(MoveTask(fileName, metadata))
+
+    def findLeftovers(self):
+        """
+        Finds clips which were finished but not moved (for example, before restart)
+        :return: list of (fileName, metadata)
+        """
+        leftovers = []
+        for (root, dirs, files) in os.walk(self.stagingPath):
+            for fileName in files:
+                # hidden files are pending or temporary files of writer and post-processor
+                if (not isClipFileName(fileName)) or fileName.startswith("."):
+                    continue
+
+                clipFileName = os.path.join(root, fileName)
+                leftovers.append((clipFileName, ClipMetadata.load(clipFileName)))
+
+        return leftovers
+
+    def stop(self):
+        self._stopEvent.set()
+        self._queue.put(None)
+
+    def getStats(self):
+        return {
+            "queueDepth": self._queue.qsize() + len(self._retries),
+            "movedFiles": self.movedFilesCount,
+            "movedBytes": self.movedBytes,
+            "failedFiles": self.failedFilesCount,
+            "lastThroughput": self.lastThroughput,
+        }
+
+    def _selectArchiveRoot(self):
+        """
+        Selects archive root with max free space
+        """
+        bestRoot = None
+        bestFree = None
+        for root in self.archiveRoots:
+            try:
+                st = os.statvfs(root)
+            except OSError:
+                continue
+
+            free = st.f_bavail * st.f_frsize
+            if (bestFree is None) or (free > bestFree):
+                bestRoot = root
+                bestFree = free
+
+        return bestRoot
+
+    def _copyThrottled(self, src, dst):
+        tmpName = dst + ".part"
+        started = time.time()
+        copied = 0
+
+        with open(src, "rb") as fin, open(tmpName, "wb") as fout:
+            while not self._stopEvent.is_set():
+                chunk = fin.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                fout.write(chunk)
+                copied += len(chunk)
+
+                if self.bandwidthLimit > 0:
+                    delay = (float(copied) / self.bandwidthLimit) - (time.time() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+            # copy must reach disk before source is removed
+            fout.flush()
+            os.fsync(fout.fileno())
+
+        if self._stopEvent.is_set():
+            os.remove(tmpName)
+            raise IOError("copying interrupted: {}".format(src))
+
+        os.rename(tmpName, dst)
+        os.remove(src)
+
+    def _moveFile(self, src, dst):
+        # file was moved by previous attempt
+        if (not os.path.exists(src)) and os.path.exists(dst):
+            return 0
+
+        dstDir = os.path.dirname(dst)
+        if not mkdir_p(dstDir):
+            raise IOError("can't create directory: {}".format(dstDir))
+
+        size = os.path.getsize(src)
+        if os.stat(src).st_dev == os.stat(dstDir).st_dev:
+            os.rename(src, dst)
+        else:
+            self._copyThrottled(src, dst)
+
+        return size
+
+    def _moveClip(self, task):
+        relPath = os.path.relpath(task.fileName, self.stagingPath)
+
+        if task.dstFileName is None:
+            root = self._selectArchiveRoot()
+            if root is None:
+                raise IOError("no available archive roots")
+
+            # clip with the same name may be in archive already (for example, recorded before clock was set back)
+            task.dstFileName = uniqueFileName(os.path.join(root, relPath))
+
+        dstFileName = task.dstFileName
+        srcBase = os.path.splitext(task.fileName)[0]
+        dstBase = os.path.splitext(dstFileName)[0]
+
+        started = time.time()
+        movedBytes = 0
+
+        # clip is moved first, sidecars follow it to the same root and get the same name as clip
+        movedBytes += self._moveFile(task.fileName, dstFileName)
+        for sidecar in sidecarFileNames(task.fileName):
+            movedBytes += self._moveFile(sidecar, dstBase + sidecar[len(srcBase):])
+
+        if not dstFileName.endswith(os.sep + relPath):
+            self._renameSnapshots(task, srcBase, dstBase, dstFileName)
+
+        elapsed = time.time() - started
+        if elapsed > 0:
+            self.lastThroughput = movedBytes / elapsed
+
+        self.movedFilesCount += 1
+        self.movedBytes += movedBytes
+        return dstFileName
+
+    def _renameSnapshots(self, task, srcBase, dstBase, dstFileName):
+        """
+        Updates names of snapshots in metadata of clip which was renamed in archive
+        """
+        metadata = task.metadata
+        if metadata is None:
+            metadata = ClipMetadata.load(dstFileName)
+
+        if (metadata is None) or (len(metadata.snapshots) == 0):
+            return
+
+        srcPrefix = os.path.basename(srcBase)
+        dstPrefix = os.path.basename(dstBase)
+        metadata.snapshots = [dstPrefix + name[len(srcPrefix):] if name.startswith(srcPrefix + ".") else name for name in metadata.snapshots]
+
+        task.metadata = metadata
+        if not metadata.save(dstFileName):
+            self.logger.error("can't save metadata for file: {}".format(dstFileName))
+
+    def _processTask(self, task):
+        try:
+            dstFileName = self._moveClip(task)
+        except (IOError, OSError) as e:
+            task.attempts += 1
+            if task.attempts > self.maxRetries:
+                self.failedFilesCount += 1
+                self.logger.error("can't move clip {}, giving up: {}".format(task.fileName, e))
+                return
+
+            self.logger.warning("can't move clip {} (attempt {}): {}".format(task.fileName, task.attempts, e))
+
+            # other clips are moved while failed one waits for retry
+            task.notBefore = time.time() + self.retryIntervalSeconds
+            self._retries.append(task)
+            return
+
+        self.logger.info("clip moved to archive: {}".format(dstFileName))
+
+        for listener in self.moveListeners:
+            try:
+                listener(task.fileName, dstFileName)
+            except Exception as e:
+                self.logger.error("move listener failed for {}: {}".format(dstFileName, e))
+
+        for listener in self.clipListeners:
+            try:
+                listener(dstFileName, task.metadata)
+            except Exception as e:
+                self.logger.error("clip listener failed for {}: {}".format(dstFileName, e))
+
+    def _nextTask(self):
+        """
+        Waits for new task or for retry time of failed task
+        :return: task or None when there is no task yet (or mover is stopped)
+        """
+        timeout = None
+        if len(self._retries) > 0:
+            timeout = self._retries[0].notBefore - time.time()
+            if timeout <= 0:
+                return self._retries.pop(0)
+
+        try:
+            return self._queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def run(self):
+        while not self._stopEvent.is_set():
+            task = self._nextTask()
+            if task is not None:
+                self._processTask(task)
@@ -0,0 +1,337 @@
+import time
+import sqlite3
+import threading
+import multiprocessing
+import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id TEXT PRIMARY KEY,
+    heartbeat_ts REAL NOT NULL,
+    load REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS assignments (
+    camera TEXT PRIMARY KEY,
+    node_id TEXT NOT NULL,
+    cost REAL,
+    assigned_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assignments_node ON assignments (node_id);
+"""
+
+
+class ClusterStore:
+    """
+    SQLite file shared by nodes of cluster: heartbeats of nodes and assignments of cameras to nodes. File must
+    be on local disk (or file system with working locks), instance must be used from single thread.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+        # autocommit mode, transactions are started explicitly
+        self._db = sqlite3.connect(fileName, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def begin(self):
+        # write lock is taken immediately, so concurrent leaders can't assign the same camera twice
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self._db.execute("COMMIT")
+
+    def rollback(self):
+        self._db.execute("ROLLBACK")
+
+    def heartbeat(self, nodeId, load, now):
+        self._db.execute(
+            "INSERT OR REPLACE INTO nodes (node_id, heartbeat_ts, load) VALUES (?, ?, ?)",
+            (nodeId, now, load)
+        )
+
+    def updateCosts(self, nodeId, costs):
+        """
+        Saves measured costs of cameras run by node
+
+        :param costs: dictionary camera name -> cost (share of node CPUs)
+        """
+        self._db.executemany(
+            "UPDATE assignments SET cost = ? WHERE camera = ? AND node_id = ?",
+            [(cost, camera, nodeId) for (camera, cost) in costs.items()]
+        )
+
+    def removeNode(self, nodeId):
+        self._db.execute("DELETE FROM assignments WHERE node_id = ?", (nodeId,))
+        self._db.execute("DELETE FROM nodes WHERE node_id = ?", (nodeId,))
+
+    def nodes(self, aliveAfter = 0):
+        """
+        :return: dictionary node id -> (heartbeat timestamp, load)
+        """
+        rows = self._db.execute("SELECT node_id, heartbeat_ts, load FROM nodes WHERE heartbeat_ts >= ?", (aliveAfter,))
+        return dict((nodeId, (heartbeat, load)) for (nodeId, heartbeat, load) in rows)
+
+    def assignments(self):
+        """
+        :return: dictionary camera name -> (node id, cost or None when it wasn't measured yet)
+        """
+        rows = self._db.execute("SELECT camera, node_id, cost FROM assignments")
+        return dict((camera, (nodeId, cost)) for (camera, nodeId, cost) in rows)
+
+    def nodeCameras(self, nodeId):
+        rows = self._db.execute("SELECT camera FROM assignments WHERE node_id = ?", (nodeId,))
+        return set(camera for (camera,) in rows)
+
+    def assign(self, camera, nodeId, cost, now):
+        self._db.execute(
+            "INSERT OR REPLACE INTO assignments (camera, node_id, cost, assigned_ts) VALUES (?, ?, ?, ?)",
+            (camera, nodeId, cost, now)
+        )
+
+    def unassign(self, camera):
+        self._db.execute("DELETE FROM assignments WHERE camera = ?", (camera,))
+
+
+def planMove(loads, costs, threshold):
+    """
+    Finds camera which should be moved to the least loaded node from the most loaded node which has camera
+    that can be moved
+
+    :param loads: dictionary node id -> load
+    :param costs: dictionary camera name -> (node id, cost)
+    :param threshold: min difference of loads of nodes when camera is moved
+    :return: tuple of (camera name, node id) or None
+    """
+    if len(loads) < 2:
+        return None
+
+    idlest = min(sorted(loads), key=lambda nodeId: loads[nodeId])
+    for source in sorted(loads, key=lambda nodeId: -loads[nodeId]):
+        difference = loads[source] - loads[idlest]
+        if difference <= threshold:
+            return None
+
+        # the largest camera which reduces difference of loads
+        candidates = [
+            (cost, camera) for (camera, (nodeId, cost)) in costs.items()
+            if (nodeId == source) and (0 < cost < difference)
+        ]
+        if len(candidates) > 0:
+            return (max(candidates)[1], idlest)
+
+    return None
+
+
+class ClusterNode(threading.Thread):
+    """
+    Node of cluster which shares list of cameras with other nodes. Nodes write heartbeats with measured
+    load to shared SQLite file, node with the lowest id among alive nodes is leader: it assigns cameras of
+    failed nodes and new cameras to the least loaded nodes and moves single camera per rebalance interval
+    from the most loaded node to the least loaded one. Each node runs cameras assigned to it with camera
+    manager. Node which can't reach shared file for node timeout stops its cameras, so they are taken over
+    by other nodes.
+
+    Node is used in place of camera manager by cameras settings watcher.
+    """
+
+    def __init__(self, logger, fileName, nodeId, cameras, cameraManager):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self.fileName = fileName
+        self.nodeId = nodeId
+        self.cameraManager = cameraManager
+
+        self.intervalSeconds = config.CLUSTER_HEARTBEAT_INTERVAL_SECONDS
+        self.nodeTimeoutSeconds = config.CLUSTER_NODE_TIMEOUT_SECONDS
+        self.rebalanceThreshold = config.CLUSTER_REBALANCE_THRESHOLD
+        self.rebalanceIntervalSeconds = config.CLUSTER_REBALANCE_INTERVAL_SECONDS
+        self.cpusQty = multiprocessing.cpu_count()
+
+        # all cameras of cluster and cameras run by this node: camera name -> CameraConfig
+        self.cameras = dict((camera.name, camera) for camera in cameras)
+        self.localCameras = {}
+
+        self.isLeader = False
+
+        # leader doesn't assign cameras until nodes started at the same time joined cluster
+        self.startupGraceSeconds = 2 * self.intervalSeconds
+        self._firstStep = None
+
+        self._lastHeartbeat = None
+        self._lastMove = None
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._store = None
+
+    def stop(self):
+        self._stopEvent.set()
+
+    # cameras settings watcher interface
+
+    def startCamera(self, cameraConfig):
+        # camera will be assigned by leader
+        with self._lock:
+            self.cameras[cameraConfig.name] = cameraConfig
+
+    def applyCameraConfig(self, oldCameraConfig, cameraConfig):
+        with self._lock:
+            self.cameras[cameraConfig.name] = cameraConfig
+            isLocal = cameraConfig.name in self.localCameras
+            if isLocal:
+                self.localCameras[cameraConfig.name] = cameraConfig
+
+        if isLocal:
+            self.cameraManager.applyCameraConfig(oldCameraConfig, cameraConfig)
+
+    def stopCamera(self, cameraConfig):
+        with self._lock:
+            self.cameras.pop(cameraConfig.name, None)
+            isLocal = self.localCameras.pop(cameraConfig.name, None) is not None
+
+        if isLocal:
+            self.cameraManager.stopCamera(cameraConfig)
+
+    def _cameraCosts(self):
+        """
+        Measured costs of local cameras as share of node CPUs
+        """
+        loads = self.cameraManager.cameraLoads()
+        return dict((name, load / self.cpusQty) for (name, load) in loads.items() if load is not None)
+
+    def _rebalance(self, now):
+        """
+        Assigns cameras to alive nodes, called by leader inside of transaction
+        """
+        alive = self._store.nodes(now - self.nodeTimeoutSeconds)
+        assignments = self._store.assignments()
+
+        with self._lock:
+            cameras = set(self.cameras)
+
+        # cameras of failed nodes and removed cameras are released
+        for (camera, (nodeId, cost)) in list(assignments.items()):
+            if (nodeId not in alive) or (camera not in cameras):
+                if nodeId not in alive:
+                    self.logger.warning("node {} failed, camera {} is released".format(nodeId, camera))
+
+                self._store.unassign(camera)
+                del assignments[camera]
+
+        # cameras which weren't measured yet get average cost
+        measured = [cost for (nodeId, cost) in assignments.values() if cost is not None]
+        defaultCost = (sum(measured) / len(measured)) if len(measured) > 0 else 1.0
+        costs = dict((camera, (nodeId, cost if cost is not None else defaultCost)) for (camera, (nodeId, cost)) in assignments.items())
+
+        loads = dict((nodeId, 0.0) for nodeId in alive)
+        for (nodeId, cost) in costs.values():
+            loads[nodeId] += cost
+
+        for camera in sorted(cameras - set(assignments)):
+            nodeId = min(sorted(loads), key=lambda item: loads[item])
+            self.logger.info("camera {} is assigned to node {}".format(camera, nodeId))
+            self._store.assign(camera, nodeId, None, now)
+            loads[nodeId] += defaultCost
+
+        if (self._lastMove is not None) and (now - self._lastMove < self.rebalanceIntervalSeconds):
+            return
+
+        move = planMove(loads, costs, self.rebalanceThreshold)
+        if move is not None:
+            (camera, nodeId) = move
+            self.logger.info("camera {} is moved from node {} to node {}".format(camera, costs[camera][0], nodeId))
+            self._store.assign(camera, nodeId, costs[camera][1], now)
+            self._lastMove = now
+
+    def _synchronize(self, now):
+        """
+        Writes heartbeat, rebalances cameras when node is leader
+
+        :return: set of cameras assigned to node
+        """
+        costs = self._cameraCosts()
+
+        self._store.begin()
+        try:
+            self._store.heartbeat(self.nodeId, sum(costs.values()), now)
+            self._store.updateCosts(self.nodeId, costs)
+
+            alive = self._store.nodes(now - self.nodeTimeoutSeconds)
+            isLeader = (min(alive) == self.nodeId)
+            if isLeader != self.isLeader:
+                self.logger.info("node {} is {}".format(self.nodeId, "leader" if isLeader else "not leader"))
+                self.isLeader = isLeader
+
+            if isLeader and (now - self._firstStep >= self.startupGraceSeconds):
+                self._rebalance(now)
+
+            assigned = self._store.nodeCameras(self.nodeId)
+            self._store.commit()
+        except Exception:
+            self._store.rollback()
+            raise
+
+        return assigned
+
+    def _applyAssignments(self, assigned):
+        with self._lock:
+            started = [self.cameras[name] for name in sorted(assigned) if (name in self.cameras) and (name not in self.localCameras)]
+            stopped = [camera for (name, camera) in sorted(self.localCameras.items()) if name not in assigned]
+
+            for camera in started:
+                self.localCameras[camera.name] = camera
+
+            for camera in stopped:
+                del self.localCameras[camera.name]
+
+        for camera in stopped:
+            self.cameraManager.stopCamera(camera)
+
+        for camera in started:
+            self.cameraManager.startCamera(camera)
+
+    def step(self, now = None):
+        if now is None:
+            now = time.time()
+
+        if self._firstStep is None:
+            self._firstStep = now
+
+        try:
+            assigned = self._synchronize(now)
+            self._lastHeartbeat = now
+        except sqlite3.Error as e:
+            self.logger.error("can't synchronize with cluster: {}".format(e))
+
+            # other nodes take cameras of this node when it doesn't write heartbeats
+            if (self._lastHeartbeat is not None) and (now - self._lastHeartbeat < self.nodeTimeoutSeconds):
+                return
+
+            assigned = set()
+
+        self._applyAssignments(assigned)
+
+    def run(self):
+        # connection is used only from this thread
+        self._store = ClusterStore(self.fileName)
+        self.logger.info("cluster node {} started".format(self.nodeId))
+
+        while not self._stopEvent.is_set():
+            self.step()
+            self._stopEvent.wait(self.intervalSeconds)
+
+        # cameras of stopped node are taken over by other nodes without waiting for timeout
+        try:
+            self._store.removeNode(self.nodeId)
+        except sqlite3.Error as e:
+            self.logger.error("can't leave cluster: {}".format(e))
+
+        self._store.close()
+        self.logger.info("cluster node {} stopped".format(self.nodeId))
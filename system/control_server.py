@@ -0,0 +1,140 @@
+import os
+import json
+import threading
+import SocketServer
+from nvr_classes.motion_driven_recorder import QueueCommand
+from system.camera_config import validatePositiveNumber, validateOneOf, validateZones
+from system.profiling import PROFILING_MODES, PROFILING_MODE_SAMPLING
+
+
+# commands available through control API and validators of their arguments
+COMMAND_VALIDATORS = {
+    QueueCommand.CMD_GET_STATS: lambda args: {},
+    QueueCommand.CMD_SET_DETECTOR: lambda args: {"threshold": validatePositiveNumber(args.get("threshold"), "threshold")},
+    QueueCommand.CMD_SET_ZONES: lambda args: {"zones": validateZones(args.get("zones"))},
+    QueueCommand.CMD_FORCE_RECORDING: lambda args: {"mode": validateOneOf(args.get("mode"), ["on", "off", "auto"], "mode")},
+    QueueCommand.CMD_TAKE_SNAPSHOT: lambda args: {},
+    QueueCommand.CMD_ROTATE: lambda args: {},
+    QueueCommand.CMD_REOPEN: lambda args: {},
+    QueueCommand.CMD_PROFILE: lambda args: {
+        "mode": validateOneOf(args.get("mode", PROFILING_MODE_SAMPLING), PROFILING_MODES, "mode"),
+        "seconds": validatePositiveNumber(args.get("seconds", 30), "seconds"),
+    },
+    QueueCommand.CMD_TRACE_ALLOCATIONS: lambda args: {
+        "seconds": validatePositiveNumber(args.get("seconds", 60), "seconds"),
+        "top": int(validatePositiveNumber(args.get("top", 25), "top")),
+    },
+}
+
+
+def parseCommand(request):
+    """
+    Creates command from request
+
+    :param request: dictionary with "cmd" and optional "args"
+    :return: QueueCommand
+    """
+    name = request.get("cmd")
+    if name not in COMMAND_VALIDATORS:
+        raise ValueError("unknown command: {}".format(name))
+
+    return QueueCommand(str(name), COMMAND_VALIDATORS[name](request.get("args") or {}))
+
+
+class ControlRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles requests: one JSON object per line, for example {"camera": "cam0", "cmd": "stats"}, each response
+    is JSON object in single line with "ok" and "result" or "error"
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if len(line.strip()) == 0:
+                continue
+
+            response = self.server.execute(line)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Control API over local Unix socket, commands are routed into command queues of camera recorders
+    """
+
+    daemon_threads = True
+
+    def __init__(self, logger, socketPath, commandTimeoutSeconds = 5.0):
+        # socket file is left after previous run when process was killed
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+        SocketServer.UnixStreamServer.__init__(self, socketPath, ControlRequestHandler)
+        os.chmod(socketPath, 0o600)
+
+        self.logger = logger
+        self.socketPath = socketPath
+        self.commandTimeoutSeconds = commandTimeoutSeconds
+
+        # camera name -> recorder
+        self.recorders = {}
+
+        # statistics of services which are added to reply of stats command: name -> function returning dictionary
+        self.statsProviders = {}
+
+        self._thread = None
+
+    def addRecorder(self, cameraName, recorder):
+        self.recorders[cameraName] = recorder
+
+    def removeRecorder(self, cameraName, recorder = None):
+        """
+        Removes recorder of camera, when recorder is specified it's removed only if camera wasn't restarted with
+        another recorder
+        """
+        if (recorder is None) or (self.recorders.get(cameraName) is recorder):
+            self.recorders.pop(cameraName, None)
+
+    def execute(self, line):
+        """
+        Executes single request
+        :return: response dictionary
+        """
+        try:
+            request = json.loads(line)
+            recorder = self.recorders.get(request.get("camera"))
+            if recorder is None:
+                raise ValueError("unknown camera: {}".format(request.get("camera")))
+
+            cmd = parseCommand(request)
+        except (ValueError, TypeError, AttributeError) as e:
+            return {"ok": False, "error": str(e)}
+
+        recorder.addCommand(cmd)
+        if not cmd.wait(self.commandTimeoutSeconds):
+            return {"ok": False, "error": "command timed out"}
+
+        if cmd.error is not None:
+            return {"ok": False, "error": cmd.error}
+
+        result = cmd.result
+        if cmd.cmd == QueueCommand.CMD_GET_STATS:
+            result = dict(result)
+            for (name, provider) in self.statsProviders.items():
+                result[name] = provider()
+
+        return {"ok": True, "result": result}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.logger.info("control server started on {}".format(self.socketPath))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
@@ -0,0 +1,197 @@
+import os
+import sys
+import ctypes
+import ctypes.util
+import threading
+import multiprocessing
+import cv2 as cv
+import config
+
+
+# environment variable with options of FFmpeg backend of OpenCV, read when capture is opened
+FFMPEG_CAPTURE_OPTIONS = "OPENCV_FFMPEG_CAPTURE_OPTIONS"
+_userCaptureOptions = os.environ.get(FFMPEG_CAPTURE_OPTIONS)
+
+
+def _loadLibc():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+
+_libc = _loadLibc()
+
+
+def availableCpus():
+    """
+    Returns list of CPUs available for process
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(multiprocessing.cpu_count()))
+
+
+def setThreadAffinity(cpus):
+    """
+    Pins calling thread to CPUs (Linux only), threads started by it later inherit affinity
+
+    :param cpus: list of CPUs
+    :return: True on success, otherwise False
+    """
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+            return True
+        except OSError:
+            return False
+
+    if _libc is None:
+        return False
+
+    bitsPerWord = 8 * ctypes.sizeof(ctypes.c_ulong)
+    cpuSet = (ctypes.c_ulong * (1024 // bitsPerWord))()
+    for cpu in cpus:
+        cpuSet[cpu // bitsPerWord] |= 1 << (cpu % bitsPerWord)
+
+    return _libc.sched_setaffinity(0, ctypes.sizeof(cpuSet), ctypes.byref(cpuSet)) == 0
+
+
+def setDecoderThreads(threadsQty):
+    """
+    Limits count of FFmpeg decoder threads for captures opened after call, options set in environment by
+    user are not changed
+
+    :param threadsQty: count of threads, 0 - FFmpeg default
+    :return: None
+    """
+    if _userCaptureOptions is not None:
+        return
+
+    if threadsQty > 0:
+        os.environ[FFMPEG_CAPTURE_OPTIONS] = "threads;{}".format(threadsQty)
+    else:
+        os.environ.pop(FFMPEG_CAPTURE_OPTIONS, None)
+
+
+def assignCoreSets(weights, cpus):
+    """
+    Assigns CPUs to cameras. When there are less cameras than CPUs each camera gets own CPUs, count of them
+    is proportional to camera weight, otherwise each camera gets single CPU and the heaviest cameras are
+    placed on the least loaded CPUs.
+
+    :param weights: dictionary camera name -> weight (count of pixels in frame)
+    :param cpus: list of available CPUs
+    :return: dictionary camera name -> list of CPUs
+    """
+    cpus = sorted(cpus)
+    names = sorted(weights, key=lambda name: (-weights[name], name))
+    if (len(names) == 0) or (len(cpus) == 0):
+        return {}
+
+    if len(names) >= len(cpus):
+        load = [0] * len(cpus)
+        result = {}
+        for name in names:
+            index = load.index(min(load))
+            load[index] += weights[name]
+            result[name] = [cpus[index]]
+
+        return result
+
+    # next free CPU goes to camera with the highest weight per CPU
+    counts = dict((name, 1) for name in names)
+    for _ in range(len(cpus) - len(names)):
+        name = max(names, key=lambda item: float(weights[item]) / counts[item])
+        counts[name] += 1
+
+    result = {}
+    first = 0
+    for name in names:
+        result[name] = cpus[first:first + counts[name]]
+        first += counts[name]
+
+    return result
+
+
+class CpuScheduler:
+    """
+    Keeps CPUs assignment for camera threads up to date with count of cameras and their frame sizes. Limits
+    threads of OpenCV pool and FFmpeg decoders, so cameras don't oversubscribe CPUs. When pinning is enabled
+    assignment is passed to onPlanChanged(plan) callback, plan is dictionary camera name -> list of CPUs.
+    """
+
+    # weight of camera which frame size isn't known yet
+    DEFAULT_WEIGHT = 1280 * 720
+
+    def __init__(self, logger, cpus = None, pinning = True):
+        self.logger = logger
+        self.cpus = list(cpus) if cpus else availableCpus()
+        self.pinning = pinning
+
+        self.openCvThreads = config.OPENCV_THREADS
+        self.decoderThreads = config.DECODER_THREADS
+
+        self.onPlanChanged = None
+
+        # camera name -> weight
+        self.weights = {}
+        self.plan = {}
+
+        self._lock = threading.Lock()
+
+    def threadsPerCamera(self):
+        return max(1, len(self.cpus) // max(1, len(self.weights)))
+
+    def addCamera(self, name, weight = None):
+        with self._lock:
+            self.weights[name] = weight if weight else self.DEFAULT_WEIGHT
+
+        self._update()
+
+    def updateCamera(self, name, weight):
+        with self._lock:
+            if (name not in self.weights) or (self.weights[name] == weight):
+                return
+
+            self.weights[name] = weight
+
+        self._update()
+
+    def removeCamera(self, name):
+        with self._lock:
+            if self.weights.pop(name, None) is None:
+                return
+
+        self._update()
+
+    def _limitThreads(self):
+        openCvThreads = self.openCvThreads if self.openCvThreads is not None else self.threadsPerCamera()
+        if openCvThreads > 0:
+            cv.setNumThreads(openCvThreads)
+
+        decoderThreads = self.decoderThreads if self.decoderThreads is not None else self.threadsPerCamera()
+        setDecoderThreads(decoderThreads)
+
+        self.logger.info("threads limits: OpenCV = {}, decoder = {}".format(openCvThreads, decoderThreads))
+
+    def _update(self):
+        with self._lock:
+            self._limitThreads()
+
+            if not self.pinning:
+                return
+
+            plan = assignCoreSets(self.weights, self.cpus)
+            if plan == self.plan:
+                return
+
+            self.plan = plan
+
+        self.logger.info("CPUs assignment: {}".format(plan))
+        if self.onPlanChanged is not None:
+            self.onPlanChanged(plan)
@@ -0,0 +1,181 @@
+import time
+import random
+import urlparse
+import numpy as np
+import cv2 as cv
+
+
+FAKE_CAMERA_SCHEME = "fake"
+
+
+def isFakeCameraUrl(connection):
+    return isinstance(connection, basestring) and connection.startswith(FAKE_CAMERA_SCHEME + "://")
+
+
+class FakeCamera:
+    """
+    Stand-in for cv.VideoCapture which emulates camera for load testing. Frames are produced with configured
+    frame rate by real clock: when reader is late, up to bufferSize frames are kept (like decoder buffer), older
+    frames are dropped and counted in droppedFrames.
+
+    Connection string: fake://synthetic?width=1280&height=720&fps=15&motion=0.2 (moving object over
+    static scene) or fake:///path/to/video.avi?fps=15 (video file played in loop).
+
+    Optional parameters:
+      motion - share of time when object moves in synthetic scene (0.0 - 1.0);
+      buffer - count of frames buffered when reader is late;
+      disconnect, stall, burst - mean interval in seconds between faults (0 - never): after disconnect
+      all reads fail until camera is reopened, stall - camera doesn't produce frames for stall_seconds,
+      burst - frames are delayed for burst_seconds and then delivered at once;
+      seed - seed of random faults.
+    """
+
+    def __init__(self, connection):
+        url = urlparse.urlparse(connection)
+        params = dict((name, values[-1]) for (name, values) in urlparse.parse_qs(url.query).items())
+
+        self.width = int(params.get("width", 640))
+        self.height = int(params.get("height", 480))
+        self.fps = float(params.get("fps", 0)) or None
+        self.motion = float(params.get("motion", 0.2))
+        self.bufferSize = int(params.get("buffer", 2))
+
+        self.disconnectInterval = float(params.get("disconnect", 0))
+        self.stallInterval = float(params.get("stall", 0))
+        self.stallSeconds = float(params.get("stall_seconds", 3))
+        self.burstInterval = float(params.get("burst", 0))
+        self.burstSeconds = float(params.get("burst_seconds", 1))
+        self._random = random.Random(params.get("seed"))
+
+        self.producedFrames = 0
+        self.droppedFrames = 0
+        self.disconnected = False
+        self._opened = False
+
+        self._video = None
+        if url.netloc != "synthetic":
+            self._video = cv.VideoCapture(url.path)
+            if not self._video.isOpened():
+                self._video = None
+                return
+
+            self.fps = self.fps or self._video.get(cv.CAP_PROP_FPS) or 25.0
+            self.width = int(params.get("width", self._video.get(cv.CAP_PROP_FRAME_WIDTH)))
+            self.height = int(params.get("height", self._video.get(cv.CAP_PROP_FRAME_HEIGHT)))
+
+        self.fps = self.fps or 15.0
+        self._background = self._makeBackground()
+        self._opened = True
+
+        now = time.time()
+        self._started = now
+        self._nextFrame = 0
+        self._nextDisconnect = self._nextFault(now, self.disconnectInterval)
+        self._nextStall = self._nextFault(now, self.stallInterval)
+        self._nextBurst = self._nextFault(now, self.burstInterval)
+
+    def _nextFault(self, now, interval):
+        if interval <= 0:
+            return None
+
+        return now + self._random.expovariate(1.0 / interval)
+
+    def _makeBackground(self):
+        # vertical gradient, so frame isn't uniform
+        column = np.linspace(40, 160, self.height).astype(np.uint8)
+        return np.repeat(np.repeat(column[:, np.newaxis, np.newaxis], self.width, axis=1), 3, axis=2)
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+    def get(self, propId):
+        if propId == cv.CAP_PROP_FPS:
+            return self.fps
+
+        if propId == cv.CAP_PROP_FRAME_WIDTH:
+            return self.width
+
+        if propId == cv.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+
+        return 0
+
+    def _injectFaults(self, now):
+        if (self._nextDisconnect is not None) and (now >= self._nextDisconnect):
+            self.disconnected = True
+
+        if (self._nextStall is not None) and (now >= self._nextStall):
+            # frames aren't produced while camera stalls
+            time.sleep(self.stallSeconds)
+            self._started += self.stallSeconds
+            self._nextStall = self._nextFault(time.time(), self.stallInterval)
+
+        if (self._nextBurst is not None) and (now >= self._nextBurst):
+            # frames are produced, but delivered later at once
+            time.sleep(self.burstSeconds)
+            self._nextBurst = self._nextFault(time.time(), self.burstInterval)
+
+    def _waitFrame(self):
+        """
+        Waits for next frame by camera clock
+        :return: index of frame
+        """
+        available = int((time.time() - self._started) * self.fps) + 1
+        if available - self._nextFrame > self.bufferSize:
+            self.droppedFrames += available - self._nextFrame - self.bufferSize
+            self._nextFrame = available - self.bufferSize
+
+        delay = self._started + self._nextFrame / self.fps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        index = self._nextFrame
+        self._nextFrame += 1
+        self.producedFrames = max(self.producedFrames, self._nextFrame)
+        return index
+
+    def _syntheticFrame(self, index):
+        frame = self._background.copy()
+
+        # object crosses the scene during first part of each 10 seconds cycle
+        cycleFrames = int(10 * self.fps)
+        position = float(index % cycleFrames) / cycleFrames
+        if position < self.motion:
+            size = max(8, self.height // 6)
+            x = int((self.width - size) * position / self.motion)
+            y = (self.height - size) // 2
+            frame[y:y + size, x:x + size] = (0, 200, 255)
+
+        return frame
+
+    def _videoFrame(self):
+        (ret, frame) = self._video.read()
+        if not ret:
+            # video is played in loop
+            self._video.set(cv.CAP_PROP_POS_FRAMES, 0)
+            (ret, frame) = self._video.read()
+            if not ret:
+                return None
+
+        if (frame.shape[1] != self.width) or (frame.shape[0] != self.height):
+            frame = cv.resize(frame, (self.width, self.height))
+
+        return frame
+
+    def read(self):
+        if (not self._opened) or self.disconnected:
+            return (False, None)
+
+        self._injectFaults(time.time())
+        if self.disconnected:
+            return (False, None)
+
+        index = self._waitFrame()
+        frame = self._videoFrame() if self._video is not None else self._syntheticFrame(index)
+        return (frame is not None, frame)
@@ -0,0 +1,301 @@
+import time
+import json
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+import cv2 as cv
+
+
+MJPEG_BOUNDARY = "pynvrframe"
+
+
+class LiveFrameSource(threading.Thread):
+    """
+    Holds latest frame of camera and encodes it to JPEG at most once per interval in its own thread. JPEG is
+    shared with all clients and nothing is encoded while there are no clients.
+    """
+
+    def __init__(self, cameraName, intervalSeconds = 0.2, quality = 80):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.cameraName = cameraName
+        self.intervalSeconds = intervalSeconds
+        self.quality = quality
+
+        self.encodedFramesCount = 0
+
+        lock = threading.Lock()
+        self._frameCondition = threading.Condition(lock)
+        self._jpegCondition = threading.Condition(lock)
+
+        self._frame = None
+        self._frameSeq = 0
+
+        self._jpeg = None
+        self._jpegSeq = 0
+        self._jpegTime = 0
+
+        self._clientsQty = 0
+        self._stopped = False
+
+    @property
+    def clientsQty(self):
+        return self._clientsQty
+
+    @property
+    def stopped(self):
+        """
+        True when camera was stopped or restarted, source won't produce JPEGs anymore
+        """
+        return self._stopped
+
+    def publish(self, frame):
+        """
+        Sets latest frame, called from capture thread. Frame must not be changed after it.
+        """
+        # nobody watches, frame is not even stored
+        if self._clientsQty == 0:
+            return
+
+        with self._frameCondition:
+            self._frame = frame
+            self._frameSeq += 1
+            self._frameCondition.notify()
+
+    def addClient(self):
+        with self._frameCondition:
+            self._clientsQty += 1
+            self._frameCondition.notify()
+
+    def removeClient(self):
+        with self._frameCondition:
+            self._clientsQty -= 1
+
+    def stop(self):
+        with self._frameCondition:
+            self._stopped = True
+            self._frameCondition.notify()
+            self._jpegCondition.notify_all()
+
+    def waitJpeg(self, lastSeq, timeout):
+        """
+        Waits for JPEG which is newer than lastSeq
+
+        :param lastSeq: sequence number of JPEG received by client before, 0 - any
+        :param timeout: max seconds to wait
+        :return: tuple of (sequence number, JPEG data) or (lastSeq, None) on timeout or when source is stopped
+                 (see stopped)
+        """
+        deadline = time.time() + timeout
+        with self._jpegCondition:
+            while (self._jpegSeq <= lastSeq) and (not self._stopped):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return (lastSeq, None)
+
+                self._jpegCondition.wait(remaining)
+
+            if self._stopped:
+                return (lastSeq, None)
+
+            return (self._jpegSeq, self._jpeg)
+
+    def waitFreshJpeg(self, timeout):
+        """
+        Returns JPEG which was encoded recently (when other clients are watching) or waits for new one
+
+        :param timeout: max seconds to wait
+        :return: tuple of (sequence number, JPEG data) or (0, None) on timeout
+        """
+        with self._jpegCondition:
+            lastSeq = self._jpegSeq
+            if (self._jpeg is not None) and ((time.time() - self._jpegTime) <= (2 * self.intervalSeconds)):
+                lastSeq -= 1
+
+        return self.waitJpeg(lastSeq, timeout)
+
+    def _nextFrame(self, encodedSeq):
+        with self._frameCondition:
+            while (not self._stopped) and ((self._clientsQty == 0) or (self._frameSeq == encodedSeq)):
+                self._frameCondition.wait()
+
+            if self._stopped:
+                return (encodedSeq, None)
+
+            return (self._frameSeq, self._frame)
+
+    def run(self):
+        encodedSeq = 0
+        while True:
+            (encodedSeq, frame) = self._nextFrame(encodedSeq)
+            if frame is None:
+                break
+
+            (ret, data) = cv.imencode(".jpg", frame, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+            if ret:
+                with self._jpegCondition:
+                    self._jpeg = data.tobytes()
+                    self._jpegSeq += 1
+                    self._jpegTime = time.time()
+                    self._jpegCondition.notify_all()
+
+                self.encodedFramesCount += 1
+
+            time.sleep(self.intervalSeconds)
+
+
+class LiveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /snapshot.jpg and /stream.mjpg of default camera, /<camera>/snapshot.jpg, /<camera>/stream.mjpg and
+    /health with status of cameras
+    """
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("live server: {} - {}".format(self.address_string(), format % args))
+
+    def _findSource(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if len(part) > 0]
+        if len(parts) == 1:
+            return (self.server.defaultSource(), parts[0])
+
+        if len(parts) == 2:
+            return (self.server.sources.get(parts[0]), parts[1])
+
+        return (None, None)
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/health":
+            self._sendHealth()
+            return
+
+        (source, resource) = self._findSource()
+        if (source is None) or (resource not in ["snapshot.jpg", "stream.mjpg"]):
+            self.send_error(404)
+            return
+
+        # slow clients are dropped when socket send times out, frames are never buffered for them
+        self.connection.settimeout(self.server.clientTimeoutSeconds)
+
+        source.addClient()
+        try:
+            if resource == "snapshot.jpg":
+                self._sendSnapshot(source)
+            else:
+                self._sendStream(source)
+        except (socket.error, socket.timeout) as e:
+            self.server.logger.info("live client {} dropped: {}".format(self.address_string(), e))
+        finally:
+            source.removeClient()
+
+    def _sendHealth(self):
+        provider = self.server.healthProvider
+        health = provider() if provider is not None else None
+        if health is None:
+            self.send_error(404)
+            return
+
+        body = json.dumps(health, indent=4, sort_keys=True)
+
+        # load balancers and monitoring check only status code
+        self.send_response(200 if health["ok"] else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _sendSnapshot(self, source):
+        (seq, jpeg) = source.waitFreshJpeg(self.server.clientTimeoutSeconds)
+        if jpeg is None:
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(jpeg)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+    def _sendStream(self, source):
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary={}".format(MJPEG_BOUNDARY))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        seq = 0
+        while not self.server.stopped:
+            (seq, jpeg) = source.waitJpeg(seq, self.server.clientTimeoutSeconds)
+            if jpeg is None:
+                # stream is closed, so client reconnects to new source of restarted camera
+                if source.stopped:
+                    self.server.logger.info("live client {} disconnected, camera {} stopped".format(self.address_string(), source.cameraName))
+                    return
+
+                continue
+
+            self.wfile.write("--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n".format(MJPEG_BOUNDARY, len(jpeg)))
+            self.wfile.write(jpeg)
+            self.wfile.write("\r\n")
+            self.wfile.flush()
+
+
+class LiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server with live snapshots and MJPEG streams of cameras
+    """
+
+    daemon_threads = True
+
+    def __init__(self, logger, address, clientTimeoutSeconds = 2.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, LiveRequestHandler)
+        self.logger = logger
+        self.clientTimeoutSeconds = clientTimeoutSeconds
+
+        # camera name -> LiveFrameSource
+        self.sources = {}
+        self._defaultCameraName = None
+
+        # function which returns status of cameras for /health (None - not available)
+        self.healthProvider = None
+
+        self.stopped = False
+        self._thread = None
+
+    def addSource(self, source):
+        if self._defaultCameraName is None:
+            self._defaultCameraName = source.cameraName
+
+        self.sources[source.cameraName] = source
+
+        # source added to running server
+        if self._thread is not None:
+            source.start()
+
+    def removeSource(self, cameraName):
+        source = self.sources.pop(cameraName, None)
+        if source is not None:
+            source.stop()
+
+    def defaultSource(self):
+        return self.sources.get(self._defaultCameraName)
+
+    def start(self):
+        for source in self.sources.values():
+            source.start()
+
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.logger.info("live server started on {}:{}".format(*self.server_address))
+
+    def stop(self):
+        self.stopped = True
+        for source in self.sources.values():
+            source.stop()
+
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,178 @@
+import os
+import multiprocessing
+import config
+
+
+# load shedding levels, each level includes all previous ones
+LEVEL_FULL_QUALITY = 0
+LEVEL_DETECTION_STRIDE = 1
+LEVEL_DETECTION_PROXY = 2
+LEVEL_NO_OVERLAYS = 3
+LEVEL_PRE_ALARM_DECIMATION = 4
+
+LEVEL_NAMES = [
+    "full quality",
+    "detection stride",
+    "detection proxy resolution",
+    "no overlays",
+    "pre-alarm decimation",
+]
+
+
+def loadPerCpu():
+    """
+    Returns 1 minute load average per CPU or None when it isn't available
+    """
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError, NotImplementedError):
+        return None
+
+
+class LoadSheddingGovernor:
+    """
+    Watches processing lag of camera loop and host CPU load. When camera can't keep up with frame rate,
+    quality is stepped down one level at a time in fixed order (see LEVEL_* constants), when there is
+    headroom again quality is restored in reverse order. Levels are changed not more often than once per
+    holdSeconds. When quality has to be stepped down right after it was restored, interval before next
+    restore is doubled (up to maxRestoreHoldSeconds), so governor doesn't oscillate between two levels.
+    """
+
+    def __init__(self, logger, cameraName = None):
+        self.logger = logger
+        self.cameraName = cameraName
+
+        # frame processing time relative to frame interval, when smoothed value is above max - quality is
+        # stepped down, when below restore value (and CPU isn't overloaded) - restored
+        self.maxBusyRatio = config.LOAD_SHEDDING_MAX_BUSY_RATIO
+        self.restoreBusyRatio = config.LOAD_SHEDDING_RESTORE_BUSY_RATIO
+
+        # host load average per CPU above which quality is stepped down (0 - not checked)
+        self.maxLoadPerCpu = config.LOAD_SHEDDING_MAX_LOAD_PER_CPU
+
+        self.holdSeconds = config.LOAD_SHEDDING_HOLD_SECONDS
+        self.maxRestoreHoldSeconds = 32 * self.holdSeconds
+        self.maxLevel = min(config.LOAD_SHEDDING_MAX_LEVEL, LEVEL_PRE_ALARM_DECIMATION)
+
+        self.loadCheckIntervalSeconds = 5
+        self.loadPerCpuFunc = loadPerCpu
+
+        # weight of new frame in smoothed busy ratio
+        self.smoothing = 0.05
+
+        self.level = LEVEL_FULL_QUALITY
+        self.busyRatio = None
+        self.levelChangesCount = 0
+
+        self._loadPerCpu = None
+        self._lastLoadCheck = None
+        self._lastLevelChange = None
+        self._lastRestore = None
+        self._restoreHoldSeconds = self.holdSeconds
+
+    def detectionStride(self):
+        """
+        Motion is detected in every N-th frame
+        """
+        return config.LOAD_SHEDDING_DETECTION_STRIDE if self.level >= LEVEL_DETECTION_STRIDE else 1
+
+    def detectionProxyScale(self):
+        """
+        Scale of frames passed to motion detector
+        """
+        return config.LOAD_SHEDDING_DETECTION_PROXY_SCALE if self.level >= LEVEL_DETECTION_PROXY else 1.0
+
+    def drawOverlays(self):
+        return self.level < LEVEL_NO_OVERLAYS
+
+    def preAlarmDecimation(self):
+        """
+        Only every N-th frame is kept in pre-alarm buffer
+        """
+        return config.LOAD_SHEDDING_PRE_ALARM_DECIMATION if self.level >= LEVEL_PRE_ALARM_DECIMATION else 1
+
+    def _isCpuOverloaded(self, instant):
+        if self.maxLoadPerCpu <= 0:
+            return False
+
+        if (self._lastLoadCheck is None) or (instant - self._lastLoadCheck >= self.loadCheckIntervalSeconds):
+            self._loadPerCpu = self.loadPerCpuFunc()
+            self._lastLoadCheck = instant
+
+        return (self._loadPerCpu is not None) and (self._loadPerCpu > self.maxLoadPerCpu)
+
+    def _nextLevel(self, instant):
+        cpuOverloaded = self._isCpuOverloaded(instant)
+
+        # restore which wasn't followed by step down is successful
+        if (self._lastRestore is not None) and (instant - self._lastRestore >= 2 * self._restoreHoldSeconds):
+            self._lastRestore = None
+            self._restoreHoldSeconds = self.holdSeconds
+
+        if ((self.busyRatio > self.maxBusyRatio) or cpuOverloaded) and (self.level < self.maxLevel):
+            if self._lastRestore is not None:
+                self._lastRestore = None
+                self._restoreHoldSeconds = min(2 * self._restoreHoldSeconds, self.maxRestoreHoldSeconds)
+
+            return self.level + 1
+
+        if (self.busyRatio >= self.restoreBusyRatio) or cpuOverloaded or (self.level == LEVEL_FULL_QUALITY):
+            return self.level
+
+        if instant - self._lastLevelChange < self._restoreHoldSeconds:
+            return self.level
+
+        self._lastRestore = instant
+        return self.level - 1
+
+    def update(self, busySeconds, frameIntervalSeconds, instant):
+        """
+        Updates governor with processing time of single frame
+
+        :param busySeconds: time spent for processing of frame
+        :param frameIntervalSeconds: interval between frames of camera
+        :param instant: current time in seconds (time.time())
+        :return: True when level was changed, otherwise False
+        """
+        if frameIntervalSeconds <= 0:
+            return False
+
+        ratio = busySeconds / frameIntervalSeconds
+        if self.busyRatio is None:
+            self.busyRatio = ratio
+        else:
+            self.busyRatio += self.smoothing * (ratio - self.busyRatio)
+
+        # first frames after start aren't representative, so level isn't changed during first hold interval
+        if self._lastLevelChange is None:
+            self._lastLevelChange = instant
+
+        if instant - self._lastLevelChange < self.holdSeconds:
+            return False
+
+        level = self._nextLevel(instant)
+        if level == self.level:
+            return False
+
+        self.logger.warning("camera {}: load shedding level changed {} -> {} ({}), busy ratio = {:.2f}, load per CPU = {}".format(
+            self.cameraName,
+            self.level,
+            level,
+            LEVEL_NAMES[level],
+            self.busyRatio,
+            "{:.2f}".format(self._loadPerCpu) if self._loadPerCpu is not None else "n/a"
+        ))
+
+        self.level = level
+        self.levelChangesCount += 1
+        self._lastLevelChange = instant
+        return True
+
+    def getStats(self):
+        return {
+            "level": self.level,
+            "levelName": LEVEL_NAMES[self.level],
+            "busyRatio": self.busyRatio,
+            "loadPerCpu": self._loadPerCpu,
+            "levelChanges": self.levelChangesCount,
+        }
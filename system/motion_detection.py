@@ -1,3 +1,6 @@
+import os
+import sys
+import threading
 import cv2 as cv
 from system.shared import LastErrorHolder
 import imutils
@@ -5,6 +8,97 @@ import numpy as np
 import datetime
 
 
+# width of reference frame in saved detector state, state is small regardless of camera resolution
+DETECTOR_STATE_WIDTH = 160
+
+
+def saveDetectorState(fileName, state):
+    """
+    Saves detector state (see MotionDetector.getState()) to compressed .npz file, file is replaced atomically
+
+    :param fileName: name of output file
+    :param state: dictionary with detector state
+    :return: None
+    """
+    pendingName = fileName + ".pending"
+    with open(pendingName, "wb") as f:
+        np.savez_compressed(f, reference=state["reference"], noiseFloor=state["noiseFloor"])
+
+    # on Windows rename fails when target exists
+    if sys.platform.startswith("win") and os.path.exists(fileName):
+        os.remove(fileName)
+
+    os.rename(pendingName, fileName)
+
+
+def loadDetectorState(fileName):
+    """
+    Loads detector state saved by saveDetectorState()
+
+    :param fileName: name of .npz file
+    :return: dictionary with detector state
+    """
+    with np.load(fileName) as data:
+        return {"reference": data["reference"], "noiseFloor": float(data["noiseFloor"])}
+
+
+class DetectorStateSaver(threading.Thread):
+    """
+    Saves detector state in background thread, so slow disk doesn't stall capture. When previous state is
+    still being saved only the latest state is kept.
+    """
+
+    def __init__(self, logger):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self._condition = threading.Condition()
+
+        # tuple of (fileName, state) waiting to be saved
+        self._pending = None
+        self._stopped = False
+
+    def save(self, fileName, state):
+        with self._condition:
+            self._pending = (fileName, state)
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Requests stop of thread, pending state is saved before thread finishes
+        :return: None
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _nextState(self):
+        with self._condition:
+            while (self._pending is None) and (not self._stopped):
+                self._condition.wait()
+
+            pending = self._pending
+            self._pending = None
+            return pending
+
+    def run(self):
+        while True:
+            pending = self._nextState()
+            if pending is None:
+                break
+
+            (fileName, state) = pending
+            try:
+                dirName = os.path.dirname(fileName)
+                if not os.path.exists(dirName):
+                    os.makedirs(dirName)
+
+                saveDetectorState(fileName, state)
+            except (IOError, OSError) as e:
+                self.logger.error("can't save detector state {}: {}".format(fileName, e))
+
+
 class MotionDetectorBase(LastErrorHolder):
     """
     Base class for motion detection support
@@ -17,14 +111,93 @@ class MotionDetectorBase(LastErrorHolder):
         # DTS (date & time) of moment when last motion was detected
         self.motionDetectionDts = None
 
+        # motion score calculated for the last frame (units depend on detector), None when not calculated
+        self.lastScore = None
+
+        # thresholded difference image (non-zero pixels - motion) for the last frame
+        self.lastMotionMask = None
+
         self.resizeBeforeDetect = True
 
         self.multiFrameDetection = False
 
+        # list of rectangles (x0, y0, x1, y1) in relative frame coordinates (0.0 - 1.0) where motion is
+        # detected, None - whole frame
+        self._zones = None
+        self._zonesMask = None
+
+        # frames are scaled by this factor before detection (detection proxy), areas are reported in
+        # original frame pixels
+        self._proxyScale = 1.0
+
+    @property
+    def zones(self):
+        return self._zones
+
+    @zones.setter
+    def zones(self, value):
+        self._zones = value if value else None
+        self._zonesMask = None
+
+    @property
+    def proxyScale(self):
+        return self._proxyScale
+
+    @proxyScale.setter
+    def proxyScale(self, value):
+        if value == self._proxyScale:
+            return
+
+        # previous frames have different size
+        self._proxyScale = value
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets previous frames
+        """
+        self.prevFrame = None
+
+    def memoryBytes(self):
+        """
+        Returns size of frames kept by detector
+        """
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def originalArea(self, proxyArea):
+        """
+        Converts area in pixels of detection proxy to area in pixels of original frame
+        """
+        if self._proxyScale == 1.0:
+            return proxyArea
+
+        return int(proxyArea / (self._proxyScale * self._proxyScale))
+
+    def applyZones(self, motionMask):
+        """
+        Clears motion outside of zones
+
+        :param motionMask: thresholded difference image
+        :return: motion mask
+        """
+        if self._zones is None:
+            return motionMask
+
+        if (self._zonesMask is None) or (self._zonesMask.shape != motionMask.shape):
+            (height, width) = motionMask.shape[:2]
+            self._zonesMask = np.zeros(motionMask.shape, dtype=motionMask.dtype)
+            for (x0, y0, x1, y1) in self._zones:
+                self._zonesMask[int(y0 * height):int(y1 * height), int(x0 * width):int(x1 * width)] = 255
+
+        return cv.bitwise_and(motionMask, self._zonesMask)
+
     def preprocessInputFrame(self, newFrame):
         if self.resizeBeforeDetect:
             return imutils.resize(newFrame, width=500, height=500)
 
+        if self._proxyScale != 1.0:
+            return cv.resize(newFrame, None, fx=self._proxyScale, fy=self._proxyScale, interpolation=cv.INTER_AREA)
+
         return newFrame.copy()
 
     def checkMotionDetected(self, frame):
@@ -70,6 +243,8 @@ class MotionDetectorV1(MotionDetectorBase):
         nb = height * width
 
         qty = 0
+        self.lastScore = 0
+        self.lastMotionMask = thresh
         for c in cnts:
             a = cv.boundingRect(c)
 
@@ -77,6 +252,7 @@ class MotionDetectorV1(MotionDetectorBase):
             s = w * h
 
             pcs = (float(s) / float(nb)) * 100
+            self.lastScore = max(self.lastScore, pcs)
 
             if pcs < self.threshold:
                 continue
@@ -126,6 +302,8 @@ class MotionDetectorV2(MotionDetectorBase):
         nb = cv.countNonZero(th1)
 
         avg = (nb * 100) / (height * width)  # Calculate the average of black pixel in the image
+        self.lastScore = avg
+        self.lastMotionMask = th1
 
         self.prevFrame = gray
 
@@ -175,6 +353,8 @@ class MotionDetectorV3(MotionDetectorBase):
         cv.erode(th1, None, iterations=1)
 
         delta_count = cv.countNonZero(th1)
+        self.lastScore = delta_count
+        self.lastMotionMask = th1
 
         cv.imshow("frame_th1", th1)
 
@@ -196,6 +376,101 @@ class MotionDetector(MotionDetectorBase):
         self.threshold = 1500
         self.prevPrevFrame = None
 
+        # smoothed mean difference between consecutive frames without motion (camera noise)
+        self.noiseFloor = None
+
+        # saved state which is restored when scene matches it (see warmStart())
+        self._warmStartState = None
+        self._warmStartConfirmFrames = 0
+        self._warmStartMaxDifference = 0
+        self._warmStartMatches = 0
+
+    def reset(self):
+        MotionDetectorBase.reset(self)
+        self.prevPrevFrame = None
+
+    def grayFrame(self, new_frame):
+        frame = self.preprocessInputFrame(new_frame)
+
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        return cv.GaussianBlur(gray, (11, 11), 0)
+
+    def getState(self):
+        """
+        Returns state which can be saved and restored after restart: reference frame (scaled down to
+        DETECTOR_STATE_WIDTH) and noise floor
+
+        :return: dictionary with state, None when detector has no reference frame yet
+        """
+        if self.prevFrame is None:
+            return None
+
+        (height, width) = self.prevFrame.shape[:2]
+        size = (DETECTOR_STATE_WIDTH, max(1, int(round(float(height) * DETECTOR_STATE_WIDTH / width))))
+        reference = cv.resize(self.prevFrame, size, interpolation=cv.INTER_AREA)
+
+        return {"reference": reference, "noiseFloor": self.noiseFloor if self.noiseFloor is not None else 0.0}
+
+    def warmStart(self, state, confirmFrames = 0, maxDifference = 0):
+        """
+        Sets saved state which is restored by confirmScene() when scene matches it
+
+        :param state: dictionary returned by getState(), None - cancels warm start
+        :param confirmFrames: count of consecutive frames which must match reference frame
+        :param maxDifference: max mean difference (0 - 255) of frame and reference frame above noise floor
+        :return: None
+        """
+        self._warmStartState = state
+        self._warmStartConfirmFrames = confirmFrames
+        self._warmStartMaxDifference = maxDifference
+        self._warmStartMatches = 0
+
+    def confirmScene(self, new_frame):
+        """
+        Compares frame with reference frame of saved state. When enough consecutive frames match it, noise floor
+        is restored and the last frame becomes previous frame, so motion can be detected in the next frame
+
+        :param new_frame: new frame from camera
+        :return: True when state restored, otherwise False
+        """
+        state = self._warmStartState
+        if state is None:
+            return False
+
+        gray = self.grayFrame(new_frame)
+        cv.normalize(gray, gray, 0, 255, cv.NORM_MINMAX)
+
+        # frame is compared with reference at its size, state is useless when aspect ratio of camera changed
+        reference = state["reference"]
+        (height, width) = gray.shape[:2]
+        (referenceHeight, referenceWidth) = reference.shape[:2]
+        if abs(float(width) / height - float(referenceWidth) / referenceHeight) > 0.02:
+            self.warmStart(None)
+            return False
+
+        scaled = cv.resize(gray, (referenceWidth, referenceHeight), interpolation=cv.INTER_AREA)
+        difference = cv.mean(cv.absdiff(scaled, reference))[0]
+        if difference > state["noiseFloor"] + self._warmStartMaxDifference:
+            self._warmStartMatches = 0
+            return False
+
+        self._warmStartMatches += 1
+        if self._warmStartMatches < self._warmStartConfirmFrames:
+            return False
+
+        self.warmStart(None)
+        self.noiseFloor = state["noiseFloor"]
+        self.prevFrame = gray
+        self.prevPrevFrame = gray if self.multiFrameDetection else None
+        return True
+
+    def _updateNoiseFloor(self, frameDiff):
+        meanDiff = cv.mean(frameDiff)[0]
+        if self.noiseFloor is None:
+            self.noiseFloor = meanDiff
+        else:
+            self.noiseFloor += (meanDiff - self.noiseFloor) * 0.05
+
     def diffImg(self, t0, t1, t2):
         if not self.multiFrameDetection:
             return cv.absdiff(t2, t1)
@@ -205,10 +480,10 @@ class MotionDetector(MotionDetectorBase):
         return cv.bitwise_and(d1, d2)
 
     def motionDetected(self, new_frame):
-        frame = self.preprocessInputFrame(new_frame)
+        gray = self.grayFrame(new_frame)
 
-        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-        gray = cv.GaussianBlur(gray, (11, 11), 0)
+        # first frame is normalized too, so it's compared with next frames in the same range
+        cv.normalize(gray, gray, 0, 255, cv.NORM_MINMAX)
 
         if (self.multiFrameDetection) and (self.prevPrevFrame is None):
             self.prevPrevFrame = gray
@@ -218,21 +493,23 @@ class MotionDetector(MotionDetectorBase):
             self.prevFrame = gray
             return False
 
-        cv.normalize(gray, gray, 0, 255, cv.NORM_MINMAX)
-
         frameDiff = self.diffImg(self.prevPrevFrame, self.prevFrame, gray)
         ret1, th1 = cv.threshold(frameDiff, 10, 255, cv.THRESH_BINARY)
 
         th1 = cv.dilate(th1, None, iterations=8)
         th1 = cv.erode(th1, None, iterations=4)
+        th1 = self.applyZones(th1)
 
-        delta_count = cv.countNonZero(th1)
+        delta_count = self.originalArea(cv.countNonZero(th1))
+        self.lastScore = delta_count
+        self.lastMotionMask = th1
 
         if self.multiFrameDetection:
             self.prevPrevFrame = self.prevFrame
 
         self.prevFrame = gray
         if delta_count < self.threshold:
+            self._updateNoiseFloor(frameDiff)
             return False
 
         if self.multiFrameDetection:
@@ -296,6 +573,8 @@ class MotionDetectorV3Traced(MotionDetectorBase):
             self.diffFrame2 = th1.copy()
 
         delta_count = cv.countNonZero(th1)
+        self.lastScore = delta_count
+        self.lastMotionMask = th1
 
         if self.multiFrameDetection:
             self.prevPrevFrame = self.prevFrame
@@ -363,6 +642,8 @@ class MotionDetectorV4(MotionDetectorBase):
             totalArea += cv.contourArea(c)
             cv.drawContours(frame, [c], 0, (0, 0, 255), 2)
 
+        self.lastScore = totalArea
+        self.lastMotionMask = th1
         if totalArea < self.threshold:
             return False
 
@@ -0,0 +1,308 @@
+import os
+import time
+import bisect
+import threading
+import Queue
+import datetime as dts
+import numpy as np
+import cv2 as cv
+from system.shared import mkdir_p
+from system.clip_metadata import ClipMetadata
+
+
+# occupancy grid is GRID_SIZE x GRID_SIZE cells, packed into GRID_WORDS 64-bit words
+GRID_SIZE = 16
+GRID_WORDS = GRID_SIZE * GRID_SIZE // 64
+
+# one record per second with motion: UTC seconds since epoch and packed occupancy bitmap
+OCCUPANCY_DTYPE = np.dtype([("ts", np.uint32), ("bits", np.uint64, (GRID_WORDS,))])
+
+EPOCH = dts.datetime(1970, 1, 1)
+
+
+def packGrid(grid):
+    """
+    Packs boolean grid GRID_SIZE x GRID_SIZE into bitmap
+
+    :param grid: numpy array of bool
+    :return: numpy array of GRID_WORDS uint64
+    """
+    return np.packbits(grid.ravel().astype(np.uint8)).view(np.uint64)
+
+
+def rectangleBitmap(x0, y0, x1, y1):
+    """
+    Creates bitmap for rectangle in relative frame coordinates (0.0 - 1.0)
+
+    :return: numpy array of GRID_WORDS uint64
+    """
+    grid = np.zeros((GRID_SIZE, GRID_SIZE), dtype=bool)
+
+    col0 = int(max(0.0, min(x0, x1)) * GRID_SIZE)
+    col1 = int(np.ceil(min(1.0, max(x0, x1)) * GRID_SIZE))
+    row0 = int(max(0.0, min(y0, y1)) * GRID_SIZE)
+    row1 = int(np.ceil(min(1.0, max(y0, y1)) * GRID_SIZE))
+
+    grid[row0:max(row1, row0 + 1), col0:max(col1, col0 + 1)] = True
+    return packGrid(grid)
+
+
+def occupancyFileName(basePath, cameraName, day):
+    return os.path.join(basePath, cameraName, "{:04}{:02}{:02}.occ".format(day.year, day.month, day.day))
+
+
+class OccupancyWriter(threading.Thread):
+    """
+    Appends occupancy records to per-day files in background thread, so capture thread never waits for disk
+    """
+
+    def __init__(self, logger, basePath, cameraName):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.basePath = basePath
+        self.cameraName = cameraName
+
+        self._queue = Queue.Queue()
+
+    def put(self, records):
+        """
+        Adds records to writing queue
+
+        :param records: list of tuples (second, packed bitmap) ordered by time
+        :return: None
+        """
+        self._queue.put(records)
+
+    def stop(self):
+        """
+        Requests stop of thread, queued records are written before thread finishes
+        :return: None
+        """
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                break
+
+            self._write(records)
+
+    def _write(self, records):
+        while len(records) > 0:
+            day = (EPOCH + dts.timedelta(seconds=records[0][0])).date()
+
+            dayRecords = []
+            while (len(records) > 0) and ((EPOCH + dts.timedelta(seconds=records[0][0])).date() == day):
+                dayRecords.append(records.pop(0))
+
+            self._append(day, dayRecords)
+
+    def _append(self, day, records):
+        fileName = occupancyFileName(self.basePath, self.cameraName, day)
+        if not mkdir_p(os.path.dirname(fileName)):
+            self.logger.error("can't create directory for occupancy file: {}".format(fileName))
+            return
+
+        data = np.zeros(len(records), dtype=OCCUPANCY_DTYPE)
+        for (index, (second, bits)) in enumerate(records):
+            data[index] = (second, bits)
+
+        try:
+            with open(fileName, "ab") as f:
+                data.tofile(f)
+        except (IOError, OSError) as e:
+            self.logger.error("can't write occupancy file {}: {}".format(fileName, e))
+
+
+class OccupancyRecorder:
+    """
+    Collects per-second spatial occupancy bitmaps of camera from motion masks, they are appended to per-day
+    files by OccupancyWriter thread. Only seconds with motion are stored.
+    """
+
+    # records are handed to writer when this count of records collected
+    FLUSH_RECORDS_QTY = 60
+
+    def __init__(self, logger, basePath, cameraName, cellThreshold = 25, flushIntervalSeconds = 10):
+        self.logger = logger
+        self.basePath = basePath
+        self.cameraName = cameraName
+
+        # min average value (0 - 255) of motion mask in grid cell to mark cell as occupied
+        self.cellThreshold = cellThreshold
+
+        # max seconds collected records wait before they are handed to writer
+        self.flushIntervalSeconds = flushIntervalSeconds
+
+        self._second = None
+        self._grid = np.zeros((GRID_SIZE, GRID_SIZE), dtype=bool)
+
+        self._pending = []
+        self._flushTime = time.time()
+        self._writer = None
+
+    def add(self, frameDts, motionMask):
+        """
+        Adds motion mask of frame to occupancy of current second
+
+        :param frameDts: DTS of frame (UTC)
+        :param motionMask: thresholded difference image
+        :return: None
+        """
+        second = int((frameDts - EPOCH).total_seconds())
+        if second != self._second:
+            self._closeSecond()
+            self._second = second
+
+        cells = cv.resize(motionMask, (GRID_SIZE, GRID_SIZE), interpolation=cv.INTER_AREA)
+        self._grid |= (cells >= self.cellThreshold)
+
+    def _closeSecond(self):
+        if (self._second is not None) and self._grid.any():
+            self._pending.append((self._second, packGrid(self._grid)))
+            self._grid[:] = False
+
+        # on quiet camera records are still written soon, so they can be searched and aren't lost on crash
+        if (len(self._pending) >= self.FLUSH_RECORDS_QTY) or (time.time() - self._flushTime >= self.flushIntervalSeconds):
+            self._handOver()
+
+    def _handOver(self):
+        self._flushTime = time.time()
+        if len(self._pending) == 0:
+            return
+
+        if self._writer is None:
+            self._writer = OccupancyWriter(self.logger, self.basePath, self.cameraName)
+            self._writer.start()
+
+        self._writer.put(self._pending)
+        self._pending = []
+
+    def flush(self):
+        """
+        Hands collected records (including current second) to writer thread
+        :return: None
+        """
+        self._closeSecond()
+        self._second = None
+        self._handOver()
+
+    def close(self):
+        """
+        Writes collected records and stops writer thread, called when recorder stops
+        :return: None
+        """
+        self.flush()
+
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer.join()
+            self._writer = None
+
+
+class OccupancyStore:
+    """
+    Searches stored occupancy bitmaps
+    """
+    def __init__(self, basePath):
+        self.basePath = basePath
+
+    def _loadDay(self, cameraName, day):
+        fileName = occupancyFileName(self.basePath, cameraName, day)
+        if not os.path.exists(fileName):
+            return None
+
+        # file may be appended right now, so only complete records are used
+        qty = os.path.getsize(fileName) // OCCUPANCY_DTYPE.itemsize
+        if qty == 0:
+            return None
+
+        return np.memmap(fileName, dtype=OCCUPANCY_DTYPE, mode="r", shape=(qty,))
+
+    def findSeconds(self, cameraName, bitmap, startDts, endDts):
+        """
+        Finds seconds when motion was in area of bitmap
+
+        :param cameraName: camera name
+        :param bitmap: area bitmap, see rectangleBitmap()
+        :param startDts: range start (UTC)
+        :param endDts: range end (UTC)
+        :return: sorted numpy array of seconds since epoch
+        """
+        startTs = int((startDts - EPOCH).total_seconds())
+        endTs = int((endDts - EPOCH).total_seconds())
+
+        result = []
+        day = startDts.date()
+        while day <= endDts.date():
+            records = self._loadDay(cameraName, day)
+            day += dts.timedelta(days=1)
+            if records is None:
+                continue
+
+            # records are appended in time order
+            first = np.searchsorted(records["ts"], startTs, side="left")
+            last = np.searchsorted(records["ts"], endTs, side="left")
+            records = records[first:last]
+
+            matched = np.any((records["bits"] & bitmap) != 0, axis=1)
+            result.append(np.asarray(records["ts"][matched]))
+
+        if len(result) == 0:
+            return np.zeros(0, dtype=np.uint32)
+
+        return np.concatenate(result)
+
+    @staticmethod
+    def groupSeconds(seconds, maxGap = 1):
+        """
+        Groups seconds into ranges
+
+        :return: list of tuples (first second, last second)
+        """
+        ranges = []
+        for second in seconds:
+            second = int(second)
+            if (len(ranges) > 0) and (second - ranges[-1][1] <= maxGap):
+                ranges[-1][1] = second
+            else:
+                ranges.append([second, second])
+
+        return [tuple(item) for item in ranges]
+
+    @staticmethod
+    def mapToClips(ranges, clips):
+        """
+        Maps time ranges to clips from recording index
+
+        :param ranges: list of (first second, last second)
+        :param clips: list of ClipRecord ordered by start
+        :return: list of tuples (clip path, position in video in seconds, duration in seconds)
+        """
+        starts = [(clip.startDts - EPOCH).total_seconds() for clip in clips]
+
+        result = []
+        for (first, last) in ranges:
+            index = bisect.bisect_right(starts, first + 1) - 1
+            if index < 0:
+                continue
+
+            clip = clips[index]
+            clipEnd = (clip.endDts - EPOCH).total_seconds()
+            if first > clipEnd:
+                continue
+
+            # clip may contain merged motion-events, so seconds are mapped to video with its segments
+            metadata = ClipMetadata.load(clip.path)
+            if (metadata is not None) and (len(metadata.segments) > 0):
+                offset = metadata.videoOffset(EPOCH + dts.timedelta(seconds=first))
+                end = metadata.videoOffset(EPOCH + dts.timedelta(seconds=last + 1))
+                result.append((clip.path, offset, end - offset))
+                continue
+
+            offset = max(0.0, first - starts[index])
+            result.append((clip.path, offset, last - first + 1))
+
+        return result
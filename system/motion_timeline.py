@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import cv2 as cv
+
+
+# record of timeline: position of frame in video in milliseconds and motion score
+TIMELINE_DTYPE = np.dtype([("offsetMs", np.uint32), ("score", np.float32)])
+
+
+def timelineFileName(clipFileName):
+    return os.path.splitext(clipFileName)[0] + ".timeline.npy"
+
+
+def heatmapFileName(clipFileName):
+    return os.path.splitext(clipFileName)[0] + ".heatmap.npy"
+
+
+class MotionTimeline:
+    """
+    Per-frame motion scores of clip (and optional coarse heatmap of motion for each frame) kept in
+    numpy arrays. Saved as .npy sidecar files next to clip, so activity can be drawn without decoding video.
+    """
+
+    CHUNK_SIZE = 1024
+
+    def __init__(self, gridSize = 0):
+        self.gridSize = gridSize
+
+        self._records = np.zeros(self.CHUNK_SIZE, dtype=TIMELINE_DTYPE)
+        self._heatmap = None
+        if gridSize > 0:
+            self._heatmap = np.zeros((self.CHUNK_SIZE, gridSize, gridSize), dtype=np.uint8)
+
+        self._qty = 0
+
+    def __len__(self):
+        return self._qty
+
+    @property
+    def records(self):
+        return self._records[:self._qty]
+
+    @property
+    def heatmap(self):
+        if self._heatmap is None:
+            return None
+
+        return self._heatmap[:self._qty]
+
+    def _grow(self):
+        size = len(self._records) * 2
+        self._records = np.resize(self._records, size)
+        if self._heatmap is not None:
+            self._heatmap = np.resize(self._heatmap, (size, self.gridSize, self.gridSize))
+
+    def add(self, offset, score, motionMask = None):
+        """
+        Adds motion score of frame
+
+        :param offset: position of frame in video (seconds)
+        :param score: motion score
+        :param motionMask: thresholded difference image of frame, used for heatmap
+        :return: None
+        """
+        if self._qty == len(self._records):
+            self._grow()
+
+        self._records[self._qty] = (int(offset * 1000), score)
+
+        if self._heatmap is not None:
+            if motionMask is not None:
+                # average of each grid cell, 255 - motion in whole cell
+                self._heatmap[self._qty] = cv.resize(motionMask, (self.gridSize, self.gridSize), interpolation=cv.INTER_AREA)
+            else:
+                self._heatmap[self._qty] = 0
+
+        self._qty += 1
+
+    def save(self, clipFileName):
+        """
+        Saves timeline (and heatmap) next to clip
+
+        :param clipFileName: clip file name
+        :return: True on success, otherwise False
+        """
+        try:
+            np.save(timelineFileName(clipFileName), self.records)
+            if self._heatmap is not None:
+                np.save(heatmapFileName(clipFileName), self.heatmap)
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    @staticmethod
+    def load(clipFileName, mmapMode = "r"):
+        """
+        Loads timeline records and heatmap of clip, arrays are memory-mapped by default
+
+        :param clipFileName: clip file name
+        :return: tuple of (records, heatmap or None) or (None, None) when timeline is not available
+        """
+        try:
+            records = np.load(timelineFileName(clipFileName), mmap_mode=mmapMode)
+        except (IOError, OSError, ValueError):
+            return (None, None)
+
+        heatmap = None
+        if os.path.exists(heatmapFileName(clipFileName)):
+            heatmap = np.load(heatmapFileName(clipFileName), mmap_mode=mmapMode)
+
+        return (records, heatmap)
+
+    @staticmethod
+    def peaks(records, qty = 5, minDistanceMs = 2000):
+        """
+        Finds offsets of motion peaks, peaks are at least minDistanceMs apart
+
+        :param records: timeline records
+        :param qty: max count of peaks
+        :return: list of offsets in milliseconds ordered by score
+        """
+        result = []
+        for index in np.argsort(records["score"])[::-1]:
+            if records["score"][index] <= 0:
+                break
+
+            offset = int(records["offsetMs"][index])
+            if all(abs(offset - prev) >= minDistanceMs for prev in result):
+                result.append(offset)
+
+            if len(result) >= qty:
+                break
+
+        return result
@@ -0,0 +1,385 @@
+import os
+import time
+import uuid
+import subprocess
+import threading
+import multiprocessing
+import Queue
+import numpy as np
+import cv2 as cv
+import config
+from system.motion_timeline import MotionTimeline
+from system.clip_metadata import CODEC_EXTENSIONS
+
+
+def thumbnailFileName(clipFileName):
+    return os.path.splitext(clipFileName)[0] + ".thumb.jpg"
+
+
+def contactSheetFileName(clipFileName):
+    return os.path.splitext(clipFileName)[0] + ".sheet.jpg"
+
+
+def transcodedFileName(clipFileName, ffmpegArgs):
+    """
+    Returns name of transcoded clip, container is chosen by video codec in ffmpeg arguments
+    """
+    codec = None
+    for (index, arg) in enumerate(ffmpegArgs[:-1]):
+        if arg in ["-c:v", "-codec:v", "-vcodec"]:
+            codec = ffmpegArgs[index + 1]
+
+    (base, ext) = os.path.splitext(clipFileName)
+    return base + CODEC_EXTENSIONS.get(codec, ext)
+
+
+class PostProcessingOptions:
+    """
+    Options passed to worker processes
+    """
+    def __init__(self):
+        # ffmpeg executable and arguments of output file, None - transcoding disabled
+        self.ffmpeg = config.POST_PROCESSING_FFMPEG
+        self.ffmpegArgs = list(config.POST_PROCESSING_FFMPEG_ARGS)
+
+        # count of motion peaks in contact sheet, 0 - thumbnails disabled
+        self.peaksQty = config.POST_PROCESSING_PEAKS_QTY
+        self.thumbnailWidth = config.POST_PROCESSING_THUMBNAIL_WIDTH
+        self.contactSheetColumns = config.POST_PROCESSING_CONTACT_SHEET_COLUMNS
+
+
+def _initWorker(niceness):
+    try:
+        os.nice(niceness)
+    except (AttributeError, OSError):
+        pass
+
+    # worker shouldn't compete for all cores with live capture
+    cv.setNumThreads(1)
+
+
+def _peakFrameIndexes(clipFileName, framesCount, qty):
+    """
+    Maps motion peaks of clip timeline to frame indexes of clip
+    """
+    (records, heatmap) = MotionTimeline.load(clipFileName)
+    if (records is None) or (framesCount <= 0):
+        return []
+
+    # timeline offsets are positions in video
+    return [min(framesCount - 1, int(offset * config.OUTPUT_FRAME_RATE / 1000)) for offset in MotionTimeline.peaks(records, qty)]
+
+
+def _readFrames(clipFileName, frameIndexes):
+    """
+    Reads frames with given indexes in single pass
+
+    :return: dict of frame index to frame
+    """
+    frames = {}
+    wanted = set(frameIndexes)
+
+    cap = cv.VideoCapture(clipFileName)
+    index = 0
+    while len(frames) < len(wanted):
+        (ret, frame) = cap.read()
+        if not ret:
+            break
+
+        if index in wanted:
+            frames[index] = frame
+
+        index += 1
+
+    cap.release()
+    return frames
+
+
+def _resizeToWidth(frame, width):
+    height = int(frame.shape[0] * float(width) / frame.shape[1])
+    return cv.resize(frame, (width, height), interpolation=cv.INTER_AREA)
+
+
+def _saveThumbnails(clipFileName, options):
+    """
+    Saves thumbnail of the strongest motion peak and contact sheet of motion peaks
+
+    :return: list of saved file names
+    """
+    cap = cv.VideoCapture(clipFileName)
+    framesCount = int(cap.get(cv.CAP_PROP_FRAME_COUNT) or 0)
+    cap.release()
+
+    # peaks are ordered by score
+    frameIndexes = _peakFrameIndexes(clipFileName, framesCount, options.peaksQty)
+    frames = _readFrames(clipFileName, frameIndexes)
+    frameIndexes = [index for index in frameIndexes if index in frames]
+    if len(frameIndexes) == 0:
+        return []
+
+    cv.imwrite(thumbnailFileName(clipFileName), _resizeToWidth(frames[frameIndexes[0]], options.thumbnailWidth))
+
+    # contact sheet shows peaks in time order, empty cells of last row are black
+    thumbnails = [_resizeToWidth(frames[index], options.thumbnailWidth) for index in sorted(frameIndexes)]
+    columns = min(options.contactSheetColumns, len(thumbnails))
+    thumbnails += [np.zeros_like(thumbnails[0])] * ((columns - len(thumbnails) % columns) % columns)
+    rows = [np.hstack(thumbnails[i:i + columns]) for i in range(0, len(thumbnails), columns)]
+    cv.imwrite(contactSheetFileName(clipFileName), np.vstack(rows))
+
+    return [thumbnailFileName(clipFileName), contactSheetFileName(clipFileName)]
+
+
+def _transcode(clipFileName, options):
+    """
+    Transcodes clip to temporary file which replaces original when result is smaller, container of transcoded
+    clip matches its codec (see transcodedFileName())
+
+    :return: tuple of (clip file name, size of clip after transcoding or None when clip wasn't replaced)
+    """
+    newFileName = transcodedFileName(clipFileName, options.ffmpegArgs)
+    (dirName, baseName) = os.path.split(newFileName)
+    tmpName = os.path.join(dirName, ".post_{}{}".format(uuid.uuid4().hex, os.path.splitext(baseName)[1]))
+
+    command = [options.ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", clipFileName] + options.ffmpegArgs + [tmpName]
+    with open(os.devnull, "wb") as devnull:
+        code = subprocess.call(command, stdout=devnull, stderr=devnull)
+
+    if (code != 0) or (not os.path.exists(tmpName)):
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise IOError("ffmpeg failed with exit code {}".format(code))
+
+    newSize = os.path.getsize(tmpName)
+
+    # clip may be passed on without result already (processing timed out)
+    if (not os.path.exists(clipFileName)) or (newSize >= os.path.getsize(clipFileName)):
+        os.remove(tmpName)
+        return (clipFileName, None)
+
+    os.rename(tmpName, newFileName)
+    if newFileName != clipFileName:
+        os.remove(clipFileName)
+
+    return (newFileName, newSize)
+
+
+def postProcessClip(clipFileName, options):
+    """
+    Post-processes clip in worker process
+
+    :param clipFileName: clip file name
+    :param options: PostProcessingOptions
+    :return: tuple of (clip file name after transcoding, size after transcoding or None, list of thumbnail files,
+             error text or None)
+    """
+    newFileName = clipFileName
+    newSize = None
+    thumbnails = []
+    try:
+        # thumbnails are made from original clip, it is decoded faster
+        if options.peaksQty > 0:
+            thumbnails = _saveThumbnails(clipFileName, options)
+
+        if options.ffmpeg is not None:
+            (newFileName, newSize) = _transcode(clipFileName, options)
+    except Exception as e:
+        return (newFileName, newSize, thumbnails, str(e))
+
+    return (newFileName, newSize, thumbnails, None)
+
+
+class PostProcessingJob:
+    def __init__(self, fileName, metadata, originalSize, result, deadline):
+        self.fileName = fileName
+        self.metadata = metadata
+        self.originalSize = originalSize
+
+        # AsyncResult of worker
+        self.result = result
+        self.deadline = deadline
+
+
+class ClipPostProcessor(threading.Thread):
+    """
+    Post-processes finished clips (transcoding to denser codec, thumbnails and contact sheet of motion peaks)
+    in pool of low priority processes. Clips are passed to next listeners after processing, so it should be
+    the first clip listener of recorder.
+    """
+
+    def __init__(self, logger):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self.options = PostProcessingOptions()
+        self.processesQty = max(1, config.POST_PROCESSING_PROCESSES)
+        self.niceness = config.POST_PROCESSING_NICENESS
+
+        # new clips are not processed while load average per CPU is above this value
+        self.maxLoadPerCpu = config.POST_PROCESSING_MAX_LOAD_PER_CPU
+        self.loadCheckIntervalSeconds = 5
+
+        # clip is passed on without result when worker doesn't return it in time (worker was killed or hung)
+        self.timeoutSeconds = config.POST_PROCESSING_TIMEOUT_SECONDS
+        self.reapIntervalSeconds = 1.0
+
+        # functions which will be called for each processed clip: listener(fileName, metadata)
+        self.clipListeners = []
+
+        self.processedFilesCount = 0
+        self.failedFilesCount = 0
+        self.timedOutFilesCount = 0
+        self.savedBytes = 0
+
+        self._queue = Queue.Queue()
+        self._slots = threading.Semaphore(self.processesQty)
+        self._stopEvent = threading.Event()
+        self._pool = None
+
+        # PostProcessingJob of clips which are processed by workers
+        self._jobs = []
+        self._jobsLock = threading.Lock()
+        self._submitFinished = threading.Event()
+        self._reaper = None
+
+    def start(self):
+        # pool is created before capture threads are started, so workers are forked from small process
+        self._pool = multiprocessing.Pool(self.processesQty, _initWorker, (self.niceness,))
+
+        self._reaper = threading.Thread(target=self._reapJobs)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+        threading.Thread.start(self)
+
+    def enqueue(self, fileName, metadata):
+        """
+        Adds finished clip to processing queue, can be used as recorder clip listener
+        """
+        self._queue.put((fileName, metadata))
+
+    def stop(self):
+        self._stopEvent.set()
+        self._queue.put(None)
+
+    def getStats(self):
+        return {
+            "queueDepth": self._queue.qsize(),
+            "processedFiles": self.processedFilesCount,
+            "failedFiles": self.failedFilesCount,
+            "timedOutFiles": self.timedOutFilesCount,
+            "savedBytes": self.savedBytes,
+        }
+
+    def _isCpuBusy(self):
+        if self.maxLoadPerCpu <= 0:
+            return False
+
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return False
+
+        return (load / multiprocessing.cpu_count()) > self.maxLoadPerCpu
+
+    def _waitIdleCpu(self):
+        while self._isCpuBusy() and (not self._stopEvent.is_set()):
+            self._stopEvent.wait(self.loadCheckIntervalSeconds)
+
+    def _notifyListeners(self, fileName, metadata):
+        for listener in self.clipListeners:
+            try:
+                listener(fileName, metadata)
+            except Exception as e:
+                self.logger.error("clip listener failed for {}: {}".format(fileName, e))
+
+    def _onProcessed(self, job, result):
+        (newFileName, newSize, thumbnails, error) = result
+        self._slots.release()
+
+        if error is not None:
+            self.failedFilesCount += 1
+            self.logger.error("can't post-process clip {}: {}".format(job.fileName, error))
+        else:
+            self.processedFilesCount += 1
+            if newSize is not None:
+                self.savedBytes += job.originalSize - newSize
+                self.logger.info("clip transcoded: {} ({} -> {} bytes)".format(newFileName, job.originalSize, newSize))
+
+        self._notifyListeners(newFileName, job.metadata)
+
+    def _jobResult(self, job):
+        """
+        Returns result of finished or timed out job
+
+        :return: result of postProcessClip() or None when job is still running
+        """
+        if job.result.ready():
+            try:
+                return job.result.get()
+            except Exception as e:
+                return (job.fileName, None, [], str(e))
+
+        if time.time() < job.deadline:
+            return None
+
+        # pool never returns result of killed worker, so original clip is passed on
+        self.timedOutFilesCount += 1
+        return (job.fileName, None, [], "no result in {} seconds, worker was killed or hung".format(self.timeoutSeconds))
+
+    def _reapJobs(self):
+        """
+        Collects results of workers (pool callback is never called when worker dies)
+        """
+        while not (self._submitFinished.is_set() and (len(self._jobs) == 0)):
+            time.sleep(self.reapIntervalSeconds)
+
+            with self._jobsLock:
+                jobs = list(self._jobs)
+
+            for job in jobs:
+                result = self._jobResult(job)
+                if result is None:
+                    continue
+
+                with self._jobsLock:
+                    self._jobs.remove(job)
+
+                self._onProcessed(job, result)
+
+    def _submit(self, fileName, metadata):
+        try:
+            originalSize = os.path.getsize(fileName)
+        except OSError as e:
+            self.logger.error("can't post-process clip {}: {}".format(fileName, e))
+            self._notifyListeners(fileName, metadata)
+            return
+
+        self._slots.acquire()
+        result = self._pool.apply_async(postProcessClip, (fileName, self.options))
+        with self._jobsLock:
+            self._jobs.append(PostProcessingJob(fileName, metadata, originalSize, result, time.time() + self.timeoutSeconds))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            # when stop requested remaining clips are passed on without processing
+            if not self._stopEvent.is_set():
+                self._waitIdleCpu()
+
+            if self._stopEvent.is_set():
+                self._notifyListeners(*item)
+                continue
+
+            self._submit(*item)
+
+        # waiting for clips which are processed right now
+        self._submitFinished.set()
+        self._reaper.join()
+
+        # all jobs are finished or timed out, so remaining workers are idle or hung
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,228 @@
+import os
+import collections
+import numpy as np
+import cv2 as cv
+
+
+class EncodedFrame:
+    """
+    Frame compressed to JPEG, it's decoded by writer thread
+    """
+    def __init__(self, data, shape):
+        self.data = data
+        self.shape = shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def decode(self):
+        return cv.imdecode(self.data, cv.IMREAD_COLOR)
+
+
+def encodeFrame(frame, quality):
+    """
+    Compresses frame to JPEG
+
+    :return: EncodedFrame or original frame when it can't be encoded
+    """
+    (ret, data) = cv.imencode(".jpg", frame, [cv.IMWRITE_JPEG_QUALITY, quality])
+    return EncodedFrame(data, frame.shape) if ret else frame
+
+
+class MemoryPreAlarmBuffer:
+    """
+    Keeps pre-alarm frames in memory. When memory limit is set, frames are compressed to JPEG if full window
+    of raw frames doesn't fit into limit and the oldest frames are removed (window is shortened) if compressed
+    frames still don't fit.
+
+    Window is maxFramesQty frames of camera. When only every N-th frame is buffered (see load shedding), frame
+    is added with repeat N and it's returned N times by drain(), so window duration doesn't change.
+    """
+    def __init__(self, maxFramesQty, maxBytes = 0, jpegQuality = 90):
+        self._maxFramesQty = maxFramesQty
+        self._frames = collections.deque()
+        self._repeats = collections.deque()
+
+        # count of frames returned by drain()
+        self.framesQty = 0
+
+        # memory limit of buffered frames (0 - unlimited)
+        self.maxBytes = maxBytes
+        self.jpegQuality = jpegQuality
+
+        # size of buffered frames
+        self.bytesQty = 0
+
+        # True when frames are compressed, True when the oldest frame was removed to fit into limit
+        self.compressed = False
+        self.shrunk = False
+
+    @property
+    def maxFramesQty(self):
+        return self._maxFramesQty
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _popOldest(self):
+        self.bytesQty -= self._frames.popleft().nbytes
+        self.framesQty -= self._repeats.popleft()
+
+    def append(self, frame, repeat = 1):
+        # count of frames which are kept in full window
+        storedQty = (self.maxFramesQty + repeat - 1) // repeat
+        self.compressed = (self.maxBytes > 0) and (frame.nbytes * storedQty > self.maxBytes)
+        if self.compressed:
+            frame = encodeFrame(frame, self.jpegQuality)
+
+        self._frames.append(frame)
+        self._repeats.append(repeat)
+        self.bytesQty += frame.nbytes
+        self.framesQty += repeat
+
+        while self.framesQty - self._repeats[0] >= self.maxFramesQty:
+            self._popOldest()
+
+        self.shrunk = False
+        while (self.maxBytes > 0) and (self.bytesQty > self.maxBytes) and (len(self._frames) > 1):
+            self._popOldest()
+            self.shrunk = True
+
+    def drain(self):
+        """
+        Returns all buffered frames (from the oldest to the newest) and clears buffer, compressed frames
+        are returned as EncodedFrame
+
+        :return: list of frames
+        """
+        frames = [frame for (frame, repeat) in zip(self._frames, self._repeats) for _ in range(repeat)]
+        self._frames.clear()
+        self._repeats.clear()
+        self.bytesQty = 0
+        self.framesQty = 0
+        return frames
+
+    def release(self):
+        """
+        Called when frames returned by drain() are written and not needed anymore
+        :return: None
+        """
+        pass
+
+    def close(self):
+        self._frames.clear()
+        self._repeats.clear()
+        self.bytesQty = 0
+        self.framesQty = 0
+
+
+class MappedPreAlarmBuffer:
+    """
+    Keeps pre-alarm frames in fixed-size ring file mapped to memory (should be placed on local SSD or tmpfs).
+    Each frame occupies slot with fixed stride, header holds ring geometry and write cursor. Memory usage is
+    bounded by the page cache and does not depend on pre-alarm window length. Like in MemoryPreAlarmBuffer,
+    frame may be added with repeat, window is maxFramesQty frames of camera.
+    """
+
+    MAGIC = 0x50524541  # "PREA"
+    VERSION = 1
+
+    # header fields (int64)
+    (H_MAGIC, H_VERSION, H_CAPACITY, H_HEIGHT, H_WIDTH, H_CHANNELS, H_FRAME_SIZE, H_WRITE_CURSOR) = range(8)
+    HEADER_SIZE = 4096
+
+    def __init__(self, fileName, maxFramesQty, frameShape):
+        self.fileName = fileName
+        self.frameShape = tuple(frameShape)
+
+        capacity = max(1, int(maxFramesQty))
+        frameSize = int(np.prod(self.frameShape))
+
+        # allocating ring file
+        with open(fileName, "wb") as f:
+            f.truncate(self.HEADER_SIZE + capacity * frameSize)
+
+        self._header = np.memmap(fileName, dtype=np.int64, mode="r+", offset=0, shape=(8,))
+        self._slots = np.memmap(fileName, dtype=np.uint8, mode="r+", offset=self.HEADER_SIZE, shape=(capacity,) + self.frameShape)
+
+        self._header[self.H_MAGIC] = self.MAGIC
+        self._header[self.H_VERSION] = self.VERSION
+        self._header[self.H_CAPACITY] = capacity
+        (self._header[self.H_HEIGHT], self._header[self.H_WIDTH]) = self.frameShape[:2]
+        self._header[self.H_CHANNELS] = self.frameShape[2] if len(self.frameShape) > 2 else 1
+        self._header[self.H_FRAME_SIZE] = frameSize
+        self._header[self.H_WRITE_CURSOR] = 0
+
+        self._capacity = capacity
+
+        # ring is backed by file, so its pages can be reclaimed by system
+        self.bytesQty = capacity * frameSize
+
+        # index of the oldest frame which was not drained yet
+        self._readCursor = 0
+
+        # how many times frame in each slot is returned by drain()
+        self._repeats = np.ones(capacity, dtype=np.int32)
+
+        # frames returned by drain() are still used by writer, ring must not be overwritten
+        self._pinned = False
+        self.droppedFrames = 0
+
+    @property
+    def maxFramesQty(self):
+        return self._capacity
+
+    @property
+    def writeCursor(self):
+        return int(self._header[self.H_WRITE_CURSOR])
+
+    def __len__(self):
+        cursor = self.writeCursor
+        return cursor - max(self._readCursor, cursor - self._capacity)
+
+    def append(self, frame, repeat = 1):
+        if self._pinned:
+            self.droppedFrames += 1
+            return
+
+        cursor = self.writeCursor
+        self._slots[cursor % self._capacity] = frame
+        self._repeats[cursor % self._capacity] = repeat
+        self._header[self.H_WRITE_CURSOR] = cursor + 1
+
+    def drain(self):
+        """
+        Returns views to buffered frames (from the oldest to the newest) without copying them. Ring is
+        not changed until release() called.
+
+        :return: list of frames
+        """
+        cursor = self.writeCursor
+        first = max(self._readCursor, cursor - self._capacity)
+
+        # the newest frames which fit into window
+        framesQty = 0
+        start = cursor
+        while (start > first) and (framesQty < self._capacity):
+            start -= 1
+            framesQty += self._repeats[start % self._capacity]
+
+        frames = [self._slots[index % self._capacity] for index in range(start, cursor) for _ in range(self._repeats[index % self._capacity])]
+
+        self._readCursor = cursor
+        self._pinned = len(frames) > 0
+        return frames
+
+    def release(self):
+        self._pinned = False
+
+    def close(self):
+        # mapping is closed when the last view to it is released
+        self._slots = None
+        self._header = None
+
+        try:
+            os.remove(self.fileName)
+        except OSError:
+            pass
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import cProfile
+import threading
+import collections
+import datetime as dts
+
+try:
+    import tracemalloc
+except ImportError:
+    # available since Python 3.4
+    tracemalloc = None
+
+
+PROFILING_MODE_CPROFILE = "cprofile"
+PROFILING_MODE_SAMPLING = "sampling"
+PROFILING_MODES = [PROFILING_MODE_CPROFILE, PROFILING_MODE_SAMPLING]
+
+
+def profileFileName(directory, cameraName, suffix):
+    """
+    Returns name of profiling result file, for example cam0_20240101_120000.prof
+    """
+    timestamp = dts.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(directory, "{}_{}{}".format(cameraName or os.getpid(), timestamp, suffix))
+
+
+class CProfileSession:
+    """
+    Deterministic profiling of thread which started session, result is saved in pstats format (can be
+    viewed with python -m pstats or snakeviz)
+    """
+
+    suffix = ".prof"
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._profile = None
+
+    def start(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def finish(self):
+        self._profile.disable()
+        self._profile.dump_stats(self.fileName)
+        self._profile = None
+
+
+def stackName(frame):
+    """
+    Returns stack of frame in folded format: functions from outermost to innermost separated by ";"
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples stack of thread with fixed interval from separate thread, profiled thread isn't slowed down
+    by tracing
+    """
+
+    def __init__(self, threadId, intervalSeconds):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.threadId = threadId
+        self.intervalSeconds = intervalSeconds
+
+        # folded stack -> count of samples
+        self.stacks = collections.Counter()
+
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def run(self):
+        while not self._stopEvent.wait(self.intervalSeconds):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is None:
+                continue
+
+            self.stacks[stackName(frame)] += 1
+
+
+class SamplingSession:
+    """
+    Sampling profiling of thread which started session, result is saved in folded stacks format (one stack
+    with count of samples per line, can be rendered with flamegraph.pl or speedscope)
+    """
+
+    suffix = ".folded"
+
+    def __init__(self, fileName, intervalSeconds = 0.005):
+        self.fileName = fileName
+        self.intervalSeconds = intervalSeconds
+        self._sampler = None
+
+    def start(self):
+        self._sampler = StackSampler(threading.current_thread().ident, self.intervalSeconds)
+        self._sampler.start()
+
+    def finish(self):
+        self._sampler.stop()
+        self._sampler.join()
+
+        with open(self.fileName, "w") as f:
+            for (stack, qty) in self._sampler.stacks.most_common():
+                f.write("{} {}\n".format(stack, qty))
+
+        self._sampler = None
+
+
+class AllocationsSession:
+    """
+    Traces memory allocations of process with tracemalloc during session and saves top allocations which are
+    still alive at the end of session (grouped by source line) to text file. Tracing is stopped when session
+    is finished, unless it was started before session.
+    """
+
+    suffix = ".allocations.txt"
+
+    def __init__(self, fileName, topQty = 25):
+        self.fileName = fileName
+        self.topQty = topQty
+        self._ownTracing = False
+        self._started = None
+
+    def start(self):
+        if tracemalloc is None:
+            raise RuntimeError("tracemalloc isn't available")
+
+        self._ownTracing = not tracemalloc.is_tracing()
+        if self._ownTracing:
+            tracemalloc.start()
+
+        self._started = time.time()
+
+    def finish(self):
+        snapshot = tracemalloc.take_snapshot()
+        (current, peak) = tracemalloc.get_traced_memory()
+        if self._ownTracing:
+            tracemalloc.stop()
+
+        statistics = snapshot.statistics("lineno")
+        with open(self.fileName, "w") as f:
+            f.write("traced for {:.1f} seconds, current {:.1f} KiB, peak {:.1f} KiB\n".format(
+                time.time() - self._started, current / 1024.0, peak / 1024.0
+            ))
+
+            for stat in statistics[:self.topQty]:
+                f.write("{}\n".format(stat))
@@ -0,0 +1,336 @@
+import os
+import re
+import sqlite3
+import threading
+import Queue
+import datetime as dts
+
+
+EPOCH = dts.datetime(1970, 1, 1)
+
+# name of output files, for example video_20170402T132017.avi or video_20170402T132017_1.avi
+CLIP_FILE_NAME_RE = re.compile(r"^video_(\d{8}T\d{6})(?:_\d+)?\.")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    frames INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    peak_score REAL NOT NULL DEFAULT 0,
+    mean_score REAL NOT NULL DEFAULT 0,
+    has_motion INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS clips_camera_start ON clips (camera, start_ts);
+CREATE INDEX IF NOT EXISTS clips_start ON clips (start_ts);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    clip_id INTEGER NOT NULL REFERENCES clips (id) ON DELETE CASCADE,
+    camera TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    peak_score REAL NOT NULL DEFAULT 0,
+    mean_score REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_camera_start ON events (camera, start_ts);
+CREATE INDEX IF NOT EXISTS events_clip ON events (clip_id);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+def toTimestamp(value):
+    """
+    Converts UTC DTS to seconds since epoch
+    """
+    return (value - EPOCH).total_seconds()
+
+
+def fromTimestamp(value):
+    return EPOCH + dts.timedelta(seconds=value)
+
+
+def parseClipFileName(fileName):
+    """
+    Extracts start DTS from clip file name
+
+    :param fileName: clip file name
+    :return: DTS or None when name doesn't match
+    """
+    match = CLIP_FILE_NAME_RE.match(os.path.basename(fileName))
+    if match is None:
+        return None
+
+    return dts.datetime.strptime(match.group(1), "%Y%m%dT%H%M%S")
+
+
+class ClipRecord:
+    def __init__(self, row):
+        (self.id, self.camera, self.path, startTs, endTs, self.frames, self.bytes,
+         self.peakScore, self.meanScore, hasMotion) = row
+
+        self.startDts = fromTimestamp(startTs)
+        self.endDts = fromTimestamp(endTs)
+        self.hasMotion = bool(hasMotion)
+
+
+class RecordingIndex:
+    """
+    SQLite index of recorded clips and motion-events. Instance must be used from single thread.
+    """
+
+    CLIP_COLUMNS = "id, camera, path, start_ts, end_ts, frames, bytes, peak_score, mean_score, has_motion"
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+        self._db = sqlite3.connect(fileName, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def _maxClipDuration(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'max_clip_duration'").fetchone()
+        return row[0] if row is not None else 0
+
+    def insertClip(self, fileName, metadata, fileSize = None):
+        """
+        Inserts (or replaces) clip with its motion-events, changes are not committed
+
+        :param fileName: clip file name
+        :param metadata: ClipMetadata
+        :param fileSize: size of clip in bytes (None - read from disk)
+        :return: clip id
+        """
+        if fileSize is None:
+            fileSize = os.path.getsize(fileName)
+
+        startTs = toTimestamp(metadata.startDts)
+        endTs = toTimestamp(metadata.endDts if metadata.endDts is not None else metadata.startDts)
+
+        cursor = self._db.execute(
+            "INSERT OR REPLACE INTO clips (camera, path, start_ts, end_ts, frames, bytes, peak_score, mean_score, has_motion) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                metadata.cameraName, os.path.abspath(fileName), startTs, endTs, metadata.framesCount, fileSize,
+                metadata.peakScore, metadata.meanScore, int(metadata.hasMotion)
+            )
+        )
+        clipId = cursor.lastrowid
+
+        self._db.executemany(
+            "INSERT INTO events (clip_id, camera, start_ts, end_ts, peak_score, mean_score) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (clipId, metadata.cameraName, toTimestamp(r.startDts), toTimestamp(r.endDts), r.peakScore, r.meanScore)
+                for r in metadata.motionRanges
+            ]
+        )
+
+        # max clip duration allows to use index on start_ts for range queries
+        if (endTs - startTs) > self._maxClipDuration():
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('max_clip_duration', ?)", (endTs - startTs,))
+
+        return clipId
+
+    def removeClip(self, fileName):
+        self._db.execute("DELETE FROM clips WHERE path = ?", (os.path.abspath(fileName),))
+
+    def updateClipPath(self, oldFileName, newFileName):
+        self._db.execute("UPDATE clips SET path = ? WHERE path = ?", (os.path.abspath(newFileName), os.path.abspath(oldFileName)))
+
+    def clear(self):
+        self._db.execute("DELETE FROM events")
+        self._db.execute("DELETE FROM clips")
+        self._db.execute("DELETE FROM meta")
+
+    def findClips(self, camera, startDts, endDts):
+        """
+        Returns clips of camera which overlap with time range
+
+        :param camera: camera name
+        :param startDts: range start (UTC)
+        :param endDts: range end (UTC)
+        :return: list of ClipRecord ordered by start
+        """
+        startTs = toTimestamp(startDts)
+        rows = self._db.execute(
+            "SELECT {} FROM clips WHERE camera = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? "
+            "ORDER BY start_ts".format(self.CLIP_COLUMNS),
+            (camera, startTs - self._maxClipDuration(), toTimestamp(endDts), startTs)
+        )
+        return [ClipRecord(row) for row in rows]
+
+    def cameras(self):
+        return [row[0] for row in self._db.execute("SELECT DISTINCT camera FROM clips")]
+
+    def cameraUsage(self, camera):
+        """
+        Returns total size of camera clips in bytes
+        """
+        row = self._db.execute("SELECT SUM(bytes) FROM clips WHERE camera = ?", (camera,)).fetchone()
+        return row[0] or 0
+
+    def oldestClips(self, camera = None, pathPrefix = None, endBefore = None, hasMotion = None, limit = 100):
+        """
+        Returns oldest clips matching all given conditions
+
+        :param camera: camera name
+        :param pathPrefix: prefix of clip path, for example archive root
+        :param endBefore: clips which ended before this DTS (UTC)
+        :param hasMotion: clips with (True) or without (False) motion
+        :param limit: max count of clips
+        :return: list of ClipRecord ordered by start
+        """
+        conditions = []
+        params = []
+
+        if camera is not None:
+            conditions.append("camera = ?")
+            params.append(camera)
+
+        if pathPrefix is not None:
+            conditions.append("substr(path, 1, ?) = ?")
+            pathPrefix = os.path.join(os.path.abspath(pathPrefix), "")
+            params.extend([len(pathPrefix), pathPrefix])
+
+        if endBefore is not None:
+            conditions.append("end_ts < ?")
+            params.append(toTimestamp(endBefore))
+
+        if hasMotion is not None:
+            conditions.append("has_motion = ?")
+            params.append(int(hasMotion))
+
+        where = ("WHERE " + " AND ".join(conditions)) if len(conditions) > 0 else ""
+        rows = self._db.execute(
+            "SELECT {} FROM clips {} ORDER BY start_ts LIMIT ?".format(self.CLIP_COLUMNS, where),
+            params + [limit]
+        )
+        return [ClipRecord(row) for row in rows]
+
+    def findEvents(self, camera, startDts, endDts):
+        """
+        Returns motion-events of camera which overlap with time range
+
+        :return: list of tuples (clip path, start DTS, end DTS, peak score, mean score) ordered by start
+        """
+        startTs = toTimestamp(startDts)
+        rows = self._db.execute(
+            "SELECT clips.path, events.start_ts, events.end_ts, events.peak_score, events.mean_score "
+            "FROM events JOIN clips ON clips.id = events.clip_id "
+            "WHERE events.camera = ? AND events.start_ts >= ? AND events.start_ts < ? AND events.end_ts > ? "
+            "ORDER BY events.start_ts",
+            (camera, startTs - self._maxClipDuration(), toTimestamp(endDts), startTs)
+        )
+        return [(path, fromTimestamp(start), fromTimestamp(end), peak, mean) for (path, start, end, peak, mean) in rows]
+
+
+class RecordingIndexWriter(threading.Thread):
+    """
+    Adds clips to recording index from background thread, inserts are committed in batches
+    """
+
+    BATCH_SIZE = 100
+    BATCH_INTERVAL_SECONDS = 1.0
+
+    def __init__(self, logger, fileName):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.fileName = fileName
+
+        self.indexedClipsCount = 0
+
+        self._queue = Queue.Queue()
+
+    def addClip(self, fileName, metadata):
+        """
+        Adds clip to index, can be used as clip listener
+
+        :param fileName: clip file name
+        :param metadata: ClipMetadata
+        :return: None
+        """
+        if metadata is None:
+            return
+
+        self._queue.put((fileName, metadata))
+
+    def removeClip(self, fileName):
+        """
+        Removes clip from index, for example clip which was indexed in staging directory and moved to archive
+
+        :param fileName: clip file name
+        :return: None
+        """
+        # item without metadata is removal
+        self._queue.put((fileName, None))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def queueSize(self):
+        return self._queue.qsize()
+
+    def _nextBatch(self):
+        """
+        Waits for the first item and then collects items which are already available
+        :return: tuple of (list of items, stop flag)
+        """
+        item = self._queue.get()
+        if item is None:
+            return ([], True)
+
+        batch = [item]
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                item = self._queue.get(timeout=self.BATCH_INTERVAL_SECONDS)
+            except Queue.Empty:
+                break
+
+            if item is None:
+                return (batch, True)
+
+            batch.append(item)
+
+        return (batch, False)
+
+    def run(self):
+        index = RecordingIndex(self.fileName)
+
+        stopped = False
+        while not stopped:
+            (batch, stopped) = self._nextBatch()
+
+            for (fileName, metadata) in batch:
+                try:
+                    if metadata is None:
+                        index.removeClip(fileName)
+                    else:
+                        index.insertClip(fileName, metadata)
+                except (OSError, sqlite3.Error) as e:
+                    self.logger.error("can't add clip to index {}: {}".format(fileName, e))
+
+            try:
+                index.commit()
+            except sqlite3.Error as e:
+                self.logger.error("can't commit recording index: {}".format(e))
+                continue
+
+            self.indexedClipsCount += len(batch)
+
+        index.close()
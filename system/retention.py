@@ -0,0 +1,319 @@
+import os
+import errno
+import sqlite3
+import threading
+import datetime as dts
+import config
+from system.clip_metadata import ClipMetadata, sidecarFileNames, isClipFileName
+from system.recording_index import RecordingIndex
+
+
+def removeClipFiles(logger, clipFileName, removeFunc = os.remove):
+    """
+    Removes clip with its sidecar files, clip is removed last, so its sidecar files are never left without it
+
+    :param logger: logger
+    :param clipFileName: clip file name
+    :param removeFunc: function used to remove single file
+    :return: True on success, otherwise False
+    """
+    for fileName in sidecarFileNames(clipFileName) + [clipFileName]:
+        try:
+            removeFunc(fileName)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                continue
+
+            logger.error("can't remove file {}: {}".format(fileName, e))
+            return False
+
+    return True
+
+
+class SegmentRetentionSweeper(threading.Thread):
+    """
+    Removes expired recordings from video archive. Recordings with motion are kept for
+    MOTION_CLIPS_RETENTION_DAYS, recordings without motion for QUIET_CLIPS_RETENTION_DAYS.
+    """
+    def __init__(self, logger, videoPaths, checkIntervalSeconds = 60 * 60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        # archive roots
+        self.videoPaths = videoPaths
+        self.checkIntervalSeconds = checkIntervalSeconds
+
+        self.motionRetentionDays = config.MOTION_CLIPS_RETENTION_DAYS
+        self.quietRetentionDays = config.QUIET_CLIPS_RETENTION_DAYS
+
+        self.removedFilesCount = 0
+
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def _isExpired(self, metadata, now):
+        retentionDays = self.motionRetentionDays if metadata.hasMotion else self.quietRetentionDays
+        if retentionDays <= 0:
+            return False
+
+        endDts = metadata.endDts if metadata.endDts is not None else metadata.startDts
+        if endDts is None:
+            return False
+
+        return (endDts + dts.timedelta(days=retentionDays)) < now
+
+    def _removeClip(self, clipFileName):
+        if not removeClipFiles(self.logger, clipFileName):
+            return False
+
+        self.removedFilesCount += 1
+        return True
+
+    def sweep(self):
+        """
+        Walks video archive and removes expired recordings
+        :return: count of removed recordings
+        """
+        now = dts.datetime.utcnow()
+        removed = 0
+
+        for videoPath in self.videoPaths:
+            removed += self._sweepPath(videoPath, now)
+
+        return removed
+
+    def _sweepPath(self, videoPath, now):
+        removed = 0
+
+        for (root, dirs, files) in os.walk(videoPath):
+            for fileName in files:
+                if not isClipFileName(fileName):
+                    continue
+
+                clipFileName = os.path.join(root, fileName)
+                metadata = ClipMetadata.load(clipFileName)
+                if (metadata is None) or (not self._isExpired(metadata, now)):
+                    continue
+
+                self.logger.info("removing expired recording: {}".format(clipFileName))
+                if self._removeClip(clipFileName):
+                    removed += 1
+
+                if self._stopEvent.is_set():
+                    return removed
+
+        return removed
+
+    def run(self):
+        while not self._stopEvent.is_set():
+            removed = self.sweep()
+            if removed > 0:
+                self.logger.info("removed expired recordings: {}".format(removed))
+
+            self._stopEvent.wait(self.checkIntervalSeconds)
+
+
+class QuotaRetentionManager(threading.Thread):
+    """
+    Keeps video archive within limits using recording index, so archive is never walked:
+        - recordings with and without motion are kept for MOTION_CLIPS_RETENTION_DAYS and QUIET_CLIPS_RETENTION_DAYS;
+        - each camera is limited by max size in bytes and max age in days;
+        - each archive root keeps at least RETENTION_MIN_FREE_BYTES of free space.
+    Oldest clips are removed first. Removal is throttled, large files are truncated step by step before
+    unlinking, so deletes don't stall disk for active writers.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, logger, indexFileName, archiveRoots, checkIntervalSeconds = 60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.indexFileName = indexFileName
+
+        self.archiveRoots = archiveRoots
+        self.checkIntervalSeconds = checkIntervalSeconds
+
+        self.motionRetentionDays = config.MOTION_CLIPS_RETENTION_DAYS
+        self.quietRetentionDays = config.QUIET_CLIPS_RETENTION_DAYS
+
+        # default quota (max bytes, max days) of camera and quotas for specific cameras, 0 - unlimited
+        self.defaultQuota = (config.RETENTION_MAX_BYTES_PER_CAMERA, config.RETENTION_MAX_DAYS_PER_CAMERA)
+        self.cameraQuotas = dict(config.RETENTION_CAMERA_QUOTAS)
+
+        self.minFreeBytes = config.RETENTION_MIN_FREE_BYTES
+
+        # pause after each removed clip and after each truncate step
+        self.deleteIntervalSeconds = config.RETENTION_DELETE_INTERVAL_SECONDS
+        self.truncateStepBytes = config.RETENTION_TRUNCATE_STEP_BYTES
+
+        self.removedFilesCount = 0
+        self.removedBytes = 0
+
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    @staticmethod
+    def isRequired():
+        """
+        Checks that at least one retention limit is configured
+        """
+        return any([
+            config.MOTION_CLIPS_RETENTION_DAYS > 0,
+            config.QUIET_CLIPS_RETENTION_DAYS > 0,
+            config.RETENTION_MAX_BYTES_PER_CAMERA > 0,
+            config.RETENTION_MAX_DAYS_PER_CAMERA > 0,
+            len(config.RETENTION_CAMERA_QUOTAS) > 0,
+            config.RETENTION_MIN_FREE_BYTES > 0
+        ])
+
+    def _quota(self, camera):
+        return self.cameraQuotas.get(camera, self.defaultQuota)
+
+    def _removeFile(self, fileName):
+        """
+        Truncates file step by step and then unlinks it
+        """
+        if self.truncateStepBytes > 0:
+            size = os.path.getsize(fileName)
+            with open(fileName, "r+b") as f:
+                while size > self.truncateStepBytes:
+                    size -= self.truncateStepBytes
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+                    self._stopEvent.wait(self.deleteIntervalSeconds)
+
+        os.remove(fileName)
+
+    def _removeClips(self, index, clips, reason):
+        """
+        Removes clips from disk and from index
+
+        :return: count of removed clips
+        """
+        removed = 0
+        for clip in clips:
+            if self._stopEvent.is_set():
+                break
+
+            self.logger.info("removing recording ({}): {}".format(reason, clip.path))
+            if not removeClipFiles(self.logger, clip.path, self._removeFile):
+                continue
+
+            index.removeClip(clip.path)
+            index.commit()
+
+            removed += 1
+            self.removedFilesCount += 1
+            self.removedBytes += clip.bytes
+
+            self._stopEvent.wait(self.deleteIntervalSeconds)
+
+        return removed
+
+    def _removeOlderThan(self, index, days, now, reason, **conditions):
+        if days <= 0:
+            return 0
+
+        endBefore = now - dts.timedelta(days=days)
+
+        removed = 0
+        while not self._stopEvent.is_set():
+            clips = index.oldestClips(endBefore=endBefore, limit=self.BATCH_SIZE, **conditions)
+            qty = self._removeClips(index, clips, reason)
+            removed += qty
+            if (qty == 0) or (len(clips) < self.BATCH_SIZE):
+                break
+
+        return removed
+
+    def _enforceCameraSize(self, index, camera, maxBytes):
+        if maxBytes <= 0:
+            return 0
+
+        usage = index.cameraUsage(camera)
+
+        removed = 0
+        while (usage > maxBytes) and (not self._stopEvent.is_set()):
+            clips = []
+            for clip in index.oldestClips(camera=camera, limit=self.BATCH_SIZE):
+                if usage <= maxBytes:
+                    break
+
+                clips.append(clip)
+                usage -= clip.bytes
+
+            qty = self._removeClips(index, clips, "camera quota")
+            removed += qty
+            if qty == 0:
+                break
+
+            usage = index.cameraUsage(camera)
+
+        return removed
+
+    @staticmethod
+    def _freeBytes(path):
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    def _enforceFreeSpace(self, index, root):
+        if (self.minFreeBytes <= 0) or (not os.path.exists(root)):
+            return 0
+
+        removed = 0
+        while (self._freeBytes(root) < self.minFreeBytes) and (not self._stopEvent.is_set()):
+            # removing one clip at time, free space is checked after each of them
+            qty = self._removeClips(index, index.oldestClips(pathPrefix=root, limit=1), "low free space")
+            if qty == 0:
+                if self._stopEvent.is_set():
+                    break
+
+                self.logger.warning("free space on {} is below limit, but there are no clips to remove".format(root))
+                break
+
+            removed += qty
+
+        return removed
+
+    def sweep(self, index):
+        """
+        Removes recordings which exceed limits
+        :return: count of removed recordings
+        """
+        now = dts.datetime.utcnow()
+
+        removed = self._removeOlderThan(index, self.motionRetentionDays, now, "expired", hasMotion=True)
+        removed += self._removeOlderThan(index, self.quietRetentionDays, now, "expired", hasMotion=False)
+
+        for camera in index.cameras():
+            (maxBytes, maxDays) = self._quota(camera)
+            removed += self._removeOlderThan(index, maxDays, now, "camera quota", camera=camera)
+            removed += self._enforceCameraSize(index, camera, maxBytes)
+
+        for root in self.archiveRoots:
+            removed += self._enforceFreeSpace(index, root)
+
+        return removed
+
+    def run(self):
+        index = RecordingIndex(self.indexFileName)
+
+        while not self._stopEvent.is_set():
+            try:
+                removed = self.sweep(index)
+            except sqlite3.Error as e:
+                self.logger.error("can't apply retention with recording index: {}".format(e))
+                removed = 0
+
+            if removed > 0:
+                self.logger.info("removed recordings: {}, total removed bytes: {}".format(removed, self.removedBytes))
+
+            self._stopEvent.wait(self.checkIntervalSeconds)
+
+        index.close()
@@ -60,6 +60,24 @@ def mkdir_p(path):
     return ok
 
 
+def uniqueFileName(fileName):
+    """
+    Returns file name which is not used yet, adds numeric suffix when needed.
+
+    :param fileName: desired file name
+    :return: file name which does not exist on disk
+    """
+    if not os.path.exists(fileName):
+        return fileName
+
+    (base, ext) = os.path.splitext(fileName)
+    index = 1
+    while os.path.exists("{}_{}{}".format(base, index, ext)):
+        index += 1
+
+    return "{}_{}{}".format(base, index, ext)
+
+
 def makeAbsoluteAppPath(path, basePath = None):
     """
     Converts relative path to absolute.
@@ -0,0 +1,157 @@
+import os
+import uuid
+import threading
+import Queue
+import cv2 as cv
+
+
+def snapshotFileName(clipFileName, index):
+    return "{}.snap{:02}.jpg".format(os.path.splitext(clipFileName)[0], index)
+
+
+def pendingSnapshotFileName(clipFileName):
+    """
+    Temporary name of snapshot, final name is known only when clip is closed
+    """
+    return os.path.join(os.path.dirname(clipFileName), ".snap_{}.jpg".format(uuid.uuid4().hex))
+
+
+class SnapshotEncoder:
+    """
+    Bounded pool of threads which encode snapshots to JPEG files. Snapshots are dropped when queue is full,
+    so capture thread is never blocked.
+    """
+
+    def __init__(self, logger, threadsQty = 2, maxQueueSize = 8, quality = 90):
+        self.logger = logger
+        self.quality = quality
+
+        self.savedCount = 0
+        self.droppedCount = 0
+
+        self._queue = Queue.Queue(maxQueueSize)
+
+        # names of snapshots which are submitted but not saved yet
+        self._pendingNames = set()
+        self._pendingCondition = threading.Condition()
+        self._threads = [threading.Thread(target=self._run) for i in range(threadsQty)]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, fileName, frame):
+        """
+        Adds frame to encoding queue, frame must not be changed after it
+
+        :param fileName: JPEG file name
+        :param frame: frame
+        :return: True when frame added, False when dropped
+        """
+        with self._pendingCondition:
+            self._pendingNames.add(fileName)
+
+        try:
+            self._queue.put_nowait((fileName, frame))
+        except Queue.Full:
+            self._finished(fileName)
+            self.droppedCount += 1
+            return False
+
+        return True
+
+    def waitSaved(self, fileNames):
+        """
+        Waits until given snapshots are saved (or failed), snapshots of other clips are not waited for
+        """
+        with self._pendingCondition:
+            while not self._pendingNames.isdisjoint(fileNames):
+                self._pendingCondition.wait()
+
+    def _finished(self, fileName):
+        with self._pendingCondition:
+            self._pendingNames.discard(fileName)
+            self._pendingCondition.notify_all()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            (fileName, frame) = item
+            try:
+                if cv.imwrite(fileName, frame, [cv.IMWRITE_JPEG_QUALITY, self.quality]):
+                    self.savedCount += 1
+                else:
+                    self.logger.error("can't save snapshot: {}".format(fileName))
+            finally:
+                self._finished(fileName)
+
+
+class SnapshotBurst:
+    """
+    Collects snapshot frames of single motion-event: frame with peak motion score and frames spread over
+    the event. Duration of event is unknown, so every stride-th frame is kept and when too many frames are
+    kept, every second one is dropped and stride is doubled.
+    """
+
+    def __init__(self, maxQty):
+        # max count of frames: peak and spread frames
+        self.maxQty = maxQty
+
+        self._index = 0
+        self._stride = 1
+
+        # list of tuples (frame index, frame)
+        self._frames = []
+
+        # tuple (score, frame index, frame)
+        self._peak = None
+
+    def add(self, frame, score):
+        """
+        Adds frame of motion-event, kept frames aren't copied, so they must not be changed after it
+
+        :param frame: frame
+        :param score: motion score of frame or None
+        :return: True when frame was kept
+        """
+        if self.maxQty <= 0:
+            return False
+
+        kept = False
+        score = score if score is not None else -1
+        if (self._peak is None) or (score > self._peak[0]):
+            self._peak = (score, self._index, frame)
+            kept = True
+
+        spreadQty = self.maxQty - 1
+        if (spreadQty > 0) and (self._index % self._stride == 0):
+            self._frames.append((self._index, frame))
+            kept = True
+            if len(self._frames) > spreadQty:
+                self._frames = self._frames[::2]
+                self._stride *= 2
+
+        self._index += 1
+        return kept
+
+    def frames(self):
+        """
+        Returns kept frames in time order
+        """
+        frames = dict(self._frames)
+        if self._peak is not None:
+            frames[self._peak[1]] = self._peak[2]
+
+        return [frames[index] for index in sorted(frames.keys())]
@@ -0,0 +1,363 @@
+import os
+import time
+import uuid
+import threading
+import Queue
+import cv2 as cv
+import config
+from system.shared import mkdir_p, uniqueFileName
+from system.prealarm_buffer import EncodedFrame
+
+
+def openVideoWriter(dirName, videoSize):
+    """
+    Creates directory (when needed) and opens new video writer with temporary (pending) name in it.
+
+    :param dirName: directory for output file
+    :param videoSize: tuple of width and height
+    :return: tuple of pending file name and writer or (None, None) on error
+    """
+    if not os.path.exists(dirName):
+        if not mkdir_p(dirName):
+            return (None, None)
+
+    pendingName = os.path.join(dirName, ".pending_{}{}".format(uuid.uuid4().hex, config.OUTPUT_FILES_EXTENSION))
+
+    fourcc = cv.VideoWriter_fourcc(*config.FOURCC_CODEC)
+    output = cv.VideoWriter(pendingName, fourcc, config.OUTPUT_FRAME_RATE, videoSize)
+
+    return (pendingName, output)
+
+
+class VideoWriterPreparer(threading.Thread):
+    """
+    Prepares next output file (directory, pending file name and writer) in background, so motion trigger
+    does not need to wait for it.
+    """
+    def __init__(self, logger):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self._requests = Queue.Queue()
+        self._lock = threading.Lock()
+
+        # prepared writer: tuple of (dirName, videoSize, pendingName, output)
+        self._prepared = None
+        self._stopped = False
+
+    def prepare(self, dirName, videoSize):
+        """
+        Requests preparation of writer for given directory and frame size.
+
+        :param dirName: directory for output file
+        :param videoSize: tuple of width and height
+        :return: None
+        """
+        self._requests.put((dirName, videoSize))
+
+    def take(self, dirName, videoSize):
+        """
+        Takes prepared writer when it matches requested directory and frame size. New writer for the same
+        parameters will be prepared automatically.
+
+        :param dirName: directory for output file
+        :param videoSize: tuple of width and height
+        :return: tuple of pending file name and writer or None when nothing prepared
+        """
+        with self._lock:
+            prepared = self._prepared
+            self._prepared = None
+
+        self.prepare(dirName, videoSize)
+
+        if prepared is None:
+            return None
+
+        (preparedDir, preparedSize, pendingName, output) = prepared
+        if (preparedDir == dirName) and (preparedSize == videoSize):
+            return (pendingName, output)
+
+        self._discard(prepared)
+        return None
+
+    def stop(self):
+        """
+        Requests stop of preparation thread, unused prepared writer will be released and its file removed
+        :return: None
+        """
+        self._stopped = True
+        self._requests.put(None)
+
+    def _discard(self, prepared):
+        (_, _, pendingName, output) = prepared
+        output.release()
+
+        try:
+            os.remove(pendingName)
+        except OSError as e:
+            self.logger.warning("can't remove unused file {}: {}".format(pendingName, e))
+
+    def run(self):
+        while not self._stopped:
+            request = self._requests.get()
+            if request is None:
+                break
+
+            (dirName, videoSize) = request
+
+            with self._lock:
+                prepared = self._prepared
+
+            if (prepared is not None) and (prepared[0] == dirName) and (prepared[1] == videoSize):
+                continue
+
+            (pendingName, output) = openVideoWriter(dirName, videoSize)
+            if output is None:
+                self.logger.error("can't prepare writer in directory: {}".format(dirName))
+                continue
+
+            with self._lock:
+                prev = self._prepared
+                self._prepared = (dirName, videoSize, pendingName, output)
+
+            if prev is not None:
+                self._discard(prev)
+
+        with self._lock:
+            prepared = self._prepared
+            self._prepared = None
+
+        if prepared is not None:
+            self._discard(prepared)
+
+
+class AsyncVideoWriter(threading.Thread):
+    """
+    Writes frames to output file in background thread. Frames are written in the same order as they were added,
+    so pre-alarm frames may be streamed to encoder while live frames are added.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, logger, output, pendingName, fileName, triggerTime, maxQueueSize = 0):
+        threading.Thread.__init__(self)
+        self.daemon = False
+        self.logger = logger
+
+        self._output = output
+        self._pendingName = pendingName
+
+        self.fileName = fileName
+        self.triggerTime = triggerTime
+
+        # seconds between trigger and moment when first frame was handed to encoder
+        self.firstFrameLatency = None
+        self.onFirstFrameWritten = None
+
+        # frames accepted to queue (position of next frame in video) and frames handed to encoder
+        self.framesQueued = 0
+        self.framesWritten = 0
+        self.droppedFrames = 0
+        self.lastWriteTime = None
+
+        # max size of queued frames (0 - unlimited), frames are dropped when it's exceeded
+        self.maxQueuedBytes = 0
+
+        # bytes of frames added to queue and bytes of written frames, each counter is changed by single thread
+        self._bytesQueued = 0
+        self._bytesWritten = 0
+
+        # ClipMetadata which will be saved next to output file when it's closed
+        self.metadata = None
+
+        # MotionTimeline which will be saved next to output file when it's closed
+        self.timeline = None
+
+        # function which will be called (from writer thread) when file closed: onClosed(fileName, metadata)
+        self.onClosed = None
+
+        self._queue = Queue.Queue(maxQueueSize)
+
+        # set by close(), so writer thread finishes file even when close marker didn't fit into full queue
+        self._closeRequested = threading.Event()
+
+        # True when writing failed, following frames are dropped
+        self.failed = False
+
+    def queueSize(self):
+        return self._queue.qsize()
+
+    def queuedBytes(self):
+        return self._bytesQueued - self._bytesWritten
+
+    def write(self, frame):
+        """
+        Adds frame to writer queue, frame is dropped when queue is full or size of queued frames exceeds limit
+
+        :param frame: frame to write
+        :return: True when frame added, otherwise False
+        """
+        # frame is always added to empty queue, so recording goes on when single frame exceeds limit
+        if self.failed:
+            self.droppedFrames += 1
+            return False
+
+        queuedBytes = self.queuedBytes()
+        if (self.maxQueuedBytes > 0) and (queuedBytes > 0) and (queuedBytes + frame.nbytes > self.maxQueuedBytes):
+            self.droppedFrames += 1
+            return False
+
+        try:
+            self._queue.put_nowait(frame)
+        except Queue.Full:
+            self.droppedFrames += 1
+            return False
+
+        self._bytesQueued += frame.nbytes
+        self.framesQueued += 1
+        return True
+
+    def writeMany(self, frames, onWritten = None):
+        """
+        Adds sequence of frames to writer queue as a single item, frames are dropped when queue is full
+
+        :param frames: list of frames
+        :param onWritten: function which will be called when all frames are written or dropped
+        :return: True when frames added, otherwise False
+        """
+        if len(frames) == 0:
+            if onWritten is not None:
+                onWritten()
+            return True
+
+        try:
+            if self.failed:
+                raise Queue.Full()
+
+            self._queue.put_nowait((frames, onWritten))
+        except Queue.Full:
+            self.droppedFrames += len(frames)
+            if onWritten is not None:
+                onWritten()
+            return False
+
+        self._bytesQueued += sum(frame.nbytes for frame in frames)
+        self.framesQueued += len(frames)
+        return True
+
+    def close(self):
+        """
+        Requests closing of output file, returns immediately
+        :return: None
+        """
+        self._closeRequested.set()
+
+        # when queue is full writer thread finishes file after queued frames are written
+        try:
+            self._queue.put_nowait(self._CLOSE)
+        except Queue.Full:
+            pass
+
+    def _writeFrame(self, frame):
+        self._bytesWritten += frame.nbytes
+
+        # compressed pre-alarm frames
+        if isinstance(frame, EncodedFrame):
+            frame = frame.decode()
+
+        self._output.write(frame)
+        self.framesWritten += 1
+        self.lastWriteTime = time.time()
+
+        if self.firstFrameLatency is not None:
+            return
+
+        self.firstFrameLatency = time.time() - self.triggerTime
+        if self.onFirstFrameWritten is not None:
+            self.onFirstFrameWritten(self.firstFrameLatency)
+
+    def _nextItem(self):
+        """
+        Returns next queued item or _CLOSE when file must be closed
+        """
+        while True:
+            try:
+                return self._queue.get(timeout=0.5)
+            except Queue.Empty:
+                if self._closeRequested.is_set():
+                    return self._CLOSE
+
+    def _writeItems(self):
+        while True:
+            item = self._nextItem()
+            if item is self._CLOSE:
+                break
+
+            if isinstance(item, tuple):
+                (frames, onWritten) = item
+                try:
+                    for frame in frames:
+                        self._writeFrame(frame)
+                finally:
+                    if onWritten is not None:
+                        onWritten()
+            else:
+                self._writeFrame(item)
+
+    def _releaseQueuedItems(self):
+        """
+        Drops frames which were not written, buffers of queued pre-alarm frames are released
+        """
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            if isinstance(item, tuple):
+                (frames, onWritten) = item
+                self.droppedFrames += len(frames)
+                if onWritten is not None:
+                    onWritten()
+            elif item is not self._CLOSE:
+                self.droppedFrames += 1
+
+    def run(self):
+        try:
+            self._writeItems()
+        except Exception as e:
+            self.failed = True
+            self.logger.error("writing to {} failed: {}".format(self.fileName, e))
+            self._releaseQueuedItems()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        """
+        Closes output file and renames it to final name, then saves metadata
+        :return: None
+        """
+        self._output.release()
+        self._output = None
+
+        fileName = uniqueFileName(self.fileName)
+        try:
+            os.rename(self._pendingName, fileName)
+        except OSError as e:
+            self.logger.error("can't rename {} to {}: {}".format(self._pendingName, fileName, e))
+            return
+
+        self.fileName = fileName
+        self.logger.info("file closed: {} ({} frames)".format(fileName, self.framesWritten))
+
+        if self.metadata is not None:
+            self.metadata.framesCount = self.framesWritten
+            if not self.metadata.save(fileName):
+                self.logger.error("can't save metadata for file: {}".format(fileName))
+
+        if (self.timeline is not None) and (not self.timeline.save(fileName)):
+            self.logger.error("can't save motion timeline for file: {}".format(fileName))
+
+        if self.onClosed is not None:
+            self.onClosed(fileName, self.metadata)
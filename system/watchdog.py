@@ -0,0 +1,221 @@
+import time
+import threading
+
+
+# main loop of recorder is blocked (for example reading from camera hangs), recorder thread is replaced
+STATUS_STALLED = "stalled"
+
+# main loop works, but frames aren't received from camera, connection to camera is reopened
+STATUS_NO_FRAMES = "no_frames"
+
+# writer doesn't write queued frames
+STATUS_WRITER_STALLED = "writer_stalled"
+
+STATUS_STARTING = "starting"
+STATUS_OK = "ok"
+
+
+def secondsSince(timestamp, now):
+    return (now - timestamp) if timestamp is not None else None
+
+
+def cameraStatus(health, now, stallSeconds):
+    """
+    Classifies progress of recorder stages
+
+    :param health: dictionary returned by MotionDrivenRecorder.getHealth()
+    :return: one of STATUS_* values
+    """
+    if health["lastLoopTime"] is None:
+        return STATUS_STARTING
+
+    if now - health["lastLoopTime"] > stallSeconds:
+        return STATUS_STALLED
+
+    lastFrameTime = health["lastFrameTime"] if health["lastFrameTime"] is not None else health["startedTime"]
+    if now - lastFrameTime > stallSeconds:
+        return STATUS_NO_FRAMES
+
+    if (health["writerQueueSize"] > 0) and (now - health["lastWriteTime"] > stallSeconds):
+        return STATUS_WRITER_STALLED
+
+    return STATUS_OK
+
+
+class PipelineWatchdog(threading.Thread):
+    """
+    Checks progress of camera recorders: when main loop of recorder is blocked longer than stall interval,
+    onStalled(cameraName) is called (camera manager replaces recorder thread, blocked thread is abandoned);
+    when loop works but no frames are received, connection to camera is reopened. Interval between actions
+    for camera which doesn't recover is doubled after each action (up to maxBackoffSeconds) and after maxReopens
+    reopens without frames recorder is restarted. Status of cameras and effective frame rate are available
+    with getHealth().
+
+    Camera is object with health() (see MotionDrivenRecorder.getHealth()) and reopen() methods.
+    """
+
+    def __init__(self, logger, stallSeconds, intervalSeconds):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+
+        self.stallSeconds = stallSeconds
+        self.intervalSeconds = intervalSeconds
+
+        # reopens without frames before recorder is restarted (0 - recorder isn't restarted)
+        self.maxReopens = 3
+
+        # max interval between actions for camera which doesn't recover
+        self.maxBackoffSeconds = 600
+
+        self.onStalled = None
+
+        # camera name -> camera
+        self._cameras = {}
+
+        # camera name -> health of camera reported by getHealth()
+        self._health = {}
+
+        # camera name -> (time, processed frames) of previous check, time of last action, counts of actions
+        self._previous = {}
+        self._lastAction = {}
+        self._restarts = {}
+        self._reopens = {}
+
+        # camera name -> count of actions since camera worked last time, reopens since last restart
+        self._failedActions = {}
+        self._failedReopens = {}
+
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+
+    def addCamera(self, cameraName, camera):
+        with self._lock:
+            self._cameras[cameraName] = camera
+            self._previous.pop(cameraName, None)
+
+            # time of last action and counts of failed actions are kept, so restarted recorder continues backoff
+
+    def removeCamera(self, cameraName, camera = None):
+        with self._lock:
+            if (camera is not None) and (self._cameras.get(cameraName) is not camera):
+                return
+
+            self._cameras.pop(cameraName, None)
+            self._health.pop(cameraName, None)
+            self._previous.pop(cameraName, None)
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def getHealth(self):
+        """
+        :return: dictionary with "ok" (True when all cameras work) and "cameras": camera name -> health
+        """
+        with self._lock:
+            cameras = dict((name, dict(health)) for (name, health) in self._health.items())
+
+        ok = all(health["status"] in [STATUS_OK, STATUS_STARTING] for health in cameras.values())
+        return {"ok": ok, "cameras": cameras}
+
+    def _effectiveFps(self, cameraName, health, now):
+        previous = self._previous.get(cameraName)
+        self._previous[cameraName] = (now, health["processedFrames"])
+        if previous is None:
+            return None
+
+        (previousTime, previousFrames) = previous
+        if (now <= previousTime) or (health["processedFrames"] < previousFrames):
+            return None
+
+        return (health["processedFrames"] - previousFrames) / (now - previousTime)
+
+    def _actionDelay(self, cameraName):
+        """
+        :return: seconds which camera gets to recover after last action
+        """
+        failedActions = self._failedActions.get(cameraName, 0)
+        if failedActions <= 1:
+            return self.stallSeconds
+
+        # limited exponent, count of failed actions grows while camera is off
+        return min(self.stallSeconds * (2 ** min(failedActions - 1, 16)), max(self.maxBackoffSeconds, self.stallSeconds))
+
+    def _selectAction(self, cameraName, status):
+        """
+        :return: action for camera which isn't recovered: STATUS_STALLED, STATUS_NO_FRAMES or None
+        """
+        if status == STATUS_NO_FRAMES:
+            failedReopens = self._failedReopens.get(cameraName, 0)
+
+            # reopening doesn't help, recorder is restarted
+            if (self.maxReopens > 0) and (failedReopens >= self.maxReopens):
+                status = STATUS_STALLED
+            else:
+                self._failedReopens[cameraName] = failedReopens + 1
+                self._reopens[cameraName] = self._reopens.get(cameraName, 0) + 1
+                return status
+
+        if status == STATUS_STALLED:
+            self._failedReopens[cameraName] = 0
+            self._restarts[cameraName] = self._restarts.get(cameraName, 0) + 1
+            return status
+
+        return None
+
+    def _checkCamera(self, cameraName, camera, now):
+        """
+        :return: action which must be done for camera: STATUS_STALLED, STATUS_NO_FRAMES or None
+        """
+        health = camera.health()
+        status = cameraStatus(health, now, self.stallSeconds)
+
+        with self._lock:
+            self._health[cameraName] = {
+                "status": status,
+                "fps": self._effectiveFps(cameraName, health, now),
+                "lastFrameAge": secondsSince(health["lastFrameTime"], now),
+                "lastDetectionAge": secondsSince(health["lastDetectionTime"], now),
+                "lastWriteAge": secondsSince(health["lastWriteTime"], now),
+                "writerQueueSize": health["writerQueueSize"],
+                "restarts": self._restarts.get(cameraName, 0),
+                "reopens": self._reopens.get(cameraName, 0),
+            }
+
+            # camera recovered when frames are received (new recorder is ok before its first frame)
+            if (status == STATUS_OK) and (health["lastFrameTime"] is not None):
+                self._failedActions.pop(cameraName, None)
+                self._failedReopens.pop(cameraName, None)
+
+            # camera gets time to recover after each action
+            lastAction = self._lastAction.get(cameraName)
+            if (lastAction is not None) and (now - lastAction < self._actionDelay(cameraName)):
+                return None
+
+            action = self._selectAction(cameraName, status)
+            if action is not None:
+                self._failedActions[cameraName] = self._failedActions.get(cameraName, 0) + 1
+                self._lastAction[cameraName] = now
+
+            return action
+
+    def check(self, now = None):
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            cameras = list(self._cameras.items())
+
+        for (cameraName, camera) in cameras:
+            action = self._checkCamera(cameraName, camera, now)
+            if action == STATUS_STALLED:
+                self.logger.error("camera {} is stalled or reopening doesn't help, restarting recorder...".format(cameraName))
+                if self.onStalled is not None:
+                    self.onStalled(cameraName)
+            elif action == STATUS_NO_FRAMES:
+                self.logger.warning("no frames from camera {}, reopening connection...".format(cameraName))
+                camera.reopen()
+
+    def run(self):
+        while not self._stopEvent.wait(self.intervalSeconds):
+            self.check()